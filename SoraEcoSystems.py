@@ -1,17 +1,36 @@
 import logging
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from aiogram import Bot, Dispatcher, Router, types, F
+from aiogram.filters import Command, StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, FSInputFile, ReplyKeyboardRemove, InlineKeyboardMarkup, \
     InlineKeyboardButton
 import sqlite3
 import asyncio
 import os
+import re
+import json
+import csv
+import secrets
+import signal
+import time
+import itertools
 from pathlib import Path
-import pandas as pd
-from datetime import datetime
-from io import BytesIO
-from openpyxl import Workbook
-from aiogram.types import BufferedInputFile
+from aiohttp import web
+from datetime import datetime, timedelta, timezone
+from collections import namedtuple, OrderedDict, Counter, deque
+from contextvars import ContextVar
+from functools import wraps
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+# pandas и openpyxl нужны только выгрузкам и импортируются внутри них,
+# чтобы не замедлять запуск бота
 import os
 from dotenv import load_dotenv
 import logging
@@ -39,231 +58,1359 @@ logger = logging.getLogger(__name__)
 
 # Инициализация бота
 bot = Bot(token=TOKEN)
-dp = Dispatcher()
-
-# Состояния пользователей
-user_states = {}
-user_data = {}
 
 ## ===== НАСТРОЙКА БАЗЫ ДАННЫХ =====
-BASE_DIR = Path(__file__).parent
+# DATA_DIR позволяет держать базу и выгрузки вне папки с кодом (например, для нагрузочного теста)
+BASE_DIR = Path(os.getenv("DATA_DIR") or Path(__file__).parent)
 DB_DIR = BASE_DIR / "database"
 EXPORT_DIR = BASE_DIR / "exports"
 REPORTS_DIR = BASE_DIR / "reports"
+ARCHIVE_DIR = DB_DIR / "archive"  # помесячные архивы журнала действий
 
 # Создаем необходимые директории
 DB_DIR.mkdir(exist_ok=True)
+ARCHIVE_DIR.mkdir(exist_ok=True)
 EXPORT_DIR.mkdir(exist_ok=True)
 REPORTS_DIR.mkdir(exist_ok=True)
 
 DB_PATH = DB_DIR / "SoraClub.db"  # База данных теперь в папке /database
 
-# Подключение к SQLite
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cursor = conn.cursor()
-
-# Создаем таблицы
-cursor.execute('''
-               CREATE TABLE IF NOT EXISTS products
-               (
-                   id
-                   INTEGER
-                   PRIMARY
-                   KEY
-                   AUTOINCREMENT,
-                   name
-                   TEXT
-                   NOT
-                   NULL,
-                   quantity
-                   INTEGER
-                   DEFAULT
-                   1,
-                   category
-                   TEXT,
-                   added_date
-                   TIMESTAMP
-                   DEFAULT
-                   CURRENT_TIMESTAMP
-               )
-               ''')
-
-cursor.execute('''
-               CREATE TABLE IF NOT EXISTS users
-               (
-                   user_id
-                   INTEGER
-                   PRIMARY
-                   KEY,
-                   username
-                   TEXT,
-                   first_name
-                   TEXT,
-                   is_admin
-                   BOOLEAN
-                   DEFAULT
-                   0,
-                   is_banned
-                   BOOLEAN
-                   DEFAULT
-                   0,
-                   is_approved
-                   BOOLEAN
-                   DEFAULT
-                   0,
-                   added_date
-                   TIMESTAMP
-                   DEFAULT
-                   CURRENT_TIMESTAMP,
-                   last_action
-                   TIMESTAMP
-               )
-               ''')
-
-cursor.execute('''
-               CREATE TABLE IF NOT EXISTS action_logs
-               (
-                   id
-                   INTEGER
-                   PRIMARY
-                   KEY
-                   AUTOINCREMENT,
-                   user_id
-                   INTEGER,
-                   action
-                   TEXT,
-                   details
-                   TEXT,
-                   timestamp
-                   TIMESTAMP
-                   DEFAULT
-                   CURRENT_TIMESTAMP
-               )
-               ''')
-
-# ОБНОВЛЕННАЯ ТАБЛИЦА ОТЧЕТОВ
-cursor.execute('''
-               CREATE TABLE IF NOT EXISTS shift_reports
-               (
-                   id
-                   INTEGER
-                   PRIMARY
-                   KEY
-                   AUTOINCREMENT,
-                   user_id
-                   INTEGER
-                   NOT
-                   NULL,
-                   report_date
-                   DATE
-                   NOT
-                   NULL,
-                   total
-                   REAL
-                   NOT
-                   NULL,
-                   cash
-                   REAL
-                   NOT
-                   NULL,
-                   card
-                   REAL
-                   NOT
-                   NULL,
-                   bar
-                   REAL
-                   NOT
-                   NULL,
-                   hookah_count
-                   INTEGER
-                   NOT
-                   NULL,
-                   expenses
-                   REAL
-                   NOT
-                   NULL,
-                   initial_cash
-                   REAL
-                   DEFAULT
-                   4000,
-                   balance
-                   REAL
-                   NOT
-                   NULL,
-                   timestamp
-                   TIMESTAMP
-                   DEFAULT
-                   CURRENT_TIMESTAMP
-               )
-               ''')
-
-# НОВАЯ ТАБЛИЦА ДЛЯ УПРАВЛЕНИЯ УВЕДОМЛЕНИЯМИ
-cursor.execute('''
-               CREATE TABLE IF NOT EXISTS notification_settings
-               (
-                   id
-                   INTEGER
-                   PRIMARY
-                   KEY
-                   AUTOINCREMENT,
-                   notification_type
-                   TEXT
-                   NOT
-                   NULL
-                   UNIQUE,
-                   chat_id
-                   TEXT
-                   NOT
-                   NULL
-               )
-               ''')
-conn.commit()
-
-# ID главного администратора
+
+# ===== ПРОФИЛИ ПОДКЛЮЧЕНИЯ SQLITE =====
+# Все профили включают WAL: читатели не блокируют запись, а коммит
+# дописывает журнал вместо перезаписи страниц базы. Профили отличаются
+# надёжностью записи на диск и объёмом памяти под кэш:
+#   safe     - fsync на каждый коммит, изменения переживут отключение питания
+#   balanced - fsync только при checkpoint, при сбое питания можно потерять
+#              последние транзакции, но база останется целой
+#   fast     - без fsync, для тестовых стендов и одноразовых данных
+DB_PROFILES = {
+    "safe": {
+        "synchronous": "FULL",
+        "cache_size": -16000,  # отрицательное значение - размер в КиБ
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+        "busy_timeout": 5000,
+    },
+    "balanced": {
+        "synchronous": "NORMAL",
+        "cache_size": -32000,
+        "mmap_size": 128 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    "fast": {
+        "synchronous": "OFF",
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+DB_PROFILE = os.getenv("DB_PROFILE", "balanced")
+DB_CHECKPOINT_INTERVAL = float(os.getenv("DB_CHECKPOINT_INTERVAL", "300"))  # секунды
+
+
+def connect_db(path, profile=DB_PROFILE):
+    if profile not in DB_PROFILES:
+        logger.warning(f"Неизвестный профиль базы данных '{profile}', используется 'balanced'")
+        profile = "balanced"
+    settings = DB_PROFILES[profile]
+
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=settings["busy_timeout"] / 1000)
+    conn.execute("PRAGMA journal_mode = WAL")
+    for name, value in settings.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+# ===== АСИНХРОННЫЙ СЛОЙ ДОСТУПА К БАЗЕ ДАННЫХ =====
+class Database:
+    """Обёртка над SQLite, выполняющая все запросы в отдельном потоке.
+
+    Соединение обслуживается одним фоновым потоком, поэтому запросы
+    выполняются последовательно, а обработчики лишь ожидают результат
+    и не блокируют цикл событий aiogram на дисковых операциях.
+    """
+
+    def __init__(self, path, profile=DB_PROFILE):
+        self.path = path
+        self.conn = connect_db(path, profile)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._checkpoint_task = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        trace = handler_trace.get()
+        if trace is None:
+            return await loop.run_in_executor(self._executor, func, *args)
+        return await loop.run_in_executor(self._executor, self._traced, trace, func, args)
+
+    def _traced(self, trace, func, args):
+        """Выполняет func и записывает её запросы и время в трассировку обработчика."""
+        if func is self._transaction:
+            label = args[0].__name__
+        elif func in (self._execute, self._executemany, self._fetchone, self._fetchall):
+            label = " ".join(args[0].split())
+        else:
+            label = getattr(func, "__name__", "query")
+        self._statement_count = 0
+        self._last_statement = None
+        self.conn.set_trace_callback(self._count_statement)
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.conn.set_trace_callback(None)
+            trace.add_query(label, time.perf_counter() - started, self._statement_count)
+
+    def _count_statement(self, sql):
+        # Каждое выражение триггера повторяет в трассировке текст вызвавшего
+        # его запроса, а управление транзакцией к запросам не относится
+        if sql != self._last_statement and not sql.startswith(("--", "BEGIN", "COMMIT", "ROLLBACK")):
+            self._statement_count += 1
+        self._last_statement = sql
+
+    def _execute(self, sql, params):
+        with self.conn:
+            return self.conn.execute(sql, params)
+
+    def _executemany(self, sql, seq_of_params):
+        with self.conn:
+            return self.conn.executemany(sql, seq_of_params)
+
+    def _fetchone(self, sql, params):
+        return self.conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params):
+        return self.conn.execute(sql, params).fetchall()
+
+    def _transaction(self, func, args):
+        with self.conn:
+            return func(self.conn, *args)
+
+    async def execute(self, sql, params=()):
+        """Выполняет изменяющий запрос и фиксирует транзакцию."""
+        return await self._run(self._execute, sql, params)
+
+    async def executemany(self, sql, seq_of_params):
+        """Выполняет запрос для набора параметров в одной транзакции."""
+        return await self._run(self._executemany, sql, list(seq_of_params))
+
+    async def fetchone(self, sql, params=()):
+        return await self._run(self._fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self._run(self._fetchall, sql, params)
+
+    async def transaction(self, func, *args):
+        """Выполняет func(conn, *args) в потоке БД внутри одной транзакции."""
+        return await self._run(self._transaction, func, args)
+
+    async def call(self, func, *args):
+        """Выполняет func(conn, *args) в потоке БД; транзакциями управляет сама func."""
+        return await self._run(func, self.conn, *args)
+
+    def _checkpoint(self, mode):
+        return self.conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+
+    async def checkpoint(self, mode="PASSIVE"):
+        """Переносит страницы из WAL-журнала в основной файл базы."""
+        return await self._run(self._checkpoint, mode)
+
+    def start_checkpoints(self, interval=DB_CHECKPOINT_INTERVAL):
+        if self._checkpoint_task is None and interval > 0:
+            self._checkpoint_task = asyncio.create_task(self._run_checkpoints(interval))
+
+    async def _run_checkpoints(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.checkpoint()
+            except Exception as e:
+                logger.error(f"Ошибка checkpoint базы данных: {e}")
+
+    async def close(self):
+        if self._checkpoint_task is not None:
+            self._checkpoint_task.cancel()
+            self._checkpoint_task = None
+        try:
+            await self.checkpoint("TRUNCATE")
+        except Exception as e:
+            logger.error(f"Ошибка checkpoint базы данных: {e}")
+        await self._run(self.conn.close)
+        self._executor.shutdown(wait=True)
+
+
+# ===== КЛУБЫ =====
+# Один процесс бота обслуживает несколько клубов. У каждого клуба своя база
+# SQLite (со своим соединением, потоком и кэшами) и свой администратор, а
+# реестр клубов и их сотрудников хранится в отдельной базе clubs.db.
+# ClubDispatcher определяет клуб отправителя для каждого обновления и
+# выполняет его в контексте этого клуба (contextvar current_club), поэтому
+# обработчики по-прежнему пишут db.fetchone(...) и попадают в базу своего
+# клуба. Базы открываются при первом обращении и закрываются, когда клуб
+# простаивает дольше CLUB_IDLE_TIMEOUT или открытых клубов больше
+# CLUBS_MAX_OPEN (вытесняется давно не использовавшийся).
+DEFAULT_CLUB = "main"  # клуб с исходной базой SoraClub.db и главным администратором
+CLUBS_DIR = DB_DIR / "clubs"
+CLUBS_DB_PATH = DB_DIR / "clubs.db"
+CLUBS_MAX_OPEN = int(os.getenv("CLUBS_MAX_OPEN", "32"))
+CLUB_IDLE_TIMEOUT = float(os.getenv("CLUB_IDLE_TIMEOUT", "600"))  # секунды
+CLUB_SWEEP_INTERVAL = 60  # секунды между проверками простаивающих клубов
+CLUB_SLUG_PATTERN = re.compile(r"^[a-z0-9_-]{2,32}$")  # допустимо в ссылке t.me/бот?start=код
+CLUBS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS clubs
+    (
+        slug       TEXT PRIMARY KEY,
+        name       TEXT    NOT NULL,
+        admin_id   INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS club_members
+    (
+        user_id INTEGER PRIMARY KEY,
+        slug    TEXT NOT NULL REFERENCES clubs (slug)
+    );
+
+    -- Запросы сотрудников на переход в другой клуб, ожидающие его администратора
+    CREATE TABLE IF NOT EXISTS club_transfers
+    (
+        user_id      INTEGER PRIMARY KEY,
+        slug         TEXT NOT NULL REFERENCES clubs (slug),
+        requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+'''
+UNKNOWN_CLUB_REPLY = (
+    "❌ Бот обслуживает несколько клубов.\n"
+    "Откройте ссылку-приглашение своего клуба или отправьте /start <код клуба>."
+)
+
+ClubInfo = namedtuple("ClubInfo", ["name", "admin_id"])
+current_club = ContextVar("current_club", default=None)
+
+
+def get_current_club():
+    club = current_club.get()
+    if club is None:
+        raise RuntimeError("Обращение к данным клуба вне контекста клуба")
+    return club
+
+
+def club_admin_id():
+    """Администратор клуба, в контексте которого выполняется код."""
+    return get_current_club().admin_id
+
+
+class Club:
+    def __init__(self, slug, info):
+        self.slug = slug
+        self.name = info.name
+        self.admin_id = info.admin_id
+        if slug == DEFAULT_CLUB:
+            self.path, self.archive_dir, self.export_dir = DB_PATH, ARCHIVE_DIR, EXPORT_DIR
+        else:
+            self.path = CLUBS_DIR / slug / "SoraClub.db"
+            self.archive_dir = CLUBS_DIR / slug / "archive"
+            self.export_dir = EXPORT_DIR / slug
+        self.db = None
+        self.permissions = {}  # кэш прав доступа, см. get_user_permissions
+        self.fsm_cache = OrderedDict()  # кэш SQLiteStorage
+        self.leases = 0  # сколько задач сейчас работают с клубом
+        self.last_used = time.monotonic()
+
+    def _open(self):
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self.export_dir.mkdir(parents=True, exist_ok=True)
+        database = Database(self.path)
+        try:
+            apply_migrations(database.conn)
+            with database.conn:
+                database.conn.execute(
+                    "INSERT OR IGNORE INTO users (user_id, username, first_name, is_admin, is_approved) "
+                    "VALUES (?, 'sora_admin', 'Sora Admin', 1, 1)",
+                    (self.admin_id,)
+                )
+        except Exception:
+            database.conn.close()
+            database._executor.shutdown()
+            raise
+        return database
+
+    async def open(self):
+        # Подключение и миграции - дисковые операции, цикл событий не ждёт их
+        self.db = await asyncio.to_thread(self._open)
+        self.db.start_checkpoints()
+
+    async def close(self):
+        await self.db.close()
+
+
+class ClubRegistry:
+    def __init__(self, path, max_open=CLUBS_MAX_OPEN, idle_timeout=CLUB_IDLE_TIMEOUT):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.open = OrderedDict()  # slug -> Club в порядке последнего использования
+        self.opened_count = 0
+        self.evicted_count = 0
+        self._members = {}  # user_id -> slug (None - пользователь не из клуба)
+        self._lock = asyncio.Lock()
+        self._closing = set()
+        self._task = None
+
+        self.db = Database(path)
+        conn = self.db.conn
+        with conn:
+            conn.executescript(CLUBS_SCHEMA)
+            created = conn.execute(
+                "INSERT OR IGNORE INTO clubs (slug, name, admin_id) VALUES (?, ?, ?)",
+                (DEFAULT_CLUB, "SoraClub", MAIN_ADMIN_ID)
+            ).rowcount
+        if created and DB_PATH.exists():
+            # Первый запуск с реестром: все, кто уже есть в исходной базе, - сотрудники основного клуба
+            conn.execute("ATTACH DATABASE ? AS club", (str(DB_PATH),))
+            try:
+                with conn:
+                    conn.execute("INSERT OR IGNORE INTO club_members SELECT user_id, ? FROM club.users",
+                                 (DEFAULT_CLUB,))
+            except sqlite3.OperationalError:
+                pass  # база ещё пустая
+            finally:
+                conn.execute("DETACH DATABASE club")
+        self.clubs = {slug: ClubInfo(name, admin_id)
+                      for slug, name, admin_id in conn.execute("SELECT slug, name, admin_id FROM clubs")}
+
+    async def add(self, slug, name, admin_id):
+        await self.db.execute("INSERT INTO clubs (slug, name, admin_id) VALUES (?, ?, ?)", (slug, name, admin_id))
+        self.clubs[slug] = ClubInfo(name, admin_id)
+        await self.set_member(admin_id, slug)
+
+    async def set_member(self, user_id, slug):
+        await self.db.execute("INSERT OR REPLACE INTO club_members (user_id, slug) VALUES (?, ?)", (user_id, slug))
+        self._members[user_id] = slug
+
+    def requested_club(self, text):
+        """Код клуба из /start <код>, если такой клуб есть."""
+        if text and text.startswith("/start "):
+            requested = text.split(maxsplit=1)[1].strip()
+            if requested in self.clubs:
+                return requested
+        return None
+
+    async def needs_transfer(self, user_id, slug):
+        # Новые пользователи и администратор клуба входят по ссылке сразу,
+        # сотрудник другого клуба - только с одобрения администратора нового
+        current = await self.get_member_club(user_id)
+        return current is not None and current != slug and self.clubs[slug].admin_id != user_id
+
+    async def request_transfer(self, user_id, slug):
+        await self.db.execute("INSERT OR REPLACE INTO club_transfers (user_id, slug) VALUES (?, ?)", (user_id, slug))
+
+    async def complete_transfer(self, user_id, slug):
+        """Переводит пользователя в клуб slug, если он об этом просил; возвращает, был ли запрос."""
+        cursor = await self.db.execute("DELETE FROM club_transfers WHERE user_id = ? AND slug = ?", (user_id, slug))
+        if not cursor.rowcount:
+            return False
+        await self.set_member(user_id, slug)
+        return True
+
+    async def get_member_club(self, user_id):
+        if user_id not in self._members:
+            row = await self.db.fetchone("SELECT slug FROM club_members WHERE user_id = ?", (user_id,))
+            self._members[user_id] = row[0] if row else None
+        return self._members[user_id]
+
+    async def resolve(self, user, text=None):
+        """Код клуба для обновления от user или None, если клуб определить нельзя."""
+        if user is None:
+            return DEFAULT_CLUB
+
+        # /start <код> - переход по ссылке-приглашению клуба (смену клуба проверяет needs_transfer)
+        requested = self.requested_club(text)
+        if requested and not await self.needs_transfer(user.id, requested):
+            if await self.get_member_club(user.id) != requested:
+                await self.set_member(user.id, requested)
+            return requested
+
+        slug = await self.get_member_club(user.id)
+        if slug is not None:
+            return slug
+
+        admin_of = [slug for slug, info in self.clubs.items() if info.admin_id == user.id]
+        if admin_of or len(self.clubs) == 1:
+            slug = admin_of[0] if admin_of else DEFAULT_CLUB
+            await self.set_member(user.id, slug)
+            return slug
+        return None
+
+    async def acquire(self, slug):
+        club = self.open.get(slug)
+        if club is None:
+            async with self._lock:
+                club = self.open.get(slug)
+                if club is None:
+                    club = Club(slug, self.clubs[slug])
+                    await club.open()
+                    self.open[slug] = club
+                    self.opened_count += 1
+                    stock_alerts.wake(slug)  # уведомления, оставшиеся с прошлого открытия
+        club.leases += 1
+        self.open.move_to_end(slug)
+        excess = len(self.open) - self.max_open
+        if excess > 0:
+            # Закрываются только клубы, с которыми сейчас никто не работает
+            self._evict([slug for slug, club in self.open.items() if not club.leases][:excess])
+        return club
+
+    def release(self, club):
+        club.leases -= 1
+        club.last_used = time.monotonic()
+
+    @asynccontextmanager
+    async def use(self, slug):
+        """Выполняет блок в контексте клуба slug, открывая его базу при необходимости."""
+        club = await self.acquire(slug)
+        token = current_club.set(club)
+        try:
+            yield club
+        finally:
+            current_club.reset(token)
+            self.release(club)
+
+    async def each_open(self, func, description):
+        """Вызывает func() в контексте каждого открытого клуба (для фоновых задач)."""
+        for slug in list(self.open):
+            try:
+                async with self.use(slug):
+                    await func()
+            except Exception as e:
+                logger.error(f"Ошибка {description} клуба {slug}: {e}")
+
+    def _evict(self, slugs):
+        for slug in slugs:
+            club = self.open.pop(slug)
+            self.evicted_count += 1
+            task = asyncio.create_task(club.close())
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    def start(self):
+        if self._task is None and self.idle_timeout > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(CLUB_SWEEP_INTERVAL)
+            deadline = time.monotonic() - self.idle_timeout
+            self._evict([slug for slug, club in self.open.items() if not club.leases and club.last_used < deadline])
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for slug, club in list(self.open.items()):
+            del self.open[slug]
+            await club.close()
+        if self._closing:
+            await asyncio.wait(self._closing)
+        await self.db.close()
+
+
+class ClubDatabase:
+    """Database клуба из текущего контекста: db.fetchone(...) и т.п. уходят в его базу."""
+
+    def __getattr__(self, name):
+        return getattr(get_current_club().db, name)
+
+
+class ClubDispatcher(Dispatcher):
+    """Dispatcher, выполняющий каждое обновление в контексте клуба отправителя."""
+
+    async def feed_update(self, bot: Bot, update: types.Update, **kwargs):
+        chat, user = UserContextMiddleware.resolve_event_context(update)
+        text = update.message.text if update.message else None
+        requested = clubs.requested_club(text)
+        if user is not None and requested and await clubs.needs_transfer(user.id, requested):
+            await request_club_transfer(bot, user, requested)
+            return UNHANDLED
+        slug = await clubs.resolve(user, text)
+        if slug is None:
+            if chat is not None and chat.type == "private":
+                await bot.send_message(chat.id, UNKNOWN_CLUB_REPLY)
+            return UNHANDLED
+        async with clubs.use(slug):
+            return await super().feed_update(bot, update, **kwargs)
+
+
+# ID главного администратора: владелец бота и администратор основного клуба
 MAIN_ADMIN_ID = 7873867301
 
+clubs = ClubRegistry(CLUBS_DB_PATH)
+db = ClubDatabase()
+
+# ===== МИГРАЦИИ СХЕМЫ =====
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция применяется
+# один раз в отдельной транзакции; новые изменения схемы добавляются
+# в конец списка, уже выпущенные миграции не редактируются.
+MIGRATIONS = [
+    # 1. Исходные таблицы
+    '''
+    CREATE TABLE IF NOT EXISTS products
+    (
+        id         INTEGER PRIMARY KEY AUTOINCREMENT,
+        name       TEXT NOT NULL,
+        quantity   INTEGER DEFAULT 1,
+        category   TEXT,
+        added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS users
+    (
+        user_id     INTEGER PRIMARY KEY,
+        username    TEXT,
+        first_name  TEXT,
+        is_admin    BOOLEAN DEFAULT 0,
+        is_banned   BOOLEAN DEFAULT 0,
+        is_approved BOOLEAN DEFAULT 0,
+        added_date  TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_action TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS action_logs
+    (
+        id        INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id   INTEGER,
+        action    TEXT,
+        details   TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS shift_reports
+    (
+        id           INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id      INTEGER NOT NULL,
+        report_date  DATE    NOT NULL,
+        total        REAL    NOT NULL,
+        cash         REAL    NOT NULL,
+        card         REAL    NOT NULL,
+        bar          REAL    NOT NULL,
+        hookah_count INTEGER NOT NULL,
+        expenses     REAL    NOT NULL,
+        initial_cash REAL DEFAULT 4000,
+        balance      REAL    NOT NULL,
+        timestamp    TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS notification_settings
+    (
+        id                INTEGER PRIMARY KEY AUTOINCREMENT,
+        notification_type TEXT NOT NULL UNIQUE,
+        chat_id           TEXT NOT NULL
+    );
+    ''',
+
+    # 2. Полнотекстовый индекс товаров. Хранит название и категорию с заменой
+    # "ё" на "е" и синхронизируется триггерами, поэтому поиск не
+    # просматривает всю таблицу products.
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, category, tokenize = 'unicode61 remove_diacritics 2'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts (rowid, name, category)
+        VALUES (new.id,
+                replace(replace(new.name, 'ё', 'е'), 'Ё', 'Е'),
+                replace(replace(new.category, 'ё', 'е'), 'Ё', 'Е'));
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        DELETE FROM products_fts WHERE rowid = old.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, category ON products BEGIN
+        UPDATE products_fts
+        SET name = replace(replace(new.name, 'ё', 'е'), 'Ё', 'Е'),
+            category = replace(replace(new.category, 'ё', 'е'), 'Ё', 'Е')
+        WHERE rowid = new.id;
+    END;
+
+    DELETE FROM products_fts;
+    INSERT INTO products_fts (rowid, name, category)
+    SELECT id,
+           replace(replace(name, 'ё', 'е'), 'Ё', 'Е'),
+           replace(replace(category, 'ё', 'е'), 'Ё', 'Е')
+    FROM products;
+    ''',
+
+    # 3. Индексы под частые запросы и один отчёт на сотрудника в день.
+    # Более ранние отчёты за тот же день не удаляются, а переносятся в
+    # shift_reports_duplicates (см. report_moved_shift_reports)
+    '''
+    CREATE TABLE IF NOT EXISTS shift_reports_duplicates AS
+    SELECT *, CURRENT_TIMESTAMP AS moved_at
+    FROM shift_reports
+    WHERE id NOT IN (SELECT MAX(id) FROM shift_reports GROUP BY user_id, report_date);
+    DELETE FROM shift_reports WHERE id IN (SELECT id FROM shift_reports_duplicates);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_shift_reports_user_date ON shift_reports (user_id, report_date);
+
+    CREATE INDEX IF NOT EXISTS idx_products_quantity ON products (quantity);
+    CREATE INDEX IF NOT EXISTS idx_users_approval ON users (is_approved, is_banned, added_date);
+    CREATE INDEX IF NOT EXISTS idx_action_logs_timestamp ON action_logs (timestamp);
+    ''',
+
+    # 4. Счётчики версий данных: меняются при любом изменении таблицы и
+    # служат ключом кэша готовых выгрузок
+    '''
+    CREATE TABLE IF NOT EXISTS data_versions
+    (
+        name    TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    );
+    INSERT OR IGNORE INTO data_versions (name) VALUES ('products'), ('shift_reports');
+
+    CREATE TRIGGER IF NOT EXISTS products_version_insert AFTER INSERT ON products BEGIN
+        UPDATE data_versions SET version = version + 1 WHERE name = 'products';
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_version_update AFTER UPDATE ON products BEGIN
+        UPDATE data_versions SET version = version + 1 WHERE name = 'products';
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_version_delete AFTER DELETE ON products BEGIN
+        UPDATE data_versions SET version = version + 1 WHERE name = 'products';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS shift_reports_version_insert AFTER INSERT ON shift_reports BEGIN
+        UPDATE data_versions SET version = version + 1 WHERE name = 'shift_reports';
+    END;
+    CREATE TRIGGER IF NOT EXISTS shift_reports_version_update AFTER UPDATE ON shift_reports BEGIN
+        UPDATE data_versions SET version = version + 1 WHERE name = 'shift_reports';
+    END;
+    CREATE TRIGGER IF NOT EXISTS shift_reports_version_delete AFTER DELETE ON shift_reports BEGIN
+        UPDATE data_versions SET version = version + 1 WHERE name = 'shift_reports';
+    END;
+    ''',
+
+    # 5. Состояния диалогов (FSM): переживают перезапуск бота
+    '''
+    CREATE TABLE IF NOT EXISTS fsm_states
+    (
+        chat_id    INTEGER NOT NULL,
+        user_id    INTEGER NOT NULL,
+        destiny    TEXT    NOT NULL,
+        state      TEXT,
+        data       TEXT    NOT NULL DEFAULT '{}',
+        updated_at REAL    NOT NULL,
+        PRIMARY KEY (chat_id, user_id, destiny)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at);
+    ''',
+
+    # 6. Материализованные счётчики статистики, поддерживаемые триггерами
+    '''
+    CREATE TABLE IF NOT EXISTS stats_counters
+    (
+        name  TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID;
+
+    INSERT OR REPLACE INTO stats_counters (name, value)
+    SELECT 'users_total', COUNT(*) FROM users
+    UNION ALL SELECT 'users_admin', COUNT(*) FROM users WHERE is_admin = 1
+    UNION ALL SELECT 'users_banned', COUNT(*) FROM users WHERE is_banned = 1
+    UNION ALL SELECT 'users_approved', COUNT(*) FROM users WHERE is_approved = 1
+    UNION ALL SELECT 'users_pending', COUNT(*) FROM users WHERE is_approved = 0 AND is_banned = 0
+    UNION ALL SELECT 'products_total', COUNT(*) FROM products
+    UNION ALL SELECT 'products_low_stock', COUNT(*) FROM products WHERE quantity < 10
+    UNION ALL SELECT 'shift_reports_total', COUNT(*) FROM shift_reports
+    UNION ALL SELECT 'action_logs_total', COUNT(*) FROM action_logs;
+
+    CREATE TRIGGER IF NOT EXISTS users_stats_insert AFTER INSERT ON users BEGIN
+        UPDATE stats_counters SET value = value + CASE name
+            WHEN 'users_total' THEN 1
+            WHEN 'users_admin' THEN IFNULL(NEW.is_admin = 1, 0)
+            WHEN 'users_banned' THEN IFNULL(NEW.is_banned = 1, 0)
+            WHEN 'users_approved' THEN IFNULL(NEW.is_approved = 1, 0)
+            WHEN 'users_pending' THEN IFNULL(NEW.is_approved = 0 AND NEW.is_banned = 0, 0)
+        END
+        WHERE name IN ('users_total', 'users_admin', 'users_banned', 'users_approved', 'users_pending');
+    END;
+    CREATE TRIGGER IF NOT EXISTS users_stats_update AFTER UPDATE OF is_admin, is_banned, is_approved ON users BEGIN
+        UPDATE stats_counters SET value = value + CASE name
+            WHEN 'users_admin' THEN IFNULL(NEW.is_admin = 1, 0) - IFNULL(OLD.is_admin = 1, 0)
+            WHEN 'users_banned' THEN IFNULL(NEW.is_banned = 1, 0) - IFNULL(OLD.is_banned = 1, 0)
+            WHEN 'users_approved' THEN IFNULL(NEW.is_approved = 1, 0) - IFNULL(OLD.is_approved = 1, 0)
+            WHEN 'users_pending' THEN IFNULL(NEW.is_approved = 0 AND NEW.is_banned = 0, 0)
+                                    - IFNULL(OLD.is_approved = 0 AND OLD.is_banned = 0, 0)
+        END
+        WHERE name IN ('users_admin', 'users_banned', 'users_approved', 'users_pending');
+    END;
+    CREATE TRIGGER IF NOT EXISTS users_stats_delete AFTER DELETE ON users BEGIN
+        UPDATE stats_counters SET value = value - CASE name
+            WHEN 'users_total' THEN 1
+            WHEN 'users_admin' THEN IFNULL(OLD.is_admin = 1, 0)
+            WHEN 'users_banned' THEN IFNULL(OLD.is_banned = 1, 0)
+            WHEN 'users_approved' THEN IFNULL(OLD.is_approved = 1, 0)
+            WHEN 'users_pending' THEN IFNULL(OLD.is_approved = 0 AND OLD.is_banned = 0, 0)
+        END
+        WHERE name IN ('users_total', 'users_admin', 'users_banned', 'users_approved', 'users_pending');
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS products_stats_insert AFTER INSERT ON products BEGIN
+        UPDATE stats_counters SET value = value + CASE name
+            WHEN 'products_total' THEN 1
+            WHEN 'products_low_stock' THEN IFNULL(NEW.quantity < 10, 0)
+        END
+        WHERE name IN ('products_total', 'products_low_stock');
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_stats_update AFTER UPDATE OF quantity ON products BEGIN
+        UPDATE stats_counters SET value = value + IFNULL(NEW.quantity < 10, 0) - IFNULL(OLD.quantity < 10, 0)
+        WHERE name = 'products_low_stock';
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_stats_delete AFTER DELETE ON products BEGIN
+        UPDATE stats_counters SET value = value - CASE name
+            WHEN 'products_total' THEN 1
+            WHEN 'products_low_stock' THEN IFNULL(OLD.quantity < 10, 0)
+        END
+        WHERE name IN ('products_total', 'products_low_stock');
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS shift_reports_stats_insert AFTER INSERT ON shift_reports BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'shift_reports_total';
+    END;
+    CREATE TRIGGER IF NOT EXISTS shift_reports_stats_delete AFTER DELETE ON shift_reports BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'shift_reports_total';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS action_logs_stats_insert AFTER INSERT ON action_logs BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'action_logs_total';
+    END;
+    CREATE TRIGGER IF NOT EXISTS action_logs_stats_delete AFTER DELETE ON action_logs BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'action_logs_total';
+    END;
+    ''',
+
+    # 7. Индексы для фильтров журнала действий по пользователю и типу действия
+    '''
+    CREATE INDEX IF NOT EXISTS idx_action_logs_user_time ON action_logs (user_id, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_action_logs_action_time ON action_logs (action, timestamp);
+    ''',
+
+    # 8. Сводки отчётов по сменам за день, неделю (с понедельника) и месяц
+    # для каждого сотрудника; поддерживаются триггерами при сохранении отчёта
+    '''
+    CREATE TABLE IF NOT EXISTS report_rollups
+    (
+        period       TEXT    NOT NULL,
+        period_start DATE    NOT NULL,
+        user_id      INTEGER NOT NULL,
+        reports      INTEGER NOT NULL,
+        total        REAL    NOT NULL,
+        cash         REAL    NOT NULL,
+        card         REAL    NOT NULL,
+        bar          REAL    NOT NULL,
+        hookah_count INTEGER NOT NULL,
+        expenses     REAL    NOT NULL,
+        net_profit   REAL    NOT NULL,
+        PRIMARY KEY (period, period_start, user_id)
+    ) WITHOUT ROWID;
+
+    INSERT INTO report_rollups
+        (period, period_start, user_id, reports, total, cash, card, bar, hookah_count, expenses, net_profit)
+    SELECT 'day', report_date, user_id, COUNT(*), SUM(total), SUM(cash), SUM(card), SUM(bar),
+           SUM(hookah_count), SUM(expenses), SUM(total - expenses)
+    FROM shift_reports
+    GROUP BY 2, user_id;
+
+    INSERT INTO report_rollups
+        (period, period_start, user_id, reports, total, cash, card, bar, hookah_count, expenses, net_profit)
+    SELECT 'week', date(report_date, 'weekday 0', '-6 days'), user_id, COUNT(*), SUM(total), SUM(cash), SUM(card), SUM(bar),
+           SUM(hookah_count), SUM(expenses), SUM(total - expenses)
+    FROM shift_reports
+    GROUP BY 2, user_id;
+
+    INSERT INTO report_rollups
+        (period, period_start, user_id, reports, total, cash, card, bar, hookah_count, expenses, net_profit)
+    SELECT 'month', date(report_date, 'start of month'), user_id, COUNT(*), SUM(total), SUM(cash), SUM(card), SUM(bar),
+           SUM(hookah_count), SUM(expenses), SUM(total - expenses)
+    FROM shift_reports
+    GROUP BY 2, user_id;
+
+    CREATE TRIGGER IF NOT EXISTS shift_reports_rollup_insert AFTER INSERT ON shift_reports BEGIN
+        INSERT INTO report_rollups
+            (period, period_start, user_id, reports, total, cash, card, bar, hookah_count, expenses, net_profit)
+        SELECT period_name, start_date, NEW.user_id, 1, NEW.total, NEW.cash, NEW.card, NEW.bar,
+               NEW.hookah_count, NEW.expenses, (NEW.total - NEW.expenses)
+        FROM (SELECT 'day' AS period_name, NEW.report_date AS start_date
+              UNION ALL SELECT 'week', date(NEW.report_date, 'weekday 0', '-6 days')
+              UNION ALL SELECT 'month', date(NEW.report_date, 'start of month'))
+        WHERE true
+        ON CONFLICT (period, period_start, user_id) DO UPDATE SET
+            reports      = reports + excluded.reports,
+            total        = total + excluded.total,
+            cash         = cash + excluded.cash,
+            card         = card + excluded.card,
+            bar          = bar + excluded.bar,
+            hookah_count = hookah_count + excluded.hookah_count,
+            expenses     = expenses + excluded.expenses,
+            net_profit   = net_profit + excluded.net_profit;
+    END;
+    CREATE TRIGGER IF NOT EXISTS shift_reports_rollup_update AFTER UPDATE ON shift_reports BEGIN
+        INSERT INTO report_rollups
+            (period, period_start, user_id, reports, total, cash, card, bar, hookah_count, expenses, net_profit)
+        SELECT period_name, start_date, OLD.user_id, -1, -OLD.total, -OLD.cash, -OLD.card, -OLD.bar,
+               -OLD.hookah_count, -OLD.expenses, -(OLD.total - OLD.expenses)
+        FROM (SELECT 'day' AS period_name, OLD.report_date AS start_date
+              UNION ALL SELECT 'week', date(OLD.report_date, 'weekday 0', '-6 days')
+              UNION ALL SELECT 'month', date(OLD.report_date, 'start of month'))
+        WHERE true
+        ON CONFLICT (period, period_start, user_id) DO UPDATE SET
+            reports      = reports + excluded.reports,
+            total        = total + excluded.total,
+            cash         = cash + excluded.cash,
+            card         = card + excluded.card,
+            bar          = bar + excluded.bar,
+            hookah_count = hookah_count + excluded.hookah_count,
+            expenses     = expenses + excluded.expenses,
+            net_profit   = net_profit + excluded.net_profit;
+        INSERT INTO report_rollups
+            (period, period_start, user_id, reports, total, cash, card, bar, hookah_count, expenses, net_profit)
+        SELECT period_name, start_date, NEW.user_id, 1, NEW.total, NEW.cash, NEW.card, NEW.bar,
+               NEW.hookah_count, NEW.expenses, (NEW.total - NEW.expenses)
+        FROM (SELECT 'day' AS period_name, NEW.report_date AS start_date
+              UNION ALL SELECT 'week', date(NEW.report_date, 'weekday 0', '-6 days')
+              UNION ALL SELECT 'month', date(NEW.report_date, 'start of month'))
+        WHERE true
+        ON CONFLICT (period, period_start, user_id) DO UPDATE SET
+            reports      = reports + excluded.reports,
+            total        = total + excluded.total,
+            cash         = cash + excluded.cash,
+            card         = card + excluded.card,
+            bar          = bar + excluded.bar,
+            hookah_count = hookah_count + excluded.hookah_count,
+            expenses     = expenses + excluded.expenses,
+            net_profit   = net_profit + excluded.net_profit;
+        DELETE FROM report_rollups WHERE reports <= 0 AND user_id = OLD.user_id AND period_start IN
+            (OLD.report_date, date(OLD.report_date, 'weekday 0', '-6 days'), date(OLD.report_date, 'start of month'));
+    END;
+    CREATE TRIGGER IF NOT EXISTS shift_reports_rollup_delete AFTER DELETE ON shift_reports BEGIN
+        INSERT INTO report_rollups
+            (period, period_start, user_id, reports, total, cash, card, bar, hookah_count, expenses, net_profit)
+        SELECT period_name, start_date, OLD.user_id, -1, -OLD.total, -OLD.cash, -OLD.card, -OLD.bar,
+               -OLD.hookah_count, -OLD.expenses, -(OLD.total - OLD.expenses)
+        FROM (SELECT 'day' AS period_name, OLD.report_date AS start_date
+              UNION ALL SELECT 'week', date(OLD.report_date, 'weekday 0', '-6 days')
+              UNION ALL SELECT 'month', date(OLD.report_date, 'start of month'))
+        WHERE true
+        ON CONFLICT (period, period_start, user_id) DO UPDATE SET
+            reports      = reports + excluded.reports,
+            total        = total + excluded.total,
+            cash         = cash + excluded.cash,
+            card         = card + excluded.card,
+            bar          = bar + excluded.bar,
+            hookah_count = hookah_count + excluded.hookah_count,
+            expenses     = expenses + excluded.expenses,
+            net_profit   = net_profit + excluded.net_profit;
+        DELETE FROM report_rollups WHERE reports <= 0 AND user_id = OLD.user_id AND period_start IN
+            (OLD.report_date, date(OLD.report_date, 'weekday 0', '-6 days'), date(OLD.report_date, 'start of month'));
+    END;
+    ''',
+
+    # 9. Журнал движения товаров. Каждая строка хранит остаток после движения,
+    # поэтому остаток на дату - одна строка по индексу, без пересчёта журнала.
+    # Текущие остатки переносятся в журнал начальной корректировкой.
+    '''
+    CREATE TABLE IF NOT EXISTS stock_movements
+    (
+        id             INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id     INTEGER NOT NULL,
+        kind           TEXT    NOT NULL,
+        delta          INTEGER NOT NULL,
+        quantity_after INTEGER NOT NULL,
+        user_id        INTEGER,
+        comment        TEXT,
+        created_at     TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_stock_movements_product_time ON stock_movements (product_id, created_at, id);
+
+    INSERT INTO stock_movements (product_id, kind, delta, quantity_after, comment, created_at)
+    SELECT id, 'correction', quantity, quantity, 'Начальный остаток', COALESCE(added_date, CURRENT_TIMESTAMP)
+    FROM products;
+    ''',
+
+    # 10. Пороги заказа. reorder_threshold - действующий порог товара: свой
+    # (threshold_custom = 1), порог категории из category_thresholds или 10.
+    # Частичный индекс содержит только товары ниже порога. Переход товара
+    # ниже порога при любой записи ставит уведомление в очередь stock_alerts.
+    '''
+    ALTER TABLE products ADD COLUMN reorder_threshold INTEGER NOT NULL DEFAULT 10;
+    ALTER TABLE products ADD COLUMN threshold_custom BOOLEAN NOT NULL DEFAULT 0;
+
+    CREATE TABLE IF NOT EXISTS category_thresholds
+    (
+        category  TEXT PRIMARY KEY,
+        threshold INTEGER NOT NULL
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_products_low_stock ON products (quantity, id) WHERE quantity < reorder_threshold;
+
+    CREATE TABLE IF NOT EXISTS stock_alerts
+    (
+        id         INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL,
+        quantity   INTEGER NOT NULL,
+        threshold  INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        sent_at    TIMESTAMP
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_stock_alerts_pending ON stock_alerts (id) WHERE sent_at IS NULL;
+
+    CREATE TRIGGER IF NOT EXISTS products_threshold_category AFTER UPDATE OF category ON products
+        WHEN NEW.threshold_custom = 0 BEGIN
+        UPDATE products
+        SET reorder_threshold = COALESCE((SELECT threshold FROM category_thresholds WHERE category = NEW.category), 10)
+        WHERE id = NEW.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS category_thresholds_insert AFTER INSERT ON category_thresholds BEGIN
+        UPDATE products SET reorder_threshold = NEW.threshold WHERE category = NEW.category AND threshold_custom = 0;
+    END;
+    CREATE TRIGGER IF NOT EXISTS category_thresholds_update AFTER UPDATE ON category_thresholds BEGIN
+        UPDATE products SET reorder_threshold = NEW.threshold WHERE category = NEW.category AND threshold_custom = 0;
+    END;
+    CREATE TRIGGER IF NOT EXISTS category_thresholds_delete AFTER DELETE ON category_thresholds BEGIN
+        UPDATE products SET reorder_threshold = 10 WHERE category = OLD.category AND threshold_custom = 0;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS products_low_stock_alert_insert AFTER INSERT ON products
+        WHEN NEW.quantity < NEW.reorder_threshold BEGIN
+        INSERT INTO stock_alerts (product_id, quantity, threshold) VALUES (NEW.id, NEW.quantity, NEW.reorder_threshold);
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_low_stock_alert_update AFTER UPDATE OF quantity, reorder_threshold ON products
+        WHEN NEW.quantity < NEW.reorder_threshold AND OLD.quantity >= OLD.reorder_threshold BEGIN
+        INSERT INTO stock_alerts (product_id, quantity, threshold) VALUES (NEW.id, NEW.quantity, NEW.reorder_threshold);
+    END;
+
+    DROP TRIGGER IF EXISTS products_stats_insert;
+    DROP TRIGGER IF EXISTS products_stats_update;
+    DROP TRIGGER IF EXISTS products_stats_delete;
+    CREATE TRIGGER IF NOT EXISTS products_stats_insert AFTER INSERT ON products BEGIN
+        UPDATE stats_counters SET value = value + CASE name
+            WHEN 'products_total' THEN 1
+            WHEN 'products_low_stock' THEN IFNULL(NEW.quantity < NEW.reorder_threshold, 0)
+        END
+        WHERE name IN ('products_total', 'products_low_stock');
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_stats_update AFTER UPDATE OF quantity, reorder_threshold ON products BEGIN
+        UPDATE stats_counters
+        SET value = value + IFNULL(NEW.quantity < NEW.reorder_threshold, 0)
+                          - IFNULL(OLD.quantity < OLD.reorder_threshold, 0)
+        WHERE name = 'products_low_stock';
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_stats_delete AFTER DELETE ON products BEGIN
+        UPDATE stats_counters SET value = value - CASE name
+            WHEN 'products_total' THEN 1
+            WHEN 'products_low_stock' THEN IFNULL(OLD.quantity < OLD.reorder_threshold, 0)
+        END
+        WHERE name IN ('products_total', 'products_low_stock');
+    END;
+    UPDATE stats_counters SET value = (SELECT COUNT(*) FROM products WHERE quantity < reorder_threshold)
+    WHERE name = 'products_low_stock';
+    ''',
+]
+
+
+def report_moved_shift_reports(conn):
+    pairs = conn.execute(
+        "SELECT user_id, report_date, COUNT(*) FROM shift_reports_duplicates GROUP BY user_id, report_date"
+    ).fetchall()
+    if pairs:
+        listed = ", ".join(f"{user_id} за {report_date} ({count} шт.)" for user_id, report_date, count in pairs)
+        logger.warning(f"Повторные отчёты по смене перенесены в таблицу shift_reports_duplicates: {listed}")
+
+
+# Что сообщить в лог после применения миграции: номер -> функция(conn)
+MIGRATION_REPORTS = {
+    3: report_moved_shift_reports,
+}
+
+
+def apply_migrations(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, script in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        try:
+            conn.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;")
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            logger.error(f"Ошибка применения миграции базы данных №{number}")
+            raise
+        logger.info(f"Применена миграция базы данных №{number}")
+        if number in MIGRATION_REPORTS:
+            MIGRATION_REPORTS[number](conn)
+
+
+
+# ===== ХРАНИЛИЩЕ СОСТОЯНИЙ ДИАЛОГОВ =====
+# Состояние и данные незавершённых диалогов пишутся в таблицу fsm_states,
+# поэтому наполовину введённый отчёт переживает перезапуск бота. В памяти
+# держится ограниченный LRU-кэш последних пользователей, а брошенные
+# диалоги удаляются по истечении FSM_STATE_TTL.
+FSM_CACHE_SIZE = 1000
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", str(24 * 60 * 60)))  # секунды
+FSM_CLEANUP_INTERVAL = 60 * 60  # секунды
+
+FSMRecord = namedtuple("FSMRecord", ["state", "data", "updated_at"])
+EMPTY_FSM_RECORD = FSMRecord(None, "{}", 0.0)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх таблицы fsm_states.
+
+    Запись сквозная: каждое изменение сразу уходит в базу, а кэш лишь
+    избавляет от чтения при каждом входящем сообщении. Данные хранятся
+    в виде JSON-строки, чтобы обработчики не могли изменить кэш по ссылке.
+    """
+
+    def __init__(self, database, cache_size=FSM_CACHE_SIZE, ttl=FSM_STATE_TTL):
+        self.db = database
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self._cleanup_task = None
+
+    @property
+    def _cache(self):
+        # Кэш у каждого клуба свой, как и таблица fsm_states
+        return get_current_club().fsm_cache
+
+    @staticmethod
+    def _key(key: StorageKey):
+        return key.chat_id, key.user_id, key.destiny
+
+    def _expired(self, record):
+        return self.ttl > 0 and record.updated_at < time.time() - self.ttl
+
+    def _remember(self, key, record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key):
+        record = self._cache.get(key)
+        if record is None:
+            row = await self.db.fetchone(
+                "SELECT state, data, updated_at FROM fsm_states "
+                "WHERE chat_id = ? AND user_id = ? AND destiny = ?",
+                key
+            )
+            record = FSMRecord(*row) if row else EMPTY_FSM_RECORD
+        else:
+            self._cache.move_to_end(key)
+
+        if record is not EMPTY_FSM_RECORD and self._expired(record):
+            await self._store(key, EMPTY_FSM_RECORD)
+            return EMPTY_FSM_RECORD
+
+        self._remember(key, record)
+        return record
+
+    async def _store(self, key, record):
+        if record.state is None and record.data == "{}":
+            await self.db.execute(
+                "DELETE FROM fsm_states WHERE chat_id = ? AND user_id = ? AND destiny = ?",
+                key
+            )
+            record = EMPTY_FSM_RECORD
+        else:
+            await self.db.execute(
+                "INSERT OR REPLACE INTO fsm_states (chat_id, user_id, destiny, state, data, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, record.state, record.data, record.updated_at)
+            )
+        self._remember(key, record)
+
+    async def _update(self, key, state, data):
+        current = await self._load(key)
+        if current.state == state and current.data == data:
+            # Без изменений пишем только для продления TTL, когда прошла половина срока
+            if current is EMPTY_FSM_RECORD or current.updated_at > time.time() - self.ttl / 2:
+                return
+        await self._store(key, FSMRecord(state, data, time.time()))
+
+    async def set_state(self, bot: Bot, key: StorageKey, state=None) -> None:
+        key = self._key(key)
+        if isinstance(state, State):
+            state = state.state
+        current = await self._load(key)
+        await self._update(key, state, current.data)
+
+    async def get_state(self, bot: Bot, key: StorageKey):
+        return (await self._load(self._key(key))).state
+
+    async def set_data(self, bot: Bot, key: StorageKey, data) -> None:
+        key = self._key(key)
+        current = await self._load(key)
+        await self._update(key, current.state, json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, bot: Bot, key: StorageKey):
+        return json.loads((await self._load(self._key(key))).data)
+
+    def start_cleanup(self, interval=FSM_CLEANUP_INTERVAL):
+        if self._cleanup_task is None and self.ttl > 0:
+            self._cleanup_task = asyncio.create_task(self._run_cleanup(interval))
+
+    async def _run_cleanup(self, interval):
+        while True:
+            await clubs.each_open(self.cleanup, "очистки состояний диалогов")
+            await asyncio.sleep(interval)
+
+    async def cleanup(self):
+        """Удаляет диалоги, брошенные дольше FSM_STATE_TTL."""
+        deadline = time.time() - self.ttl
+        cursor = await self.db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (deadline,))
+        for key in [k for k, record in self._cache.items() if record.updated_at and record.updated_at < deadline]:
+            del self._cache[key]
+        if cursor.rowcount:
+            logger.info(f"Удалено брошенных диалогов: {cursor.rowcount}")
+        return cursor.rowcount
+
+    async def close(self) -> None:
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+
+
+fsm_storage = SQLiteStorage(db)
+dp = ClubDispatcher(storage=fsm_storage)
+
+
+# ===== МЕТРИКИ ОБРАБОТЧИКОВ =====
+# HandlerMetricsMiddleware замеряет каждый обработчик сообщений и кнопок:
+# время выполнения, число SQL-запросов и время в базе (Database._run пишет
+# их в трассировку текущего обработчика через contextvar) и вызовы Bot API.
+# Итоги копятся в гистограммах с начала работы (для Prometheus) и в окне
+# последних METRICS_WINDOW вызовов (перцентили для команды /metrics).
+SLOW_HANDLER_MS = float(os.getenv("SLOW_HANDLER_MS", "500"))  # 0 - не логировать медленные
+METRICS_WINDOW = 1000  # последних вызовов на обработчик для перцентилей
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # секунды
+
+handler_trace = ContextVar("handler_trace", default=None)
+
+
+class HandlerTrace:
+    """Запросы к базе и вызовы Bot API одного вызова обработчика."""
+
+    def __init__(self):
+        self.queries = []  # (запрос, секунды, число выражений)
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.api_calls = 0
+
+    def add_query(self, label, duration, statements):
+        self.queries.append((label, duration, statements))
+        self.sql_count += statements
+        self.sql_time += duration
+
+
+class HandlerStats:
+    def __init__(self):
+        self.bucket_counts = [0] * len(METRICS_BUCKETS)
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.api_calls = 0
+        self.recent = deque(maxlen=METRICS_WINDOW)  # (секунды, запросы, секунды в SQL)
+
+    def observe(self, duration, trace, failed):
+        self.count += 1
+        self.errors += failed
+        self.total_time += duration
+        self.sql_count += trace.sql_count
+        self.sql_time += trace.sql_time
+        self.api_calls += trace.api_calls
+        for index, bound in enumerate(METRICS_BUCKETS):
+            if duration <= bound:
+                self.bucket_counts[index] += 1
+        self.recent.append((duration, trace.sql_count, trace.sql_time))
+
+
+class HandlerMetrics:
+    def __init__(self, slow_threshold_ms=SLOW_HANDLER_MS):
+        self.slow_threshold = slow_threshold_ms / 1000
+        self.handlers = {}
+        self.api_calls = Counter()
+        self.started_at = time.time()
+
+    def observe(self, name, duration, trace, failed):
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = HandlerStats()
+        stats.observe(duration, trace, failed)
+
+        if self.slow_threshold and duration >= self.slow_threshold:
+            queries = "\n".join(f"  {seconds * 1000:.1f} мс, выражений: {count} - {label[:120]}"
+                                 for label, seconds, count in trace.queries)
+            logger.warning(
+                f"Медленный обработчик {name}: {duration * 1000:.0f} мс, "
+                f"SQL: {trace.sql_count} за {trace.sql_time * 1000:.0f} мс, "
+                f"вызовов API: {trace.api_calls}" + (f"\n{queries}" if queries else "")
+            )
+
+    def summary(self, limit=15):
+        """Строки для /metrics: самые медленные обработчики по p95 за окно."""
+        rows = []
+        for name, stats in self.handlers.items():
+            durations = sorted(sample[0] for sample in stats.recent)
+            p50 = durations[len(durations) // 2]
+            p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+            window_sql = sum(sample[1] for sample in stats.recent) / len(stats.recent)
+            window_sql_time = sum(sample[2] for sample in stats.recent) / len(stats.recent)
+            rows.append((p95, name, stats, p50, window_sql, window_sql_time))
+        rows.sort(key=lambda row: row[0], reverse=True)
+        return rows[:limit]
+
+    def render_prometheus(self):
+        lines = [
+            "# HELP sora_handler_duration_seconds Время выполнения обработчика",
+            "# TYPE sora_handler_duration_seconds histogram",
+        ]
+        for name, stats in sorted(self.handlers.items()):
+            for bound, count in zip(METRICS_BUCKETS, stats.bucket_counts):
+                lines.append(f'sora_handler_duration_seconds_bucket{{handler="{name}",le="{bound}"}} {count}')
+            lines.append(f'sora_handler_duration_seconds_bucket{{handler="{name}",le="+Inf"}} {stats.count}')
+            lines.append(f'sora_handler_duration_seconds_sum{{handler="{name}"}} {stats.total_time:.6f}')
+            lines.append(f'sora_handler_duration_seconds_count{{handler="{name}"}} {stats.count}')
+
+        counters = [
+            ("sora_handler_errors_total", "Обработчик завершился исключением", "errors", "{}"),
+            ("sora_handler_sql_queries_total", "SQL-выражений, выполненных обработчиком", "sql_count", "{}"),
+            ("sora_handler_sql_seconds_total", "Время обработчика в базе данных", "sql_time", "{:.6f}"),
+            ("sora_handler_api_calls_total", "Вызовов Bot API из обработчика", "api_calls", "{}"),
+        ]
+        for metric, description, attribute, value_format in counters:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, stats in sorted(self.handlers.items()):
+                value = value_format.format(getattr(stats, attribute))
+                lines.append(f'{metric}{{handler="{name}"}} {value}')
+
+        lines.append("# HELP sora_api_calls_total Вызовов Bot API по методам")
+        lines.append("# TYPE sora_api_calls_total counter")
+        for method, count in sorted(self.api_calls.items()):
+            lines.append(f'sora_api_calls_total{{method="{method}"}} {count}')
+        lines.append("# HELP sora_uptime_seconds Время работы бота")
+        lines.append("# TYPE sora_uptime_seconds gauge")
+        lines.append(f"sora_uptime_seconds {time.time() - self.started_at:.0f}")
+        return "\n".join(lines) + "\n"
+
+
+handler_metrics = HandlerMetrics()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data.get("menu_handler", data["handler"]).callback.__name__
+        trace = HandlerTrace()
+        token = handler_trace.set(trace)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await handler(event, data)
+            failed = False
+            return result
+        finally:
+            handler_trace.reset(token)
+            handler_metrics.observe(name, time.perf_counter() - started, trace, failed)
+
+
+async def count_api_call(make_request, bot, method):
+    handler_metrics.api_calls[type(method).__name__] += 1
+    trace = handler_trace.get()
+    if trace is not None:
+        trace.api_calls += 1
+    return await make_request(bot, method)
+
+
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(count_api_call)
+
+# Максимальное количество товаров в результатах поиска
+SEARCH_RESULT_LIMIT = 50
+
+
+
+# ===== КЭШ ПРАВ ДОСТУПА =====
+# Флаги пользователя читаются из базы одной строкой и хранятся в памяти до
+# явной инвалидации, поэтому проверки доступа одобренного пользователя не
+# обращаются к базе. Незарегистрированные пользователи кэшируются как None.
+# Кэш у каждого клуба свой (Club.permissions) и исчезает вместе с закрытием клуба.
+UserPermissions = namedtuple("UserPermissions", ["is_admin", "is_banned", "is_approved"])
+
+
+async def get_user_permissions(user_id):
+    permissions_cache = get_current_club().permissions
+    if user_id in permissions_cache:
+        return permissions_cache[user_id]
+
+    row = await db.fetchone(
+        "SELECT is_admin, is_banned, is_approved FROM users WHERE user_id = ?",
+        (user_id,)
+    )
+    permissions = UserPermissions(*(v == 1 for v in row)) if row else None
+    permissions_cache[user_id] = permissions
+    return permissions
+
+
+# Сбрасывает кэш после любого изменения флагов пользователя
+def invalidate_permissions(user_id):
+    get_current_club().permissions.pop(user_id, None)
+
 
 # ===== ФУНКЦИЯ ПРОВЕРКИ РЕГИСТРАЦИИ ПОЛЬЗОВАТЕЛЯ =====
-def is_registered(user_id):
+async def is_registered(user_id):
     try:
-        cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        return cursor.fetchone() is not None
+        return await get_user_permissions(user_id) is not None
     except Exception as e:
         logger.error(f"Ошибка проверки регистрации пользователя {user_id}: {e}")
         return False
 
 
 # Функция для проверки одобрения пользователя
-def is_approved(user_id):
-    if user_id == MAIN_ADMIN_ID:
+async def is_approved(user_id):
+    if user_id == club_admin_id():
         return True
     try:
-        cursor.execute("SELECT is_approved FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result and result[0] == 1
+        permissions = await get_user_permissions(user_id)
+        return permissions is not None and permissions.is_approved
     except Exception as e:
         logger.error(f"Ошибка проверки одобрения для {user_id}: {e}")
         return False
 
 
 # Функция для регистрации пользователя
-def register_user(user_id, username, first_name):
+async def register_user(user_id, username, first_name):
     try:
-        cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        if not cursor.fetchone():
-            # Для главного администратора всегда одобрен и админ
-            if user_id == MAIN_ADMIN_ID:
+        if not await db.fetchone("SELECT user_id FROM users WHERE user_id = ?", (user_id,)):
+            # Администратор клуба всегда одобрен и админ
+            if user_id == club_admin_id():
                 is_admin_val = 1
                 is_approved_val = 1
             else:
                 is_admin_val = 0
                 is_approved_val = 0  # По умолчанию не одобрен
 
-            cursor.execute(
+            await db.execute(
                 "INSERT INTO users (user_id, username, first_name, is_admin, is_approved) VALUES (?, ?, ?, ?, ?)",
                 (user_id, username, first_name, is_admin_val, is_approved_val)
             )
-            conn.commit()
+            invalidate_permissions(user_id)
             logger.info(
                 f"Зарегистрирован новый пользователь: ID={user_id}, Имя={first_name}, Админ={is_admin_val}, Одобрен={is_approved_val}")
             return True
@@ -274,83 +1421,547 @@ def register_user(user_id, username, first_name):
 
 
 # Функция для проверки прав администратора
-def is_admin(user_id):
+async def is_admin(user_id):
     try:
-        cursor.execute("SELECT is_admin FROM users WHERE user_id = ? AND is_banned = 0", (user_id,))
-        result = cursor.fetchone()
-        return result and result[0] == 1
+        permissions = await get_user_permissions(user_id)
+        return permissions is not None and permissions.is_admin and not permissions.is_banned
     except Exception as e:
         logger.error(f"Ошибка проверки прав администратора для {user_id}: {e}")
         return False
 
 
 # Функция для проверки бана пользователя
-def is_banned(user_id):
+async def is_banned(user_id):
     try:
-        cursor.execute("SELECT is_banned FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result and result[0] == 1
+        permissions = await get_user_permissions(user_id)
+        return permissions is not None and permissions.is_banned
     except Exception as e:
         logger.error(f"Ошибка проверки бана для {user_id}: {e}")
         return False
 
 
 # Функция для получения chat_id для уведомлений
-def get_notification_chat(notification_type: str) -> str:
+async def get_notification_chat(notification_type: str) -> str:
     try:
-        cursor.execute(
+        result = await db.fetchone(
             "SELECT chat_id FROM notification_settings WHERE notification_type = ?",
             (notification_type,)
         )
-        result = cursor.fetchone()
         return result[0] if result else None
     except Exception as e:
         logger.error(f"Ошибка получения чата для {notification_type}: {e}")
         return None
 
 
+# ===== ОЧЕРЕДЬ ИСХОДЯЩИХ УВЕДОМЛЕНИЙ =====
+# Все уведомления идут через одну очередь с приоритетами. Отправка
+# ограничена общим ведром токенов и ведром на каждый чат (лимиты Telegram:
+# ~30 сообщений в секунду всего, ~1 в секунду в личный чат и ~20 в минуту
+# в группу), а ответ 429 блокирует чат на указанное retry_after время.
+PRIORITY_REPORT = 0  # отчёты по сменам в группу
+PRIORITY_NORMAL = 1  # уведомления пользователям и администратору
+PRIORITY_ACTION = 2  # журнал действий
+
+NOTIFY_GLOBAL_RATE = 25.0
+NOTIFY_PRIVATE_CHAT_RATE = 1.0
+NOTIFY_GROUP_CHAT_RATE = 20 / 60
+NOTIFY_MAX_ATTEMPTS = 5
+NOTIFY_BUCKET_PRUNE_INTERVAL = 60.0  # секунды между очистками вёдер простаивающих чатов
+# Интервал сводки действий в секундах, 0 - отправлять каждое действие отдельно
+ACTION_DIGEST_INTERVAL = float(os.getenv("ACTION_DIGEST_INTERVAL", "0"))
+
+MESSAGE_MAX_LENGTH = 4000
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Сколько секунд ждать до появления токена."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds, now):
+        self._refill(now)
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def idle(self, now):
+        """Полное ведро без блокировки ничем не отличается от нового."""
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class NotificationDispatcher:
+    def __init__(self, bot, global_rate=NOTIFY_GLOBAL_RATE, private_chat_rate=NOTIFY_PRIVATE_CHAT_RATE,
+                 group_chat_rate=NOTIFY_GROUP_CHAT_RATE, max_attempts=NOTIFY_MAX_ATTEMPTS,
+                 digest_interval=ACTION_DIGEST_INTERVAL, prune_interval=NOTIFY_BUCKET_PRUNE_INTERVAL):
+        self.bot = bot
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.max_attempts = max_attempts
+        self.digest_interval = digest_interval
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.prune_interval = prune_interval
+        self._pruned_at = time.monotonic()
+        self.queue = asyncio.PriorityQueue()
+        self.digests = {}
+        self.sent_count = 0
+        self.failed_count = 0
+        self.retry_count = 0
+        self._seq = 0
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._worker = None
+        self._digest_task = None
+
+    def send(self, chat_id, text, priority=PRIORITY_NORMAL):
+        """Ставит сообщение в очередь. Возвращает future с результатом доставки (True/False)."""
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        self._pending += 1
+        self._idle.clear()
+        self.queue.put_nowait((priority, self._seq, chat_id, text, 1, future))
+        return future
+
+    def send_action(self, chat_id, text):
+        """Уведомление журнала действий: сразу или в составе сводки."""
+        if self.digest_interval > 0:
+            self.digests.setdefault(chat_id, []).append(text)
+        else:
+            self.send(chat_id, text, PRIORITY_ACTION)
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        if self.digest_interval > 0 and self._digest_task is None:
+            self._digest_task = asyncio.create_task(self._run_digests())
+
+    async def stop(self, timeout=10.0):
+        """Отправляет накопленные сводки и дожидается опустошения очереди."""
+        if self._digest_task is not None:
+            self._digest_task.cancel()
+            self._digest_task = None
+        self.flush_digests()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не отправлено уведомлений при остановке: {self._pending}")
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    def flush_digests(self):
+        digests, self.digests = self.digests, {}
+        for chat_id, texts in digests.items():
+            header = f"🔔 Сводка действий ({len(texts)}):\n\n"
+            chunk = header
+            for text in texts:
+                if len(chunk) + len(text) + 2 > MESSAGE_MAX_LENGTH and chunk != header:
+                    self.send(chat_id, chunk, PRIORITY_ACTION)
+                    chunk = header
+                chunk += text + "\n\n"
+            self.send(chat_id, chunk, PRIORITY_ACTION)
+
+    async def _run_digests(self):
+        while True:
+            await asyncio.sleep(self.digest_interval)
+            self.flush_digests()
+
+    def _chat_bucket(self, chat_id):
+        key = str(chat_id)
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            self._prune_chat_buckets(time.monotonic())
+            # У групп и каналов отрицательные ID
+            rate = self.group_chat_rate if key.startswith("-") else self.private_chat_rate
+            bucket = self.chat_buckets[key] = TokenBucket(rate, 1)
+        return bucket
+
+    def _prune_chat_buckets(self, now):
+        # Без очистки словарь хранил бы ведро каждого чата, куда бот когда-либо писал
+        if now - self._pruned_at < self.prune_interval:
+            return
+        self._pruned_at = now
+        for key in [key for key, bucket in self.chat_buckets.items() if bucket.idle(now)]:
+            del self.chat_buckets[key]
+
+    def _requeue(self, item):
+        self.queue.put_nowait(item)
+
+    def _done(self, future, delivered):
+        if not future.done():
+            future.set_result(delivered)
+        self._pending -= 1
+        if self._pending == 0:
+            self._idle.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            priority, seq, chat_id, text, attempt, future = item
+
+            chat_bucket = self._chat_bucket(chat_id)
+            chat_wait = chat_bucket.delay(time.monotonic())
+            if chat_wait > 0:
+                # Чат занят - откладываем сообщение, не задерживая остальные чаты
+                loop.call_later(chat_wait, self._requeue, item)
+                continue
+
+            global_wait = self.global_bucket.delay(time.monotonic())
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+
+            now = time.monotonic()
+            self.global_bucket.consume(now)
+            chat_bucket.consume(now)
+            try:
+                await self.bot.send_message(chat_id, text)
+                self.sent_count += 1
+                self._done(future, True)
+            except TelegramRetryAfter as e:
+                self.retry_count += 1
+                logger.warning(f"Превышен лимит отправки в чат {chat_id}, повтор через {e.retry_after} с")
+                chat_bucket.block(e.retry_after, time.monotonic())
+                self._requeue(item)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt < self.max_attempts:
+                    self.retry_count += 1
+                    loop.call_later(2 ** attempt, self._requeue,
+                                    (priority, seq, chat_id, text, attempt + 1, future))
+                else:
+                    self.failed_count += 1
+                    logger.error(f"Ошибка отправки уведомления в чат {chat_id}: {e}")
+                    self._done(future, False)
+            except Exception as e:
+                self.failed_count += 1
+                logger.error(f"Ошибка отправки уведомления в чат {chat_id}: {e}")
+                self._done(future, False)
+
+
+notifier = NotificationDispatcher(bot)
+
+
+# ===== БУФЕР ЖУРНАЛА ДЕЙСТВИЙ =====
+# log_action только ставит запись в очередь, а фоновая задача пишет записи
+# пачками: одна транзакция с executemany в action_logs и одно обновление
+# last_action на пользователя. Уведомления отправляются после записи пачки.
+ACTION_LOG_QUEUE_SIZE = 10000
+ACTION_LOG_BATCH_SIZE = 500
+ACTION_LOG_FLUSH_INTERVAL = 1.0  # секунды
+
+ActionLogEntry = namedtuple("ActionLogEntry", ["user_id", "action", "details", "timestamp", "local_time", "club"])
+
+
+class ActionLogBuffer:
+    def __init__(self, maxsize, batch_size, flush_interval):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flushed_count = 0
+        self.dropped_count = 0
+        self._batch = []  # пачка, которая собирается прямо сейчас
+        self._task = None
+
+    def put(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.dropped_count += 1
+            logger.warning(f"Очередь журнала действий переполнена, запись отброшена: {entry.action}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # wait_for в _run может поглотить отмену, если запись пришла
+            # одновременно с ней, поэтому отменяем, пока задача не завершится
+            while not self._task.done():
+                self._task.cancel()
+                await asyncio.wait({self._task}, timeout=0.1)
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        """Записывает всё, что накопилось в очереди, не дожидаясь интервала."""
+        if self._batch:
+            batch, self._batch = self._batch, []
+            await self._write_batch(batch)
+        while not self.queue.empty():
+            batch = []
+            while not self.queue.empty() and len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+            await self._write_batch(batch)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(self._batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    self._batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch, self._batch = self._batch, []
+            await self._write_batch(batch)
+
+    async def _write_batch(self, batch):
+        # В пачке могут быть записи разных клубов - каждая часть пишется в базу своего клуба
+        by_club = {}
+        for entry in batch:
+            by_club.setdefault(entry.club, []).append(entry)
+        for slug, entries in by_club.items():
+            async with clubs.use(slug):
+                await self._write_club_batch(entries)
+
+    async def _write_club_batch(self, batch):
+        try:
+            await db.transaction(_write_action_log_batch, batch)
+            self.flushed_count += len(batch)
+        except Exception as e:
+            self.dropped_count += len(batch)
+            logger.error(f"Ошибка записи пачки журнала действий ({len(batch)} записей): {e}")
+            return
+
+        try:
+            await send_action_notifications(batch)
+        except Exception as e:
+            logger.error(f"Ошибка отправки уведомлений о действиях: {e}")
+
+
+def _write_action_log_batch(conn, batch):
+    conn.executemany(
+        "INSERT INTO action_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
+        [(entry.user_id, entry.action, entry.details, entry.timestamp) for entry in batch]
+    )
+    # Для каждого пользователя достаточно последнего времени из пачки
+    last_actions = {entry.user_id: entry.local_time for entry in batch}
+    conn.executemany(
+        "UPDATE users SET last_action = ? WHERE user_id = ?",
+        [(local_time, user_id) for user_id, local_time in last_actions.items()]
+    )
+
+
+action_log = ActionLogBuffer(ACTION_LOG_QUEUE_SIZE, ACTION_LOG_BATCH_SIZE, ACTION_LOG_FLUSH_INTERVAL)
+
+
 # Функция для логирования действий
 async def log_action(user_id, action, details=""):
     try:
-        cursor.execute(
-            "INSERT INTO action_logs (user_id, action, details) VALUES (?, ?, ?)",
-            (user_id, action, details)
-        )
-        conn.commit()
+        action_log.put(ActionLogEntry(
+            user_id,
+            action,
+            details,
+            datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),  # как CURRENT_TIMESTAMP
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            get_current_club().slug
+        ))
         logger.info(f"Действие пользователя {user_id}: {action} - {details}")
+    except Exception as e:
+        logger.error(f"Ошибка логирования действия: {e}")
+
+
+# Отправляет уведомления о действиях в настроенный чат или администратору клуба
+async def send_action_notifications(batch):
+    entries = [entry for entry in batch if entry.user_id != club_admin_id()]
+    if not entries:
+        return
 
-        # Обновляем время последнего действия пользователя
-        update_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "UPDATE users SET last_action = ? WHERE user_id = ?",
-            (update_time, user_id)
+    user_ids = list({entry.user_id for entry in entries})
+    placeholders = ", ".join("?" * len(user_ids))
+    rows = await db.fetchall(
+        f"SELECT user_id, username, first_name FROM users WHERE user_id IN ({placeholders})",
+        user_ids
+    )
+    users = {row[0]: row[1:] for row in rows}
+
+    # Получаем чат для уведомлений из настроек
+    action_chat_id = await get_notification_chat("actions") or club_admin_id()
+    for entry in entries:
+        user_info = users.get(entry.user_id)
+        username = user_info[0] if user_info and user_info[0] else "без username"
+        first_name = user_info[1] if user_info and user_info[1] else "Неизвестно"
+
+        notification = (
+            f"🔔 Действие пользователя:\n"
+            f"👤 {first_name} (@{username})\n"
+            f"🆔 ID: {entry.user_id}\n"
+            f"⚡ Действие: {entry.action}\n"
+            f"📝 Детали: {entry.details}\n"
+            f"🕐 Время: {entry.local_time}"
         )
-        conn.commit()
-
-        # Отправляем уведомление в настроенный чат или главному администратору
-        if user_id != MAIN_ADMIN_ID:
-            cursor.execute("SELECT username, first_name FROM users WHERE user_id = ?", (user_id,))
-            user_info = cursor.fetchone()
-            username = user_info[0] if user_info and user_info[0] else "без username"
-            first_name = user_info[1] if user_info and user_info[1] else "Неизвестно"
-
-            notification = (
-                f"🔔 Действие пользователя:\n"
-                f"👤 {first_name} (@{username})\n"
-                f"🆔 ID: {user_id}\n"
-                f"⚡ Действие: {action}\n"
-                f"📝 Детали: {details}\n"
-                f"🕐 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-            )
+        notifier.send_action(action_chat_id, notification)
+
+
+# ===== АРХИВ ЖУРНАЛА ДЕЙСТВИЙ =====
+# Записи старше ACTION_LOG_RETENTION_DAYS переносятся из action_logs в
+# помесячные базы action_logs_ГГГГ-ММ.db в папке архива клуба. Перенос идёт пачками
+# по ACTION_LOG_ARCHIVE_BATCH строк, каждая пачка - отдельная короткая
+# транзакция, так что запись в основную базу не блокируется надолго.
+# Вставка в архив идемпотентна (INSERT OR IGNORE по id), поэтому сбой между
+# пачками не приводит ни к потере, ни к дублированию записей.
+ACTION_LOG_RETENTION_DAYS = int(os.getenv("ACTION_LOG_RETENTION_DAYS", "90"))  # 0 - не архивировать
+ACTION_LOG_ARCHIVE_BATCH = 5000
+ACTION_LOG_ARCHIVE_INTERVAL = 60 * 60  # секунды между проходами
+ACTION_LOG_ARCHIVE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS archive.action_logs
+    (
+        id        INTEGER PRIMARY KEY,
+        user_id   INTEGER,
+        action    TEXT,
+        details   TEXT,
+        timestamp TIMESTAMP
+    )
+'''
+
+
+def get_archive_path(month):
+    return get_current_club().archive_dir / f"action_logs_{month}.db"
+
+
+def list_archive_months():
+    archive_dir = get_current_club().archive_dir
+    return sorted(path.stem.removeprefix("action_logs_") for path in archive_dir.glob("action_logs_*.db"))
+
+
+def _archive_action_log_batch(conn, cutoff, batch_size, archive_dir):
+    rows = conn.execute(
+        "SELECT id, user_id, action, details, timestamp FROM action_logs "
+        "WHERE timestamp < ? ORDER BY timestamp LIMIT ?",
+        (cutoff, batch_size)
+    ).fetchall()
+
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(row[4][:7], []).append(row)
+
+    for month, month_rows in by_month.items():
+        conn.execute("ATTACH DATABASE ? AS archive", (str(archive_dir / f"action_logs_{month}.db"),))
+        try:
+            conn.execute(ACTION_LOG_ARCHIVE_SCHEMA)
+            # В WAL-режиме транзакция над двумя базами не атомарна целиком,
+            # поэтому сначала фиксируем архив и только затем удаляем оригиналы
+            with conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO archive.action_logs (id, user_id, action, details, timestamp) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    month_rows
+                )
+            with conn:
+                conn.executemany("DELETE FROM action_logs WHERE id = ?", [(row[0],) for row in month_rows])
+        finally:
+            conn.execute("DETACH DATABASE archive")
+
+    return len(rows)
+
+
+def _read_archived_logs(conn, path, limit):
+    conn.execute("ATTACH DATABASE ? AS archive", (str(path),))
+    try:
+        return conn.execute(
+            "SELECT al.action, al.details, al.timestamp, u.first_name, u.username "
+            "FROM archive.action_logs al LEFT JOIN users u ON al.user_id = u.user_id "
+            "ORDER BY al.id DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+    finally:
+        conn.execute("DETACH DATABASE archive")
+
+
+async def fetch_archived_logs(month, limit=20):
+    """Читает последние записи архивного месяца (ГГГГ-ММ), подключая его архив."""
+    path = get_archive_path(month)
+    if not path.exists():
+        return []
+    return await db.call(_read_archived_logs, path, limit)
 
-            # Получаем чат для уведомлений из настроек
-            action_chat_id = get_notification_chat("actions") or MAIN_ADMIN_ID
+
+class ActionLogArchiver:
+    def __init__(self, retention_days, batch_size, interval):
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self.archived_count = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None and self.retention_days > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
             try:
-                await bot.send_message(action_chat_id, notification)
-            except Exception as e:
-                logger.error(f"Ошибка отправки уведомления: {e}")
-    except Exception as e:
-        logger.error(f"Ошибка логирования действия: {e}")
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def archive(self):
+        """Переносит в архив все записи старше срока хранения; возвращает их число."""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.retention_days)
+        cutoff = cutoff.strftime('%Y-%m-%d %H:%M:%S')
+        archive_dir = get_current_club().archive_dir
+        total = 0
+        while True:
+            moved = await db.call(_archive_action_log_batch, cutoff, self.batch_size, archive_dir)
+            total += moved
+            if moved < self.batch_size:
+                break
+            # Даём обработчикам выполнить свои запросы между пачками
+            await asyncio.sleep(0)
+        self.archived_count += total
+        if total:
+            logger.info(f"Перенесено в архив журнала действий: {total}")
+        return total
+
+    async def _run(self):
+        while True:
+            await clubs.each_open(self.archive, "архивации журнала действий")
+            await asyncio.sleep(self.interval)
+
+
+log_archiver = ActionLogArchiver(ACTION_LOG_RETENTION_DAYS, ACTION_LOG_ARCHIVE_BATCH, ACTION_LOG_ARCHIVE_INTERVAL)
+
+
+# ===== СТАТИСТИКА =====
+# Счётчики пользователей, товаров, отчётов и записей журнала хранятся в
+# таблице stats_counters и обновляются триггерами в той же транзакции, что
+# и сами изменения. Скользящее окно "действий за 24 часа" считается по
+# индексу idx_action_logs_timestamp в том же запросе.
+STATS_QUERY = '''
+    SELECT name, value FROM stats_counters
+    UNION ALL
+    SELECT 'actions_24h', COUNT(*) FROM action_logs WHERE timestamp > datetime('now', '-1 day')
+'''
+
+
+async def get_stats():
+    """Возвращает словарь всех показателей панели статистики одним запросом."""
+    return dict(await db.fetchall(STATS_QUERY))
 
 
 # ===== ФУНКЦИЯ АВТОМАТИЧЕСКОЙ РЕГИСТРАЦИИ =====
@@ -360,9 +1971,9 @@ async def register_if_needed(message: types.Message) -> bool:
     first_name = message.from_user.first_name
 
     # Если пользователь не зарегистрирован
-    if not is_registered(user_id):
+    if not await is_registered(user_id):
         # Регистрируем нового пользователя
-        if register_user(user_id, username, first_name):
+        if await register_user(user_id, username, first_name):
             await message.answer(
                 "✅ Вы успешно зарегистрированы!\n"
                 "⏳ Ожидайте подтверждения доступа администратором."
@@ -377,10 +1988,7 @@ async def register_if_needed(message: types.Message) -> bool:
                 f"📎 Username: @{username}\n\n"
                 f"Для одобрения доступа используйте админ-панель."
             )
-            try:
-                await bot.send_message(MAIN_ADMIN_ID, admin_notification)
-            except Exception as e:
-                logger.error(f"Ошибка отправки уведомления админу: {e}")
+            notifier.send(club_admin_id(), admin_notification)
             return True
         else:
             await message.answer("❌ Ошибка регистрации. Обратитесь к администратору.")
@@ -390,7 +1998,8 @@ async def register_if_needed(message: types.Message) -> bool:
 
 # ===== ОБНОВЛЕННЫЕ MIDDLEWARE ДЛЯ ПРОВЕРКИ ДОСТУПА =====
 def access_required(func):
-    async def wrapper(message: types.Message):
+    @wraps(func)
+    async def wrapper(message: types.Message, **kwargs):
         user_id = message.from_user.id
 
         # Автоматическая регистрация при необходимости
@@ -398,53 +2007,133 @@ def access_required(func):
             return
 
         # Проверка бана
-        if is_banned(user_id):
+        if await is_banned(user_id):
             await message.answer("❌ Ваш доступ к боту заблокирован.")
             return
 
-        # Проверка одобрения (главный администратор всегда одобрен)
-        if not is_approved(user_id) and user_id != MAIN_ADMIN_ID:
+        # Проверка одобрения (администратор клуба всегда одобрен)
+        if not await is_approved(user_id) and user_id != club_admin_id():
             await message.answer("❌ Ваш доступ к боту еще не подтвержден администратором. Ожидайте одобрения.")
             return
 
-        return await func(message)
+        return await func(message, **kwargs)
 
     return wrapper
 
 
 def admin_required(func):
-    async def wrapper(message: types.Message):
+    @wraps(func)
+    async def wrapper(message: types.Message, **kwargs):
         user_id = message.from_user.id
 
         # Автоматическая регистрация при необходимости
         if not (await register_if_needed(message)):
             return
 
-        if is_banned(user_id):
+        if await is_banned(user_id):
             await message.answer("❌ Ваш доступ к боту заблокирован.")
             return
 
-        if not is_approved(user_id) and user_id != MAIN_ADMIN_ID:
+        if not await is_approved(user_id) and user_id != club_admin_id():
             await message.answer("❌ Ваш доступ к боту еще не подтвержден администратором.")
             return
 
-        if not is_admin(user_id):
+        if not await is_admin(user_id):
             await message.answer("❌ У вас нет прав администратора для выполнения этого действия.")
             return
-        return await func(message)
+        return await func(message, **kwargs)
 
     return wrapper
 
 
+# ===== МАРШРУТИЗАЦИЯ СООБЩЕНИЙ =====
+# Обработчики разбиты по подсистемам на Router. Кнопки меню и шаги диалогов
+# не проверяются фильтрами по очереди: каждый MenuRouter хранит таблицы
+# "текст кнопки -> обработчик" и "состояние -> обработчик", а menu_index
+# сводит таблицы всех подсистем и находит обработчик за два обращения к
+# словарю, сколько бы кнопок ни было. Если подходят и кнопка, и состояние,
+# срабатывает обработчик, объявленный раньше, как при проверке фильтров по порядку.
+MenuEntry = namedtuple("MenuEntry", ["order", "handler"])
+menu_order = itertools.count()
+
+
+class MenuRouter(Router):
+    """Router с таблицами кнопок меню и состояний диалогов."""
+
+    def __init__(self, name: str):
+        super().__init__(name=name)
+        self.buttons = {}
+        self.states = {}
+
+    def _register(self, table: dict, keys, kind: str):
+        def decorator(func):
+            entry = MenuEntry(next(menu_order), HandlerObject(callback=func))
+            for key in keys:
+                if key in table:
+                    raise ValueError(f"{kind} '{key}' уже обрабатывается в {self.name}")
+                table[key] = entry
+            return func
+
+        return decorator
+
+    def button(self, *texts: str):
+        return self._register(self.buttons, texts, "Кнопка")
+
+    def state(self, *states: str):
+        return self._register(self.states, states, "Состояние")
+
+
+class MenuIndex:
+    """Общие таблицы кнопок и состояний всех подсистем."""
+
+    def __init__(self, routers):
+        self.routers = routers
+        self.buttons = {}
+        self.states = {}
+
+    def build(self):
+        for router in self.routers:
+            for table, merged, kind in ((router.buttons, self.buttons, "Кнопка"),
+                                        (router.states, self.states, "Состояние")):
+                for key, entry in table.items():
+                    if key in merged:
+                        raise ValueError(f"{kind} '{key}' обрабатывается в нескольких подсистемах")
+                    merged[key] = entry
+        logger.info(f"Таблица меню: {len(self.buttons)} кнопок, {len(self.states)} состояний")
+
+    def lookup(self, text: str, raw_state=None):
+        entries = [entry for entry in (self.states.get(raw_state), self.buttons.get(text)) if entry]
+        return min(entries).handler if entries else None
+
+    async def match(self, message: types.Message, raw_state=None):
+        """Фильтр: найденный обработчик передаётся дальше как menu_handler."""
+        if not message.text:
+            return False
+        handler = self.lookup(message.text, raw_state)
+        return {"menu_handler": handler} if handler else False
+
+    async def dispatch(self, message: types.Message, menu_handler: HandlerObject, **data):
+        return await menu_handler.call(message, **data)
+
+
+warehouse_router = MenuRouter("warehouse")
+reports_router = MenuRouter("reports")
+admin_router = MenuRouter("admin")
+notifications_router = MenuRouter("notifications")
+# Общие команды и навигация; подключается последним, после команд подсистем
+common_router = MenuRouter("common")
+menu_index = MenuIndex([warehouse_router, reports_router, admin_router, notifications_router, common_router])
+
+
 # ===== КЛАВИАТУРЫ =====
-def get_main_keyboard(user_id):
+async def get_main_keyboard(user_id):
     keyboard = [
         [KeyboardButton(text="📊 Склад")],
         [KeyboardButton(text="📝 Отчёт по смене")],
         [KeyboardButton(text="📥 Экспорт в Excel")]
     ]
 
-    if is_admin(user_id):
+    if await is_admin(user_id):
         keyboard.append([KeyboardButton(text="👑 Админ-панель")])
 
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
@@ -469,6 +2158,7 @@ def get_admin_keyboard():
             [KeyboardButton(text="👥 Управление пользователями")],
             [KeyboardButton(text="🔒 Управление доступом")],
             [KeyboardButton(text="📊 Статистика"), KeyboardButton(text="📋 Логи действий")],
+            [KeyboardButton(text="📈 Аналитика"), KeyboardButton(text="📤 Импорт товаров")],
             [KeyboardButton(text="🔔 Управление уведомлениями")],  # Новая кнопка
             [KeyboardButton(text="🔙 Назад в главное меню")]
         ],
@@ -519,6 +2209,7 @@ def get_notification_keyboard():
             [KeyboardButton(text="👁 Просмотреть настройки")],
             [KeyboardButton(text="✏️ Установить текущий чат для отчетов")],
             [KeyboardButton(text="✏️ Установить текущий чат для действий")],
+            [KeyboardButton(text="✏️ Установить текущий чат для остатков")],
             [KeyboardButton(text="❓ Как получить ID чата?")],
             [KeyboardButton(text="🔙 Назад в админ-панель")]
         ],
@@ -546,45 +2237,45 @@ def get_skip_keyboard():
 
 
 # ===== КОМАНДА /start =====
-@dp.message(Command("start"))
+@common_router.message(Command("start"))
 @access_required
-async def start(message: types.Message):
+async def start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username
     first_name = message.from_user.first_name
 
-    # Автоматическая регистрация главного администратора
-    if user_id == MAIN_ADMIN_ID and not is_registered(user_id):
-        cursor.execute(
+    # Автоматическая регистрация администратора клуба
+    if user_id == club_admin_id() and not await is_registered(user_id):
+        await db.execute(
             "INSERT INTO users (user_id, username, first_name, is_admin, is_approved) VALUES (?, ?, ?, ?, ?)",
             (user_id, username, first_name, 1, 1)
         )
-        conn.commit()
+        invalidate_permissions(user_id)
         logger.info(f"Главный администратор зарегистрирован: {user_id}")
 
     # Проверяем, заблокирован ли пользователь
-    if is_banned(user_id):
+    if await is_banned(user_id):
         await message.answer("❌ Ваш доступ к боту заблокирован администратором.")
         return
 
     # Проверяем одобрен ли пользователь
-    if not is_approved(user_id) and user_id != MAIN_ADMIN_ID:
+    if not await is_approved(user_id) and user_id != club_admin_id():
         await message.answer(
             "❌ Ваш доступ к боту еще не подтвержден.\n"
             "⏳ Ожидайте одобрения администратором."
         )
         return
 
-    user_states[user_id] = None
-    user_data[user_id] = {}
+    await state.set_state(None)
+    await state.set_data({})
 
     welcome_text = "🛒 Добро пожаловать в складской бот!\n"
-    await message.answer(welcome_text, reply_markup=get_main_keyboard(user_id))
+    await message.answer(welcome_text, reply_markup=await get_main_keyboard(user_id))
     await log_action(user_id, "Запуск бота", "Пользователь вошел в систему")
 
 
 # ===== АДМИН-ПАНЕЛЬ =====
-@dp.message(F.text == "👑 Админ-панель")
+@admin_router.button("👑 Админ-панель")
 @admin_required
 async def admin_panel(message: types.Message):
     await message.answer(
@@ -594,7 +2285,7 @@ async def admin_panel(message: types.Message):
     )
 
 
-@dp.message(F.text == "🔔 Управление уведомлениями")
+@notifications_router.button("🔔 Управление уведомлениями")
 @admin_required
 async def notification_management(message: types.Message):
     await message.answer(
@@ -604,12 +2295,11 @@ async def notification_management(message: types.Message):
     )
 
 
-@dp.message(F.text == "👁 Просмотреть настройки")
+@notifications_router.button("👁 Просмотреть настройки")
 @admin_required
 async def view_notification_settings(message: types.Message):
     try:
-        cursor.execute("SELECT * FROM notification_settings")
-        settings = cursor.fetchall()
+        settings = await db.fetchall("SELECT * FROM notification_settings")
 
         response = "🔔 Текущие настройки уведомлений:\n\n"
 
@@ -627,7 +2317,7 @@ async def view_notification_settings(message: types.Message):
         await message.answer("❌ Ошибка при получении настроек уведомлений")
 
 
-@dp.message(F.text == "✏️ Установить текущий чат для отчетов")
+@notifications_router.button("✏️ Установить текущий чат для отчетов")
 @admin_required
 async def set_report_chat_current(message: types.Message):
     user_id = message.from_user.id
@@ -650,11 +2340,10 @@ async def set_report_chat_current(message: types.Message):
 
     try:
         # Сохраняем или обновляем настройку
-        cursor.execute(
+        await db.execute(
             "INSERT OR REPLACE INTO notification_settings (notification_type, chat_id) VALUES (?, ?)",
             ("reports", str(chat_id))
         )
-        conn.commit()
 
         await message.answer(
             f"✅ Чат для отчетов успешно установлен!\n"
@@ -672,7 +2361,7 @@ async def set_report_chat_current(message: types.Message):
                              reply_markup=get_notification_keyboard())
 
 
-@dp.message(F.text == "✏️ Установить текущий чат для действий")
+@notifications_router.button("✏️ Установить текущий чат для действий")
 @admin_required
 async def set_action_chat_current(message: types.Message):
     user_id = message.from_user.id
@@ -695,11 +2384,10 @@ async def set_action_chat_current(message: types.Message):
 
     try:
         # Сохраняем или обновляем настройку
-        cursor.execute(
+        await db.execute(
             "INSERT OR REPLACE INTO notification_settings (notification_type, chat_id) VALUES (?, ?)",
             ("actions", str(chat_id))
         )
-        conn.commit()
 
         await message.answer(
             f"✅ Чат для логов действий успешно установлен!\n"
@@ -717,7 +2405,51 @@ async def set_action_chat_current(message: types.Message):
                              reply_markup=get_notification_keyboard())
 
 
-@dp.message(F.text == "❓ Как получить ID чата?")
+@notifications_router.button("✏️ Установить текущий чат для остатков")
+@admin_required
+async def set_stock_chat_current(message: types.Message):
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+
+    # Проверяем, что бот администратор в этом чате (для групп)
+    if message.chat.type != "private":
+        try:
+            chat_member = await bot.get_chat_member(chat_id, bot.id)
+            if not chat_member.status in ['administrator', 'creator']:
+                await message.answer(
+                    "❌ Бот должен быть администратором в этом чате!\n"
+                    "Пожалуйста, назначьте бота администратором и повторите попытку."
+                )
+                return
+        except Exception as e:
+            logger.error(f"Ошибка проверки прав бота: {e}")
+            await message.answer("❌ Не удалось проверить права бота в этом чате.")
+            return
+
+    try:
+        # Сохраняем или обновляем настройку
+        await db.execute(
+            "INSERT OR REPLACE INTO notification_settings (notification_type, chat_id) VALUES (?, ?)",
+            ("stock", str(chat_id))
+        )
+
+        await message.answer(
+            f"✅ Чат для уведомлений об остатках успешно установлен!\n"
+            f"ID чата: {chat_id}\n"
+            f"Уведомления о заканчивающихся товарах будут отправляться сюда.",
+            reply_markup=get_notification_keyboard()
+        )
+
+        await log_action(user_id, "Настройка уведомлений",
+                         f"Установлен чат для остатков: {chat_id}")
+
+    except Exception as e:
+        logger.error(f"Ошибка сохранения настроек уведомлений: {e}")
+        await message.answer("❌ Ошибка сохранения настроек. Попробуйте позже.",
+                             reply_markup=get_notification_keyboard())
+
+
+@notifications_router.button("❓ Как получить ID чата?")
 @admin_required
 async def how_to_get_chat_id(message: types.Message):
     help_text = (
@@ -729,14 +2461,15 @@ async def how_to_get_chat_id(message: types.Message):
         "Для установки текущего чата:\n"
         "- В меню уведомлений выберите:\n"
         "  • '✏️ Установить текущий чат для отчетов' - для отчетов\n"
-        "  • '✏️ Установить текущий чат для действий' - для логов действий\n\n"
+        "  • '✏️ Установить текущий чат для действий' - для логов действий\n"
+        "  • '✏️ Установить текущий чат для остатков' - для уведомлений о заканчивающихся товарах\n\n"
         "Для установки чата из личных сообщений просто используйте соответствующие кнопки."
     )
     await message.answer(help_text)
 
 
 # Команда для получения ID чата
-@dp.message(Command("id"))
+@notifications_router.message(Command("id"))
 async def get_chat_id(message: types.Message):
     chat_id = message.chat.id
     chat_type = message.chat.type
@@ -751,7 +2484,7 @@ async def get_chat_id(message: types.Message):
     await message.answer(response, parse_mode="Markdown")
 
 
-@dp.message(F.text == "🔒 Управление доступом")
+@admin_router.button("🔒 Управление доступом")
 @admin_required
 async def access_management(message: types.Message):
     await message.answer(
@@ -761,18 +2494,17 @@ async def access_management(message: types.Message):
     )
 
 
-@dp.message(F.text == "👀 Показать неодобренных")
+@admin_router.button("👀 Показать неодобренных")
 @admin_required
 async def show_unapproved_users(message: types.Message):
     try:
-        cursor.execute("""
+        users = await db.fetchall("""
                        SELECT user_id, username, first_name, added_date
                        FROM users
                        WHERE is_approved = 0
                          AND is_banned = 0
                        ORDER BY added_date DESC
                        """)
-        users = cursor.fetchall()
 
         if not users:
             await message.answer("✅ Все пользователи одобрены или заблокированы.")
@@ -813,18 +2545,17 @@ async def show_unapproved_users(message: types.Message):
         await message.answer("❌ Ошибка при получении списка пользователей.")
 
 
-@dp.message(F.text == "✅ Одобрить доступ")
+@admin_router.button("✅ Одобрить доступ")
 @admin_required
 async def approve_access_start(message: types.Message):
     try:
-        cursor.execute("""
+        users = await db.fetchall("""
                        SELECT user_id, username, first_name, added_date
                        FROM users
                        WHERE is_approved = 0
                          AND is_banned = 0
                        ORDER BY added_date DESC
                        """)
-        users = cursor.fetchall()
 
         if not users:
             await message.answer("✅ Все пользователи уже одобрены.")
@@ -850,18 +2581,17 @@ async def approve_access_start(message: types.Message):
         await message.answer("❌ Ошибка при получении списка пользователей.")
 
 
-@dp.message(F.text == "🚫 Запретить доступ")
+@admin_router.button("🚫 Запретить доступ")
 @admin_required
 async def disapprove_access_start(message: types.Message):
     try:
-        cursor.execute("""
+        users = await db.fetchall("""
                        SELECT user_id, username, first_name, added_date
                        FROM users
                        WHERE is_approved = 1
                          AND is_banned = 0
                        ORDER BY added_date DESC
                        """)
-        users = cursor.fetchall()
 
         if not users:
             await message.answer("ℹ️ Нет одобренных пользователей для запрета доступа.")
@@ -888,18 +2618,17 @@ async def disapprove_access_start(message: types.Message):
 
 
 # Обработчик кнопки одобрения пользователя
-@dp.callback_query(F.data.startswith("approve_"))
+@admin_router.callback_query(F.data.startswith("approve_"))
 async def handle_approve_user(callback: types.CallbackQuery):
     try:
         user_id = int(callback.data.split("_")[1])
 
         # Обновляем статус пользователя
-        cursor.execute("UPDATE users SET is_approved = 1 WHERE user_id = ?", (user_id,))
-        conn.commit()
+        await db.execute("UPDATE users SET is_approved = 1 WHERE user_id = ?", (user_id,))
+        invalidate_permissions(user_id)
 
         # Получаем информацию о пользователе
-        cursor.execute("SELECT first_name, username FROM users WHERE user_id = ?", (user_id,))
-        user = cursor.fetchone()
+        user = await db.fetchone("SELECT first_name, username FROM users WHERE user_id = ?", (user_id,))
         first_name = user[0] if user and user[0] else "Пользователь"
         username = user[1] if user and user[1] else "без username"
 
@@ -911,14 +2640,11 @@ async def handle_approve_user(callback: types.CallbackQuery):
         )
 
         # Уведомляем пользователя
-        try:
-            await bot.send_message(
-                user_id,
-                "🎉 Ваш доступ к боту подтвержден администратором!\n"
-                "Теперь вы можете пользоваться всеми функциями."
-            )
-        except Exception as e:
-            logger.error(f"Не удалось уведомить пользователя {user_id}: {e}")
+        notifier.send(
+            user_id,
+            "🎉 Ваш доступ к боту подтвержден администратором!\n"
+            "Теперь вы можете пользоваться всеми функциями."
+        )
 
         # Удаляем сообщение с кнопкой
         await callback.message.delete()
@@ -932,18 +2658,17 @@ async def handle_approve_user(callback: types.CallbackQuery):
 
 
 # Обработчик кнопки запрета доступа пользователя
-@dp.callback_query(F.data.startswith("disapprove_"))
+@admin_router.callback_query(F.data.startswith("disapprove_"))
 async def handle_disapprove_user(callback: types.CallbackQuery):
     try:
         user_id = int(callback.data.split("_")[1])
 
         # Обновляем статус пользователя
-        cursor.execute("UPDATE users SET is_approved = 0 WHERE user_id = ?", (user_id,))
-        conn.commit()
+        await db.execute("UPDATE users SET is_approved = 0 WHERE user_id = ?", (user_id,))
+        invalidate_permissions(user_id)
 
         # Получаем информацию о пользователе
-        cursor.execute("SELECT first_name, username FROM users WHERE user_id = ?", (user_id,))
-        user = cursor.fetchone()
+        user = await db.fetchone("SELECT first_name, username FROM users WHERE user_id = ?", (user_id,))
         first_name = user[0] if user and user[0] else "Пользователь"
         username = user[1] if user and user[1] else "без username"
 
@@ -955,14 +2680,11 @@ async def handle_disapprove_user(callback: types.CallbackQuery):
         )
 
         # Уведомляем пользователя
-        try:
-            await bot.send_message(
-                user_id,
-                "🚫 Ваш доступ к боту был отозван администратором.\n"
-                "Для выяснения причин обратитесь к администратору."
-            )
-        except Exception as e:
-            logger.error(f"Не удалось уведомить пользователя {user_id}: {e}")
+        notifier.send(
+            user_id,
+            "🚫 Ваш доступ к боту был отозван администратором.\n"
+            "Для выяснения причин обратитесь к администратору."
+        )
 
         # Удаляем сообщение с кнопкой
         await callback.message.delete()
@@ -975,16 +2697,15 @@ async def handle_disapprove_user(callback: types.CallbackQuery):
         await callback.answer("❌ Ошибка при запрете доступа")
 
 
-@dp.message(F.text == "👥 Список всех пользователей")
+@admin_router.button("👥 Список всех пользователей")
 @admin_required
 async def list_all_users(message: types.Message):
     try:
-        cursor.execute("""
+        users = await db.fetchall("""
                        SELECT user_id, username, first_name, is_admin, is_banned, is_approved, added_date
                        FROM users
                        ORDER BY added_date DESC
                        """)
-        users = cursor.fetchall()
 
         if not users:
             await message.answer("👥 Пользователей нет в базе данных.")
@@ -1021,12 +2742,12 @@ async def list_all_users(message: types.Message):
 
 
 # Обработчик выбора пользователя из списка
-@dp.callback_query(F.data.startswith("user_"))
+@admin_router.callback_query(F.data.startswith("user_"))
 async def handle_user_selected(callback: types.CallbackQuery):
     try:
         user_id = int(callback.data.split("_")[1])
 
-        cursor.execute("""
+        user = await db.fetchone("""
                        SELECT user_id,
                               username,
                               first_name,
@@ -1038,7 +2759,6 @@ async def handle_user_selected(callback: types.CallbackQuery):
                        FROM users
                        WHERE user_id = ?
                        """, (user_id,))
-        user = cursor.fetchone()
 
         if not user:
             await callback.answer("❌ Пользователь не найден")
@@ -1109,21 +2829,20 @@ async def handle_user_selected(callback: types.CallbackQuery):
         await callback.answer("❌ Ошибка при получении информации")
 
 
-@dp.callback_query(F.data.startswith("promote_"))
+@admin_router.callback_query(F.data.startswith("promote_"))
 async def promote_user_callback(callback: types.CallbackQuery):
     try:
         target_user_id = int(callback.data.split("_")[1])
         admin_id = callback.from_user.id
 
-        if target_user_id == MAIN_ADMIN_ID:
-            await callback.answer("❌ Нельзя изменить статус главного администратора")
+        if target_user_id == club_admin_id():
+            await callback.answer("❌ Нельзя изменить статус администратора клуба")
             return
 
-        cursor.execute("UPDATE users SET is_admin = 1 WHERE user_id = ?", (target_user_id,))
-        conn.commit()
+        await db.execute("UPDATE users SET is_admin = 1 WHERE user_id = ?", (target_user_id,))
+        invalidate_permissions(target_user_id)
 
-        cursor.execute("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
-        user = cursor.fetchone()
+        user = await db.fetchone("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
         first_name = user[0] if user and user[0] else "Пользователь"
         username = user[1] if user and user[1] else "без username"
 
@@ -1133,14 +2852,11 @@ async def promote_user_callback(callback: types.CallbackQuery):
             f"🆔 ID: {target_user_id}"
         )
 
-        try:
-            await bot.send_message(
-                target_user_id,
-                "🎉 Вам предоставлены права администратора!\n"
-                "Теперь вы можете управлять ботом."
-            )
-        except Exception as e:
-            logger.error(f"Не удалось уведомить пользователя {target_user_id}: {e}")
+        notifier.send(
+            target_user_id,
+            "🎉 Вам предоставлены права администратора!\n"
+            "Теперь вы можете управлять ботом."
+        )
 
         await callback.answer()
         await log_action(admin_id, "Назначение администратора", f"ID: {target_user_id}")
@@ -1150,21 +2866,20 @@ async def promote_user_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Ошибка при назначении администратора")
 
 
-@dp.callback_query(F.data.startswith("demote_"))
+@admin_router.callback_query(F.data.startswith("demote_"))
 async def demote_user_callback(callback: types.CallbackQuery):
     try:
         target_user_id = int(callback.data.split("_")[1])
         admin_id = callback.from_user.id
 
-        if target_user_id == MAIN_ADMIN_ID:
-            await callback.answer("❌ Нельзя изменить статус главного администратора")
+        if target_user_id == club_admin_id():
+            await callback.answer("❌ Нельзя изменить статус администратора клуба")
             return
 
-        cursor.execute("UPDATE users SET is_admin = 0 WHERE user_id = ?", (target_user_id,))
-        conn.commit()
+        await db.execute("UPDATE users SET is_admin = 0 WHERE user_id = ?", (target_user_id,))
+        invalidate_permissions(target_user_id)
 
-        cursor.execute("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
-        user = cursor.fetchone()
+        user = await db.fetchone("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
         first_name = user[0] if user and user[0] else "Пользователь"
         username = user[1] if user and user[1] else "без username"
 
@@ -1174,13 +2889,10 @@ async def demote_user_callback(callback: types.CallbackQuery):
             f"🆔 ID: {target_user_id}"
         )
 
-        try:
-            await bot.send_message(
-                target_user_id,
-                "❌ Ваши права администратора были отозваны."
-            )
-        except Exception as e:
-            logger.error(f"Не удалось уведомить пользователя {target_user_id}: {e}")
+        notifier.send(
+            target_user_id,
+            "❌ Ваши права администратора были отозваны."
+        )
 
         await callback.answer()
         await log_action(admin_id, "Снятие прав администратора", f"ID: {target_user_id}")
@@ -1190,21 +2902,20 @@ async def demote_user_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Ошибка при снятии прав администратора")
 
 
-@dp.callback_query(F.data.startswith("ban_"))
+@admin_router.callback_query(F.data.startswith("ban_"))
 async def ban_user_callback(callback: types.CallbackQuery):
     try:
         target_user_id = int(callback.data.split("_")[1])
         admin_id = callback.from_user.id
 
-        if target_user_id == MAIN_ADMIN_ID:
-            await callback.answer("❌ Нельзя заблокировать главного администратора")
+        if target_user_id == club_admin_id():
+            await callback.answer("❌ Нельзя заблокировать администратора клуба")
             return
 
-        cursor.execute("UPDATE users SET is_banned = 1 WHERE user_id = ?", (target_user_id,))
-        conn.commit()
+        await db.execute("UPDATE users SET is_banned = 1 WHERE user_id = ?", (target_user_id,))
+        invalidate_permissions(target_user_id)
 
-        cursor.execute("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
-        user = cursor.fetchone()
+        user = await db.fetchone("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
         first_name = user[0] if user and user[0] else "Пользователь"
         username = user[1] if user and user[1] else "без username"
 
@@ -1214,13 +2925,10 @@ async def ban_user_callback(callback: types.CallbackQuery):
             f"🆔 ID: {target_user_id}"
         )
 
-        try:
-            await bot.send_message(
-                target_user_id,
-                "🚫 Ваш доступ к боту был заблокирован администратором."
-            )
-        except Exception as e:
-            logger.error(f"Не удалось уведомить пользователя {target_user_id}: {e}")
+        notifier.send(
+            target_user_id,
+            "🚫 Ваш доступ к боту был заблокирован администратором."
+        )
 
         await callback.answer()
         await log_action(admin_id, "Блокировка пользователя", f"ID: {target_user_id}")
@@ -1230,17 +2938,16 @@ async def ban_user_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Ошибка при блокировке пользователя")
 
 
-@dp.callback_query(F.data.startswith("unban_"))
+@admin_router.callback_query(F.data.startswith("unban_"))
 async def unban_user_callback(callback: types.CallbackQuery):
     try:
         target_user_id = int(callback.data.split("_")[1])
         admin_id = callback.from_user.id
 
-        cursor.execute("UPDATE users SET is_banned = 0 WHERE user_id = ?", (target_user_id,))
-        conn.commit()
+        await db.execute("UPDATE users SET is_banned = 0 WHERE user_id = ?", (target_user_id,))
+        invalidate_permissions(target_user_id)
 
-        cursor.execute("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
-        user = cursor.fetchone()
+        user = await db.fetchone("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
         first_name = user[0] if user and user[0] else "Пользователь"
         username = user[1] if user and user[1] else "без username"
 
@@ -1250,13 +2957,10 @@ async def unban_user_callback(callback: types.CallbackQuery):
             f"🆔 ID: {target_user_id}"
         )
 
-        try:
-            await bot.send_message(
-                target_user_id,
-                "✅ Ваш доступ к боту был восстановлен администратором."
-            )
-        except Exception as e:
-            logger.error(f"Не удалось уведомить пользователя {target_user_id}: {e}")
+        notifier.send(
+            target_user_id,
+            "✅ Ваш доступ к боту был восстановлен администратором."
+        )
 
         await callback.answer()
         await log_action(admin_id, "Разблокировка пользователя", f"ID: {target_user_id}")
@@ -1266,7 +2970,7 @@ async def unban_user_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Ошибка при разблокировке пользователя")
 
 
-@dp.message(F.text == "👥 Управление пользователями")
+@admin_router.button("👥 Управление пользователями")
 @admin_required
 async def user_management(message: types.Message):
     await message.answer(
@@ -1276,58 +2980,33 @@ async def user_management(message: types.Message):
     )
 
 
-@dp.message(F.text == "👀 Список пользователей")
+@admin_router.button("👀 Список пользователей")
 @admin_required
 async def list_users(message: types.Message):
     await list_all_users(message)
 
 
-@dp.message(F.text == "📊 Статистика")
+@admin_router.button("📊 Статистика")
 @admin_required
 async def admin_stats(message: types.Message):
     try:
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_admin = 1")
-        admin_count = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_banned = 1")
-        banned_count = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_approved = 1")
-        approved_count = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_approved = 0 AND is_banned = 0")
-        pending_count = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM products")
-        total_products = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM products WHERE quantity < 10")
-        low_stock = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM shift_reports")
-        total_reports = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM action_logs WHERE timestamp > datetime('now', '-1 day')")
-        actions_24h = cursor.fetchone()[0]
+        stats = await get_stats()
 
         response = (
             f"📊 Статистика бота:\n\n"
             f"👥 Пользователи:\n"
-            f"├ Всего: {total_users}\n"
-            f"├ Администраторы: {admin_count}\n"
-            f"├ Одобренные: {approved_count}\n"
-            f"├ Ожидают одобрения: {pending_count}\n"
-            f"└ Заблокированы: {banned_count}\n\n"
+            f"├ Всего: {stats['users_total']}\n"
+            f"├ Администраторы: {stats['users_admin']}\n"
+            f"├ Одобренные: {stats['users_approved']}\n"
+            f"├ Ожидают одобрения: {stats['users_pending']}\n"
+            f"└ Заблокированы: {stats['users_banned']}\n\n"
             f"📦 Товары:\n"
-            f"├ Всего: {total_products}\n"
-            f"└ С низким запасом: {low_stock}\n\n"
+            f"├ Всего: {stats['products_total']}\n"
+            f"└ С низким запасом: {stats['products_low_stock']}\n\n"
             f"📝 Отчеты:\n"
-            f"└ Всего отчетов: {total_reports}\n\n"
+            f"└ Всего отчетов: {stats['shift_reports_total']}\n\n"
             f"⚡ Активность:\n"
-            f"└ Действий за 24ч: {actions_24h}"
+            f"└ Действий за 24ч: {stats['actions_24h']}"
         )
 
         await message.answer(response)
@@ -1337,78 +3016,370 @@ async def admin_stats(message: types.Message):
         await message.answer("❌ Ошибка при получении статистики.")
 
 
-@dp.message(F.text == "📋 Логи действий")
+# /metrics - самые медленные обработчики за последние METRICS_WINDOW вызовов
+@admin_router.message(Command("metrics"))
 @admin_required
-async def view_logs(message: types.Message):
+async def view_handler_metrics(message: types.Message):
     try:
-        cursor.execute("""
-                       SELECT al.action, al.details, al.timestamp, u.first_name, u.username
-                       FROM action_logs al
-                                LEFT JOIN users u ON al.user_id = u.user_id
-                       ORDER BY al.timestamp DESC LIMIT 20
-                       """)
-        logs = cursor.fetchall()
-
-        if not logs:
-            await message.answer("📋 Логи действий пусты.")
+        rows = handler_metrics.summary()
+        if not rows:
+            await message.answer("📭 Обработчики ещё не вызывались.")
             return
 
-        response = "📋 Последние 20 действий:\n\n"
-        for log in logs:
-            username = f"@{log[4]}" if log[4] else "без username"
-            first_name = log[3] or "Неизвестно"
+        response = "⏱ Обработчики (p50 / p95 за последние вызовы):\n\n"
+        for p95, name, stats, p50, window_sql, window_sql_time in rows:
             response += (
-                f"⚡ {log[0]}\n"
-                f"👤 {first_name} ({username})\n"
-                f"📝 {log[1]}\n"
-                f"🕐 {log[2]}\n\n"
+                f"🔹 {name}\n"
+                f"├ Вызовов: {stats.count}, ошибок: {stats.errors}\n"
+                f"├ Время: {p50 * 1000:.0f} / {p95 * 1000:.0f} мс\n"
+                f"├ SQL за вызов: {window_sql:.1f}, "
+                f"в базе: {window_sql_time * 1000:.1f} мс\n"
+                f"└ Вызовов API: {stats.api_calls}\n\n"
             )
+        calls = ", ".join(f"{method}: {count}" for method, count in handler_metrics.api_calls.most_common(5))
+        response += f"📡 Bot API: {calls or 'нет вызовов'}"
 
-        if len(response) > 4000:
-            for i in range(0, len(response), 4000):
-                await message.answer(response[i:i + 4000])
-        else:
-            await message.answer(response)
+        await message.answer(response[:MESSAGE_MAX_LENGTH])
 
     except Exception as e:
-        logger.error(f"Ошибка при получении логов: {e}")
-        await message.answer("❌ Ошибка при получении логов.")
+        logger.error(f"Ошибка при получении метрик: {e}")
+        await message.answer("❌ Ошибка при получении метрик.")
+
+
+# ===== ПРОСМОТР ЖУРНАЛА ДЕЙСТВИЙ =====
+# Страница журнала выбирается по ключу (timestamp, id) крайней показанной
+# записи. Для любого сочетания фильтров есть подходящий индекс (по времени,
+# по пользователю или по типу действия), поэтому стоимость страницы не
+# зависит от размера таблицы. Текущие фильтры администратора хранятся в
+# данных FSM под ключом log_filters.
+LOGS_PAGE_SIZE = 10
+LOG_FILTER_PATTERN = re.compile(r'(user|action|from|to)=("[^"]*"|\S+)')
+LOG_FILTERS_HELP = (
+    "Фильтры: /logs user=ID|@username action=\"Тип действия\" "
+    "from=ГГГГ-ММ-ДД to=ГГГГ-ММ-ДД"
+)
 
 
-# Обработчики для управления пользователями
-@dp.message(F.text == "⚡ Назначить админа")
-@admin_required
-async def promote_user_start(message: types.Message):
-    user_states[message.from_user.id] = "promoting_user"
-    await message.answer("Введите ID пользователя для назначения администратором:", reply_markup=get_cancel_keyboard())
+async def parse_log_filters(text):
+    """Разбирает аргументы /logs; возвращает (фильтры, текст ошибки)."""
+    filters = {}
+    for key, value in LOG_FILTER_PATTERN.findall(text):
+        value = value.strip('"')
+        if key == "user":
+            if value.isdigit():
+                filters["user_id"] = int(value)
+            else:
+                row = await db.fetchone("SELECT user_id FROM users WHERE username = ?", (value.lstrip("@"),))
+                if not row:
+                    return None, f"❌ Пользователь {value} не найден"
+                filters["user_id"] = row[0]
+        elif key == "action":
+            filters["action"] = value
+        else:
+            try:
+                datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                return None, "❌ Неверный формат даты. Используйте ГГГГ-ММ-ДД"
+            filters["date_from" if key == "from" else "date_to"] = value
+    return filters, None
+
+
+def log_filter_conditions(filters):
+    conditions, params = [], []
+    if filters.get("user_id"):
+        conditions.append("al.user_id = ?")
+        params.append(filters["user_id"])
+    if filters.get("action"):
+        conditions.append("al.action = ?")
+        params.append(filters["action"])
+    if filters.get("date_from"):
+        conditions.append("al.timestamp >= ?")
+        params.append(filters["date_from"])
+    if filters.get("date_to"):
+        conditions.append("al.timestamp < date(?, '+1 day')")
+        params.append(filters["date_to"])
+    return conditions, params
+
+
+def describe_log_filters(filters):
+    parts = []
+    if filters.get("user_id"):
+        parts.append(f"👤 {filters['user_id']}")
+    if filters.get("action"):
+        parts.append(f"⚡ {filters['action']}")
+    if filters.get("date_from") or filters.get("date_to"):
+        parts.append(f"📅 {filters.get('date_from', '...')} — {filters.get('date_to', '...')}")
+    return ", ".join(parts)
+
+
+async def fetch_logs_page(filters, direction="next", key=None, page_size=LOGS_PAGE_SIZE):
+    """Возвращает (записи, есть_новее, есть_старше) для одной страницы журнала."""
+    conditions, params = log_filter_conditions(filters)
+    backward = direction == "prev"
+    if key is not None:
+        conditions.append(f"(al.timestamp, al.id) {'>' if backward else '<'} (?, ?)")
+        params.extend(key)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    order = "ASC" if backward else "DESC"
+
+    logs = await db.fetchall(
+        f"""
+        SELECT al.id, al.action, al.details, al.timestamp, u.first_name, u.username
+        FROM action_logs al
+                 LEFT JOIN users u ON al.user_id = u.user_id
+        {where}
+        ORDER BY al.timestamp {order}, al.id {order}
+        LIMIT ?
+        """,
+        (*params, page_size + 1)
+    )
+    has_more = len(logs) > page_size
+    logs = logs[:page_size]
+
+    if backward:
+        logs.reverse()
+        return logs, has_more, True
+    return logs, key is not None, has_more
+
+
+async def render_logs_page(filters, direction="next", key=None, page=1):
+    """Собирает текст и inline-клавиатуру страницы журнала; None, если записей нет."""
+    logs, has_newer, has_older = await fetch_logs_page(filters, direction, key)
+    if not logs and key is not None:
+        logs, has_newer, has_older = await fetch_logs_page(filters)
+        page = 1
+    if not logs:
+        return None, None
+
+    response = f"📋 Журнал действий (стр. {page}):\n"
+    if filters:
+        response += f"🔎 {describe_log_filters(filters)}\n"
+    response += "\n"
+    for log in logs:
+        username = f"@{log[5]}" if log[5] else "без username"
+        first_name = log[4] or "Неизвестно"
+        response += (
+            f"⚡ {log[1]}\n"
+            f"👤 {first_name} ({username})\n"
+            f"📝 {log[2]}\n"
+            f"🕐 {log[3]}\n\n"
+        )
+    if page == 1 and not filters:
+        response += LOG_FILTERS_HELP
+
+    navigation = []
+    if has_newer:
+        navigation.append(InlineKeyboardButton(
+            text="⬅️ Новее", callback_data=f"logs:prev:{page - 1}:{logs[0][3]}:{logs[0][0]}"
+        ))
+    if has_older:
+        navigation.append(InlineKeyboardButton(
+            text="Старее ➡️", callback_data=f"logs:next:{page + 1}:{logs[-1][3]}:{logs[-1][0]}"
+        ))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton(text="📄 Скачать CSV", callback_data="logs_csv")])
+
+    return response[:MESSAGE_MAX_LENGTH], InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+async def send_logs_page(message: types.Message, filters):
+    text, keyboard = await render_logs_page(filters)
+    if text is None:
+        await message.answer("📋 Записей не найдено." if filters else "📋 Логи действий пусты.")
+        return
+    await message.answer(text, reply_markup=keyboard)
 
 
-@dp.message(F.text == "🚫 Заблокировать")
+@admin_router.button("📋 Логи действий")
 @admin_required
-async def ban_user_start(message: types.Message):
-    user_states[message.from_user.id] = "banning_user"
-    await message.answer("Введите ID пользователя для блокировки:", reply_markup=get_cancel_keyboard())
-
+async def view_logs(message: types.Message, state: FSMContext):
+    try:
+        await state.update_data(log_filters={})
+        await send_logs_page(message, {})
 
-@dp.message(F.text == "✅ Разблокировать")
-@admin_required
-async def unban_user_start(message: types.Message):
-    user_states[message.from_user.id] = "unbanning_user"
-    await message.answer("Введите ID пользователя для разблокировки:", reply_markup=get_cancel_keyboard())
+    except Exception as e:
+        logger.error(f"Ошибка при получении логов: {e}")
+        await message.answer("❌ Ошибка при получении логов.")
 
 
-@dp.message(F.text == "❌ Снять админа")
+# /logs user=ID action="Тип" from=ГГГГ-ММ-ДД to=ГГГГ-ММ-ДД - журнал с фильтрами
+@admin_router.message(Command("logs"))
 @admin_required
-async def demote_user_start(message: types.Message):
-    user_states[message.from_user.id] = "demoting_user"
-    await message.answer("Введите ID пользователя для снятия прав администратора:", reply_markup=get_cancel_keyboard())
+async def view_filtered_logs(message: types.Message, state: FSMContext):
+    try:
+        filters, error = await parse_log_filters(message.text)
+        if error:
+            await message.answer(f"{error}\n\n{LOG_FILTERS_HELP}")
+            return
+
+        await state.update_data(log_filters=filters)
+        await send_logs_page(message, filters)
+
+    except Exception as e:
+        logger.error(f"Ошибка при получении логов: {e}")
+        await message.answer("❌ Ошибка при получении логов.")
+
+
+# Листание журнала: logs:<направление>:<номер страницы>:<timestamp>:<id>
+@admin_router.callback_query(F.data.startswith("logs:"))
+@admin_required
+async def logs_page_handler(callback: types.CallbackQuery, state: FSMContext):
+    try:
+        _, direction, page, cursor = callback.data.split(":", 3)
+        timestamp, log_id = cursor.rsplit(":", 1)
+        filters = (await state.get_data()).get("log_filters", {})
+
+        text, keyboard = await render_logs_page(filters, direction, (timestamp, int(log_id)), int(page))
+        if text is None:
+            await callback.message.edit_text("📋 Записей не найдено.")
+        else:
+            await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.answer()
+
+    except Exception as e:
+        logger.error(f"Ошибка при листании журнала действий: {e}")
+        await callback.answer("❌ Ошибка при загрузке страницы")
+
+
+def build_logs_csv(path, filters):
+    """Построчно записывает отфильтрованный журнал в CSV и возвращает число записей."""
+    conditions, params = log_filter_conditions(filters)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    conn = connect_db(get_current_club().path)
+    try:
+        cursor = conn.execute(
+            f"""
+            SELECT al.id, al.timestamp, al.user_id, u.first_name, u.username, al.action, al.details
+            FROM action_logs al
+                     LEFT JOIN users u ON al.user_id = u.user_id
+            {where}
+            ORDER BY al.timestamp DESC, al.id DESC
+            """,
+            params
+        )
+        count = 0
+        with open(path, "w", newline="", encoding="utf-8-sig") as file:
+            writer = csv.writer(file, delimiter=";")
+            writer.writerow(["id", "timestamp", "user_id", "first_name", "username", "action", "details"])
+            while rows := cursor.fetchmany(1000):
+                writer.writerows(rows)
+                count += len(rows)
+        return count
+    finally:
+        conn.close()
+
+
+@admin_router.callback_query(F.data == "logs_csv")
+@admin_required
+async def export_logs_csv(callback: types.CallbackQuery, state: FSMContext):
+    filters = (await state.get_data()).get("log_filters", {})
+    path = get_current_club().export_dir / f"logs_{callback.from_user.id}_{int(time.time())}.csv"
+
+    try:
+        await callback.answer("⏳ Формирование CSV...")
+        # Сборка делит ограничение параллельных выгрузок с экспортом в Excel
+        async with export_jobs.semaphore:
+            count = await asyncio.to_thread(build_logs_csv, path, filters)
+
+        caption = f"📄 Журнал действий: {count} записей"
+        if filters:
+            caption += f"\n🔎 {describe_log_filters(filters)}"
+        await callback.message.answer_document(
+            document=FSInputFile(path, filename=f"журнал_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.csv"),
+            caption=caption
+        )
+        await log_action(callback.from_user.id, "Экспорт журнала действий", f"Записей: {count}")
+
+    except Exception as e:
+        logger.error(f"Ошибка экспорта журнала действий: {e}")
+        await callback.message.answer("❌ Ошибка при экспорте журнала действий.")
+
+    finally:
+        path.unlink(missing_ok=True)
+
+
+# /logs_archive - список архивных месяцев, /logs_archive ГГГГ-ММ - последние записи месяца
+@admin_router.message(Command("logs_archive"))
+@admin_required
+async def view_archived_logs(message: types.Message):
+    args = message.text.split()[1:]
+
+    try:
+        if not args:
+            months = list_archive_months()
+            if not months:
+                await message.answer("🗄 Архив журнала действий пуст.")
+                return
+            await message.answer(
+                "🗄 Архив журнала действий:\n" + "\n".join(f"▪️ {month}" for month in months) +
+                "\n\nДля просмотра: /logs_archive ГГГГ-ММ"
+            )
+            return
+
+        month = args[0]
+        if not re.fullmatch(r"\d{4}-\d{2}", month):
+            await message.answer("❌ Укажите месяц в формате ГГГГ-ММ, например: /logs_archive 2024-01")
+            return
+
+        logs = await fetch_archived_logs(month)
+        if not logs:
+            await message.answer(f"📭 В архиве нет записей за {month}.")
+            return
+
+        response = f"🗄 Последние {len(logs)} действий за {month}:\n\n"
+        for log in logs:
+            username = f"@{log[4]}" if log[4] else "без username"
+            first_name = log[3] or "Неизвестно"
+            response += (
+                f"⚡ {log[0]}\n"
+                f"👤 {first_name} ({username})\n"
+                f"📝 {log[1]}\n"
+                f"🕐 {log[2]}\n\n"
+            )
+
+        for i in range(0, len(response), MESSAGE_MAX_LENGTH):
+            await message.answer(response[i:i + MESSAGE_MAX_LENGTH])
+
+    except Exception as e:
+        logger.error(f"Ошибка при получении архива логов: {e}")
+        await message.answer("❌ Ошибка при получении архива логов.")
+
+
+# Обработчики для управления пользователями
+@admin_router.button("⚡ Назначить админа")
+@admin_required
+async def promote_user_start(message: types.Message, state: FSMContext):
+    await state.set_state("promoting_user")
+    await message.answer("Введите ID пользователя для назначения администратором:", reply_markup=get_cancel_keyboard())
+
+
+@admin_router.button("🚫 Заблокировать")
+@admin_required
+async def ban_user_start(message: types.Message, state: FSMContext):
+    await state.set_state("banning_user")
+    await message.answer("Введите ID пользователя для блокировки:", reply_markup=get_cancel_keyboard())
+
+
+@admin_router.button("✅ Разблокировать")
+@admin_required
+async def unban_user_start(message: types.Message, state: FSMContext):
+    await state.set_state("unbanning_user")
+    await message.answer("Введите ID пользователя для разблокировки:", reply_markup=get_cancel_keyboard())
+
+
+@admin_router.button("❌ Снять админа")
+@admin_required
+async def demote_user_start(message: types.Message, state: FSMContext):
+    await state.set_state("demoting_user")
+    await message.answer("Введите ID пользователя для снятия прав администратора:", reply_markup=get_cancel_keyboard())
 
 
 # Обработчики ввода ID пользователей для управления
-@dp.message(F.text, lambda message: user_states.get(message.from_user.id) == "promoting_user")
-async def promote_user_execute(message: types.Message):
+@admin_router.state("promoting_user")
+async def promote_user_execute(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
-        user_states[message.from_user.id] = None
+        await state.set_state(None)
         await message.answer("❌ Назначение администратора отменено", reply_markup=get_user_management_keyboard())
         return
 
@@ -1420,14 +3391,13 @@ async def promote_user_execute(message: types.Message):
     admin_id = message.from_user.id
 
     try:
-        cursor.execute("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
-        user = cursor.fetchone()
+        user = await db.fetchone("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
 
         if not user:
             await message.answer("❌ Пользователь не найден в базе данных.", reply_markup=get_cancel_keyboard())
         else:
-            cursor.execute("UPDATE users SET is_admin = 1 WHERE user_id = ?", (target_user_id,))
-            conn.commit()
+            await db.execute("UPDATE users SET is_admin = 1 WHERE user_id = ?", (target_user_id,))
+            invalidate_permissions(target_user_id)
 
             username = f"@{user[1]}" if user[1] else "без username"
             await message.answer(f"✅ Пользователь {user[0]} ({username}) назначен администратором.",
@@ -1435,22 +3405,19 @@ async def promote_user_execute(message: types.Message):
             await log_action(admin_id, "Назначение администратора",
                              f"Пользователь ID {target_user_id} назначен админом")
 
-            try:
-                await bot.send_message(target_user_id, "🎉 Вам предоставлены права администратора!")
-            except:
-                pass
+            notifier.send(target_user_id, "🎉 Вам предоставлены права администратора!")
 
     except Exception as e:
         logger.error(f"Ошибка при назначении админа: {e}")
         await message.answer("❌ Ошибка при назначении администратора.", reply_markup=get_cancel_keyboard())
     finally:
-        user_states[message.from_user.id] = None
+        await state.set_state(None)
 
 
-@dp.message(F.text, lambda message: user_states.get(message.from_user.id) == "banning_user")
-async def ban_user_execute(message: types.Message):
+@admin_router.state("banning_user")
+async def ban_user_execute(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
-        user_states[message.from_user.id] = None
+        await state.set_state(None)
         await message.answer("❌ Блокировка пользователя отменена", reply_markup=get_user_management_keyboard())
         return
 
@@ -1461,42 +3428,38 @@ async def ban_user_execute(message: types.Message):
     target_user_id = int(message.text)
     admin_id = message.from_user.id
 
-    if target_user_id == MAIN_ADMIN_ID:
-        await message.answer("❌ Нельзя заблокировать главного администратора.", reply_markup=get_cancel_keyboard())
-        user_states[message.from_user.id] = None
+    if target_user_id == club_admin_id():
+        await message.answer("❌ Нельзя заблокировать администратора клуба.", reply_markup=get_cancel_keyboard())
+        await state.set_state(None)
         return
 
     try:
-        cursor.execute("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
-        user = cursor.fetchone()
+        user = await db.fetchone("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
 
         if not user:
             await message.answer("❌ Пользователь не найден в базе данных.", reply_markup=get_cancel_keyboard())
         else:
-            cursor.execute("UPDATE users SET is_banned = 1 WHERE user_id = ?", (target_user_id,))
-            conn.commit()
+            await db.execute("UPDATE users SET is_banned = 1 WHERE user_id = ?", (target_user_id,))
+            invalidate_permissions(target_user_id)
 
             username = f"@{user[1]}" if user[1] else "без username"
             await message.answer(f"🚫 Пользователь {user[0]} ({username}) заблокирован.",
                                  reply_markup=get_user_management_keyboard())
             await log_action(admin_id, "Блокировка пользователя", f"Пользователь ID {target_user_id} заблокирован")
 
-            try:
-                await bot.send_message(target_user_id, "🚫 Ваш доступ к боту заблокирован администратором.")
-            except:
-                pass
+            notifier.send(target_user_id, "🚫 Ваш доступ к боту заблокирован администратором.")
 
     except Exception as e:
         logger.error(f"Ошибка при блокировке пользователя: {e}")
         await message.answer("❌ Ошибка при блокировке пользователя.", reply_markup=get_cancel_keyboard())
     finally:
-        user_states[message.from_user.id] = None
+        await state.set_state(None)
 
 
-@dp.message(F.text, lambda message: user_states.get(message.from_user.id) == "unbanning_user")
-async def unban_user_execute(message: types.Message):
+@admin_router.state("unbanning_user")
+async def unban_user_execute(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
-        user_states[message.from_user.id] = None
+        await state.set_state(None)
         await message.answer("❌ Разблокировка пользователя отменена", reply_markup=get_user_management_keyboard())
         return
 
@@ -1508,36 +3471,32 @@ async def unban_user_execute(message: types.Message):
     admin_id = message.from_user.id
 
     try:
-        cursor.execute("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
-        user = cursor.fetchone()
+        user = await db.fetchone("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
 
         if not user:
             await message.answer("❌ Пользователь не найден в базе данных.", reply_markup=get_cancel_keyboard())
         else:
-            cursor.execute("UPDATE users SET is_banned = 0 WHERE user_id = ?", (target_user_id,))
-            conn.commit()
+            await db.execute("UPDATE users SET is_banned = 0 WHERE user_id = ?", (target_user_id,))
+            invalidate_permissions(target_user_id)
 
             username = f"@{user[1]}" if user[1] else "без username"
             await message.answer(f"✅ Пользователь {user[0]} ({username}) разблокирован.",
                                  reply_markup=get_user_management_keyboard())
             await log_action(admin_id, "Разблокировка пользователя", f"Пользователь ID {target_user_id} разблокирован")
 
-            try:
-                await bot.send_message(target_user_id, "✅ Ваш доступ к боту восстановлен!")
-            except:
-                pass
+            notifier.send(target_user_id, "✅ Ваш доступ к боту восстановлен!")
 
     except Exception as e:
         logger.error(f"Ошибка при разблокировке пользователя: {e}")
         await message.answer("❌ Ошибка при разблокировке пользователя.", reply_markup=get_cancel_keyboard())
     finally:
-        user_states[message.from_user.id] = None
+        await state.set_state(None)
 
 
-@dp.message(F.text, lambda message: user_states.get(message.from_user.id) == "demoting_user")
-async def demote_user_execute(message: types.Message):
+@admin_router.state("demoting_user")
+async def demote_user_execute(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
-        user_states[message.from_user.id] = None
+        await state.set_state(None)
         await message.answer("❌ Снятие прав администратора отменено", reply_markup=get_user_management_keyboard())
         return
 
@@ -1548,20 +3507,19 @@ async def demote_user_execute(message: types.Message):
     target_user_id = int(message.text)
     admin_id = message.from_user.id
 
-    if target_user_id == MAIN_ADMIN_ID:
-        await message.answer("❌ Нельзя снять права у главного администратора.", reply_markup=get_cancel_keyboard())
-        user_states[message.from_user.id] = None
+    if target_user_id == club_admin_id():
+        await message.answer("❌ Нельзя снять права у администратора клуба.", reply_markup=get_cancel_keyboard())
+        await state.set_state(None)
         return
 
     try:
-        cursor.execute("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
-        user = cursor.fetchone()
+        user = await db.fetchone("SELECT first_name, username FROM users WHERE user_id = ?", (target_user_id,))
 
         if not user:
             await message.answer("❌ Пользователь не найден в базе данных.", reply_markup=get_cancel_keyboard())
         else:
-            cursor.execute("UPDATE users SET is_admin = 0 WHERE user_id = ?", (target_user_id,))
-            conn.commit()
+            await db.execute("UPDATE users SET is_admin = 0 WHERE user_id = ?", (target_user_id,))
+            invalidate_permissions(target_user_id)
 
             username = f"@{user[1]}" if user[1] else "без username"
             await message.answer(f"❌ У пользователя {user[0]} ({username}) сняты права администратора.",
@@ -1569,32 +3527,414 @@ async def demote_user_execute(message: types.Message):
             await log_action(admin_id, "Снятие прав администратора",
                              f"У пользователя ID {target_user_id} сняты права админа")
 
-            try:
-                await bot.send_message(target_user_id, "❌ Ваши права администратора отозваны.")
-            except:
-                pass
+            notifier.send(target_user_id, "❌ Ваши права администратора отозваны.")
 
     except Exception as e:
         logger.error(f"Ошибка при снятии прав администратора: {e}")
         await message.answer("❌ Ошибка при снятии прав администратора.", reply_markup=get_cancel_keyboard())
     finally:
-        user_states[message.from_user.id] = None
+        await state.set_state(None)
 
 
 # Навигация админ-панели
-@dp.message(F.text == "🔙 Назад в админ-панель")
+@admin_router.button("🔙 Назад в админ-панель")
 @admin_required
 async def back_to_admin_panel(message: types.Message):
     await message.answer("👑 Панель администратора", reply_markup=get_admin_keyboard())
 
 
-@dp.message(F.text == "🔙 Назад в главное меню")
+@admin_router.button("🔙 Назад в главное меню")
 async def back_to_main_menu_from_admin(message: types.Message):
-    await message.answer("Главное меню:", reply_markup=get_main_keyboard(message.from_user.id))
+    await message.answer("Главное меню:", reply_markup=await get_main_keyboard(message.from_user.id))
+
+
+# ===== УПРАВЛЕНИЕ КЛУБАМИ =====
+# Команды владельца бота (MAIN_ADMIN_ID): список клубов и создание нового.
+# База клуба создаётся при первом обращении, сотрудники подключаются по
+# ссылке-приглашению t.me/<бот>?start=<код> или командой /start <код>.
+@admin_router.message(Command("clubs"))
+@admin_required
+async def list_clubs(message: types.Message):
+    if message.from_user.id != MAIN_ADMIN_ID:
+        await message.answer("❌ Управлять клубами может только владелец бота.")
+        return
+
+    response = f"🏢 Клубы ({len(clubs.clubs)}), открыто баз: {len(clubs.open)} из {clubs.max_open}\n\n"
+    for slug, info in sorted(clubs.clubs.items()):
+        response += f"{'🟢' if slug in clubs.open else '⚪️'} {info.name} - код: {slug}, администратор: {info.admin_id}\n"
+    response += "\nНовый клуб: /club_add код ID_администратора Название"
+    await message.answer(response)
+
+
+# /club_add код ID_администратора Название - регистрирует клуб с отдельной базой
+@admin_router.message(Command("club_add"))
+@admin_required
+async def add_club(message: types.Message):
+    if message.from_user.id != MAIN_ADMIN_ID:
+        await message.answer("❌ Управлять клубами может только владелец бота.")
+        return
+
+    args = message.text.split(maxsplit=3)[1:]
+    if len(args) < 3 or not args[1].isdigit() or not CLUB_SLUG_PATTERN.match(args[0]):
+        await message.answer(
+            "❌ Формат: /club_add код ID_администратора Название\n"
+            "Код - 2-32 символа: латинские строчные буквы, цифры, _ и -."
+        )
+        return
+
+    slug, admin_id, name = args[0], int(args[1]), args[2].strip()
+    if slug in clubs.clubs:
+        await message.answer(f"❌ Клуб с кодом {slug} уже есть.")
+        return
+
+    try:
+        await clubs.add(slug, name, admin_id)
+        await message.answer(
+            f"✅ Клуб '{name}' создан!\n"
+            f"Администратор: {admin_id}\n"
+            f"Сотрудники подключаются командой /start {slug} "
+            f"или по ссылке t.me/<имя бота>?start={slug}"
+        )
+        await log_action(message.from_user.id, "Создание клуба", f"{slug} - {name}, администратор {admin_id}")
+    except Exception as e:
+        logger.error(f"Ошибка создания клуба {slug}: {e}")
+        await message.answer("❌ Ошибка при создании клуба!")
+
+
+# Сотрудник одного клуба, открывший ссылку другого, остаётся в своём клубе,
+# пока администратор нового клуба не подтвердит переход командой
+# /club_transfer ID. Иначе любой мог бы сам перейти в любой клуб по коду.
+async def request_club_transfer(bot: Bot, user: types.User, slug):
+    await clubs.request_transfer(user.id, slug)
+    info = clubs.clubs[slug]
+    await bot.send_message(
+        user.id,
+        f"📨 Запрос на переход в клуб '{info.name}' отправлен его администратору.\n"
+        f"До одобрения вы остаётесь в своём текущем клубе."
+    )
+    notifier.send(
+        info.admin_id,
+        f"🔁 Сотрудник другого клуба просит перевести его в ваш клуб!\n"
+        f"🆔 ID: {user.id}\n"
+        f"👨‍💼 Имя: {user.first_name}\n"
+        f"📎 Username: @{user.username}\n\n"
+        f"Для перевода: /club_transfer {user.id}"
+    )
+    logger.info(f"Запрос на переход пользователя {user.id} в клуб {slug}")
+
+
+@admin_router.message(Command("club_transfer"))
+@admin_required
+async def approve_club_transfer(message: types.Message):
+    args = message.text.split()[1:]
+    if not args or not args[0].isdigit():
+        await message.answer("❌ Формат: /club_transfer ID_пользователя")
+        return
+
+    user_id = int(args[0])
+    club = get_current_club()
+    try:
+        if not await clubs.complete_transfer(user_id, club.slug):
+            await message.answer("❌ Этот пользователь не просил о переходе в ваш клуб.")
+            return
+
+        await message.answer(f"✅ Пользователь {user_id} переведён в клуб. Подтвердите его доступ после регистрации.")
+        notifier.send(user_id, f"✅ Переход в клуб '{club.name}' одобрен. Отправьте /start для регистрации.")
+        await log_action(message.from_user.id, "Перевод в клуб", f"Пользователь {user_id}")
+    except Exception as e:
+        logger.error(f"Ошибка перевода пользователя {user_id} в клуб {club.slug}: {e}")
+        await message.answer("❌ Ошибка при переводе пользователя!")
+
+
+# ===== ДВИЖЕНИЕ ТОВАРОВ =====
+# Остаток меняется только движением из журнала stock_movements: приход,
+# продажа, списание или корректировка на величину delta. Изменение
+# quantity = quantity + delta и запись в журнал идут в одной транзакции,
+# поэтому одновременные правки одного товара не затирают друг друга.
+STOCK_MOVEMENT_KINDS = {
+    "📥 Приход": "receipt",
+    "📤 Продажа": "sale",
+    "🗑 Списание": "writeoff",
+    "✏️ Корректировка": "correction",
+}
+STOCK_MOVEMENT_NAMES = {
+    "receipt": "Приход",
+    "sale": "Продажа",
+    "writeoff": "Списание",
+    "correction": "Корректировка",
+}
+STOCK_HISTORY_LIMIT = 10
+
+
+def get_stock_movement_keyboard():
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="📥 Приход"), KeyboardButton(text="📤 Продажа")],
+            [KeyboardButton(text="🗑 Списание"), KeyboardButton(text="✏️ Корректировка")],
+            [KeyboardButton(text="❌ Отмена")]
+        ],
+        resize_keyboard=True
+    )
+
+
+def _apply_stock_movement(conn, product_id, kind, delta, user_id, comment):
+    row = conn.execute(
+        "UPDATE products SET quantity = quantity + ? WHERE id = ? AND quantity + ? >= 0 "
+        "RETURNING quantity, reorder_threshold",
+        (delta, product_id, delta)
+    ).fetchone()
+    if row is None:
+        return None
+    conn.execute(
+        "INSERT INTO stock_movements (product_id, kind, delta, quantity_after, user_id, comment) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (product_id, kind, delta, row[0], user_id, comment)
+    )
+    return row
+
+
+async def apply_stock_movement(product_id, kind, delta, user_id=None, comment=None):
+    """Применяет движение; возвращает (новый остаток, порог) или None, если
+    товара нет или остаток ушёл бы в минус."""
+    result = await db.transaction(_apply_stock_movement, product_id, kind, delta, user_id, comment)
+    stock_alerts.wake()
+    return result
+
+
+def _add_product(conn, name, quantity, category, user_id):
+    """Добавляет товар с порогом его категории; возвращает (id, порог)."""
+    product_id, threshold = conn.execute(
+        "INSERT INTO products (name, quantity, category, reorder_threshold) "
+        "VALUES (?, ?, ?, COALESCE((SELECT threshold FROM category_thresholds WHERE category = ?), ?)) "
+        "RETURNING id, reorder_threshold",
+        (name, quantity, category, category, DEFAULT_REORDER_THRESHOLD)
+    ).fetchone()
+    conn.execute(
+        "INSERT INTO stock_movements (product_id, kind, delta, quantity_after, user_id, comment) "
+        "VALUES (?, 'receipt', ?, ?, ?, 'Добавление товара')",
+        (product_id, quantity, quantity, user_id)
+    )
+    return product_id, threshold
+
+
+async def get_stock_at(product_id, day):
+    """Остаток товара на конец дня day (ГГГГ-ММ-ДД) или None, если товара ещё не было."""
+    # created_at хранится в UTC, а день - местный: конец дня переводим в UTC
+    row = await db.fetchone(
+        "SELECT quantity_after FROM stock_movements "
+        "WHERE product_id = ? AND created_at < datetime(date(?, '+1 day'), 'utc') "
+        "ORDER BY created_at DESC, id DESC LIMIT 1",
+        (product_id, day)
+    )
+    return row[0] if row else None
+
+
+async def fetch_stock_history(product_id, limit=STOCK_HISTORY_LIMIT):
+    return await db.fetchall(
+        "SELECT sm.kind, sm.delta, sm.quantity_after, sm.comment, "
+        "datetime(sm.created_at, 'localtime'), u.first_name "
+        "FROM stock_movements sm LEFT JOIN users u ON u.user_id = sm.user_id "
+        "WHERE sm.product_id = ? ORDER BY sm.created_at DESC, sm.id DESC LIMIT ?",
+        (product_id, limit)
+    )
+
+
+
+async def send_stock_history(message: types.Message, product_id, day=None):
+    product = await db.fetchone("SELECT name, quantity FROM products WHERE id = ?", (product_id,))
+    if not product:
+        await message.answer("❌ Товар не найден!")
+        return
+
+    response = f"📜 {product[0]} (ID: {product_id})\nТекущий остаток: {product[1]} шт.\n"
+    if day:
+        stock = await get_stock_at(product_id, day)
+        response += f"Остаток на конец {day}: {f'{stock} шт.' if stock is not None else 'товара ещё не было'}\n"
+
+    history = await fetch_stock_history(product_id)
+    if history:
+        response += "\nПоследние движения:\n"
+        for kind, delta, quantity_after, comment, created_at, first_name in history:
+            response += (
+                f"• {created_at[:16]} {STOCK_MOVEMENT_NAMES.get(kind, kind)} {delta:+d} → {quantity_after}"
+                f"{f' ({first_name})' if first_name else ''}{f' - {comment}' if comment else ''}\n"
+            )
+    await message.answer(response)
+
+
+# /stock ID [ГГГГ-ММ-ДД] - движения товара и остаток на конец указанного дня
+@warehouse_router.message(Command("stock"))
+@access_required
+async def view_stock_history(message: types.Message):
+    args = message.text.split()[1:]
+    try:
+        product_id = int(args[0])
+        day = args[1] if len(args) > 1 else None
+        if day:
+            datetime.strptime(day, '%Y-%m-%d')
+    except (IndexError, ValueError):
+        await message.answer("❌ Формат: /stock ID [ГГГГ-ММ-ДД]")
+        return
+
+    try:
+        await send_stock_history(message, product_id, day)
+    except Exception as e:
+        logger.error(f"Ошибка при получении движения товара: {e}")
+        await message.answer("❌ Ошибка при получении движения товара.")
+
+
+
+# ===== ПОРОГИ ЗАКАЗА И УВЕДОМЛЕНИЯ ОБ ОСТАТКАХ =====
+# Товар считается заканчивающимся, когда quantity < reorder_threshold. Порог
+# задаётся товару вручную или наследуется от категории (category_thresholds),
+# иначе равен DEFAULT_REORDER_THRESHOLD. Триггеры добавляют строку в
+# stock_alerts только в момент перехода товара ниже порога, поэтому на одно
+# снижение приходит одно уведомление, а проверка стоит O(1) на запись.
+# StockAlertDispatcher забирает новые строки сразу после изменений через
+# бота и раз в STOCK_ALERT_POLL_INTERVAL секунд - на случай прямых записей.
+DEFAULT_REORDER_THRESHOLD = 10  # совпадает со значением по умолчанию в миграции №10
+STOCK_ALERT_POLL_INTERVAL = 60
+STOCK_ALERT_BATCH = 50
+
+
+def _take_stock_alerts(conn, limit):
+    rows = conn.execute(
+        "SELECT a.id, a.product_id, p.name, a.quantity, a.threshold "
+        "FROM stock_alerts a LEFT JOIN products p ON p.id = a.product_id "
+        "WHERE a.sent_at IS NULL ORDER BY a.id LIMIT ?",
+        (limit,)
+    ).fetchall()
+    conn.executemany("UPDATE stock_alerts SET sent_at = CURRENT_TIMESTAMP WHERE id = ?", [(row[0],) for row in rows])
+    return rows
+
+
+class StockAlertDispatcher:
+    def __init__(self, interval=STOCK_ALERT_POLL_INTERVAL, batch_size=STOCK_ALERT_BATCH):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.sent_count = 0
+        self._wakeup = asyncio.Event()
+        self._woken = set()  # клубы, в которых могли появиться уведомления
+        self._task = None
+
+    def wake(self, slug=None):
+        self._woken.add(slug or get_current_club().slug)
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def dispatch(self):
+        """Отправляет все новые уведомления об остатках; возвращает их число."""
+        total = 0
+        while True:
+            alerts = await db.transaction(_take_stock_alerts, self.batch_size)
+            # Товары, удалённые до отправки, пропускаем
+            lines = [
+                f"▪️ {name} (ID: {product_id})\nОсталось: {quantity} шт., порог: {threshold}"
+                for _, product_id, name, quantity, threshold in alerts if name is not None
+            ]
+            if lines:
+                chat_id = (await get_notification_chat("stock") or await get_notification_chat("actions")
+                           or club_admin_id())
+                notifier.send(chat_id, "🚨 Заканчиваются товары:\n\n" + "\n\n".join(lines))
+                total += len(lines)
+            if len(alerts) < self.batch_size:
+                break
+        self.sent_count += total
+        return total
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                # Опрос на случай записей мимо бота - по всем открытым клубам
+                self._woken.update(clubs.open)
+            self._wakeup.clear()
+            woken, self._woken = self._woken, set()
+            for slug in woken:
+                try:
+                    async with clubs.use(slug):
+                        await self.dispatch()
+                except Exception as e:
+                    logger.error(f"Ошибка отправки уведомлений об остатках клуба {slug}: {e}")
+
+
+stock_alerts = StockAlertDispatcher()
+
+
+async def reset_product_threshold(product_id):
+    await db.execute(
+        "UPDATE products SET threshold_custom = 0, "
+        "reorder_threshold = COALESCE((SELECT threshold FROM category_thresholds "
+        "WHERE category = products.category), ?) WHERE id = ?",
+        (DEFAULT_REORDER_THRESHOLD, product_id)
+    )
+    stock_alerts.wake()
+
+
+async def set_product_threshold(product_id, threshold):
+    await db.execute(
+        "UPDATE products SET reorder_threshold = ?, threshold_custom = 1 WHERE id = ?",
+        (threshold, product_id)
+    )
+    stock_alerts.wake()
+
+
+# /threshold - пороги категорий; /threshold Категория N - задать, /threshold Категория сброс - убрать
+@warehouse_router.message(Command("threshold"))
+@admin_required
+async def category_threshold_command(message: types.Message):
+    user_id = message.from_user.id
+    args = message.text.split(maxsplit=1)[1:]
+    try:
+        if not args:
+            rows = await db.fetchall("SELECT category, threshold FROM category_thresholds ORDER BY category")
+            response = f"🎯 Порог по умолчанию: {DEFAULT_REORDER_THRESHOLD} шт.\n"
+            if rows:
+                response += "\nПороги категорий:\n" + "\n".join(f"• {category}: {threshold} шт." for category, threshold in rows)
+            response += "\n\nФормат: /threshold Категория N или /threshold Категория сброс"
+            await message.answer(response)
+            return
+
+        category, _, value = args[0].rpartition(" ")
+        if not category or not (value.isdigit() or value.lower() == "сброс"):
+            await message.answer("❌ Формат: /threshold Категория N или /threshold Категория сброс")
+            return
+
+        if value.lower() == "сброс":
+            await db.execute("DELETE FROM category_thresholds WHERE category = ?", (category,))
+            response = f"✅ Для категории '{category}' действует порог по умолчанию: {DEFAULT_REORDER_THRESHOLD} шт."
+        else:
+            await db.execute(
+                "INSERT INTO category_thresholds (category, threshold) VALUES (?, ?) "
+                "ON CONFLICT (category) DO UPDATE SET threshold = excluded.threshold",
+                (category, int(value))
+            )
+            response = f"✅ Порог категории '{category}': {value} шт."
+        stock_alerts.wake()
+
+        await message.answer(response)
+        await log_action(user_id, "Порог категории", f"{category}: {value}")
+
+    except Exception as e:
+        logger.error(f"Ошибка при изменении порога категории: {e}")
+        await message.answer("❌ Ошибка при изменении порога категории.")
 
 
 # ===== Обработчик входа в меню склада =====
-@dp.message(F.text == "📊 Склад")
+@warehouse_router.button("📊 Склад")
 @access_required
 async def warehouse_menu(message: types.Message):
     await message.answer(
@@ -1605,44 +3945,40 @@ async def warehouse_menu(message: types.Message):
 
 
 # ===== ДОБАВЛЕНИЕ ТОВАРА =====
-@dp.message(F.text == "📦 Добавить товар")
+@warehouse_router.button("📦 Добавить товар")
 @access_required
-async def add_product_start(message: types.Message):
+async def add_product_start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    user_states[user_id] = "adding_name"
-    user_data[user_id] = {}
+    await state.set_state("adding_name")
+    await state.set_data({})
     await message.answer("Введите название товара:", reply_markup=get_cancel_keyboard())
 
 
-@dp.message(F.text, lambda message: user_states.get(message.from_user.id) == "adding_name")
-async def add_product_name(message: types.Message):
+@warehouse_router.state("adding_name")
+async def add_product_name(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
-        user_states[message.from_user.id] = None
-        user_data[message.from_user.id] = {}
+        await state.clear()
         await message.answer("❌ Добавление товара отменено", reply_markup=get_warehouse_keyboard())
         return
 
-    user_id = message.from_user.id
-    user_data[user_id]["name"] = message.text
-    user_states[user_id] = "adding_quantity"
+    await state.update_data(name=message.text)
+    await state.set_state("adding_quantity")
     await message.answer("Введите количество товара:", reply_markup=get_cancel_keyboard())
 
 
-@dp.message(F.text, lambda message: user_states.get(message.from_user.id) == "adding_quantity")
-async def add_product_quantity(message: types.Message):
+@warehouse_router.state("adding_quantity")
+async def add_product_quantity(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
-        user_states[message.from_user.id] = None
-        user_data[message.from_user.id] = {}
+        await state.clear()
         await message.answer("❌ Добавление товара отменено", reply_markup=get_warehouse_keyboard())
         return
 
-    user_id = message.from_user.id
     if not message.text.isdigit():
         await message.answer("❌ Ошибка! Введите число для количества.", reply_markup=get_cancel_keyboard())
         return
 
-    user_data[user_id]["quantity"] = int(message.text)
-    user_states[user_id] = "adding_category"
+    await state.update_data(quantity=int(message.text))
+    await state.set_state("adding_category")
     await message.answer(
         "Введите категорию товара (или нажмите 'Пропустить'):",
         reply_markup=ReplyKeyboardMarkup(
@@ -1655,60 +3991,76 @@ async def add_product_quantity(message: types.Message):
     )
 
 
-@dp.message(F.text, lambda message: user_states.get(message.from_user.id) == "adding_category")
-async def add_product_final(message: types.Message):
+@warehouse_router.state("adding_category")
+async def add_product_final(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
-        user_states[message.from_user.id] = None
-        user_data[message.from_user.id] = {}
+        await state.clear()
         await message.answer("❌ Добавление товара отменено", reply_markup=get_warehouse_keyboard())
         return
 
     user_id = message.from_user.id
     category = None if message.text == "Пропустить" else message.text
+    data = await state.get_data()
 
     try:
-        cursor.execute(
-            "INSERT INTO products (name, quantity, category) VALUES (?, ?, ?)",
-            (user_data[user_id]["name"], user_data[user_id]["quantity"], category)
-        )
-        conn.commit()
+        product_id, threshold = await db.transaction(_add_product, data["name"], data["quantity"], category, user_id)
+        stock_alerts.wake()
 
         await message.answer(
             f"✅ Товар успешно добавлен!\n"
-            f"Название: {user_data[user_id]['name']}\n"
-            f"Количество: {user_data[user_id]['quantity']}\n"
+            f"Название: {data['name']}\n"
+            f"Количество: {data['quantity']}\n"
             f"Категория: {category if category else 'не указана'}",
             reply_markup=get_warehouse_keyboard()
         )
 
         await log_action(user_id, "Добавление товара",
-                         f"{user_data[user_id]['name']} (кол-во: {user_data[user_id]['quantity']})")
+                         f"{data['name']} (кол-во: {data['quantity']})")
 
-        if user_data[user_id]["quantity"] < 10:
+        if data["quantity"] < threshold:
             await message.answer(
-                f"⚠️ Внимание! Товар '{user_data[user_id]['name']}' добавлен с низким количеством: {user_data[user_id]['quantity']} шт.",
+                f"⚠️ Внимание! Товар '{data['name']}' добавлен с низким количеством: {data['quantity']} шт.",
                 reply_markup=get_warehouse_keyboard()
             )
     except Exception as e:
         logger.error(f"Ошибка при добавлении товара: {e}")
         await message.answer("❌ Произошла ошибка при добавлении товара!", reply_markup=get_warehouse_keyboard())
     finally:
-        user_states[user_id] = None
-        user_data[user_id] = {}
+        await state.clear()
 
 
 # ===== ПОИСК ТОВАРА =====
-@dp.message(F.text == "🔍 Поиск товара")
+# Поиск по индексу products_fts: каждое слово запроса ищется как префикс,
+# регистр не учитывается, результаты упорядочены по релевантности (bm25).
+async def search_products(search_term, limit=SEARCH_RESULT_LIMIT):
+    words = re.findall(r"\w+", search_term.replace("ё", "е").replace("Ё", "Е"))
+    if not words:
+        return []
+
+    match_query = " ".join(f'"{word}"*' for word in words)
+    return await db.fetchall(
+        """
+        SELECT p.id, p.name, p.quantity, p.category, p.added_date, p.reorder_threshold
+        FROM products_fts
+                 JOIN products p ON p.id = products_fts.rowid
+        WHERE products_fts MATCH ?
+        ORDER BY bm25(products_fts, 10.0, 5.0) LIMIT ?
+        """,
+        (match_query, limit)
+    )
+
+
+@warehouse_router.button("🔍 Поиск товара")
 @access_required
-async def search_product_start(message: types.Message):
-    user_states[message.from_user.id] = "searching"
+async def search_product_start(message: types.Message, state: FSMContext):
+    await state.set_state("searching")
     await message.answer("Введите название товара или категории для поиска:", reply_markup=get_cancel_keyboard())
 
 
-@dp.message(F.text, lambda message: user_states.get(message.from_user.id) == "searching")
-async def search_product_execute(message: types.Message):
+@warehouse_router.state("searching")
+async def search_product_execute(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
-        user_states[message.from_user.id] = None
+        await state.set_state(None)
         await message.answer("❌ Поиск товара отменен", reply_markup=get_warehouse_keyboard())
         return
 
@@ -1716,35 +4068,27 @@ async def search_product_execute(message: types.Message):
     search_term = message.text.strip()
 
     try:
-        cursor.execute("SELECT * FROM products")
-        all_products = cursor.fetchall()
-
-        if not all_products:
-            await message.answer("📭 Склад пуст!", reply_markup=get_warehouse_keyboard())
-            user_states[user_id] = None
-            return
-
-        found_products = []
-        for product in all_products:
-            name_match = search_term.lower() in product[1].lower() if product[1] else False
-            category_match = search_term.lower() in product[3].lower() if product[3] else False
-
-            if name_match or category_match:
-                found_products.append(product)
+        found_products = await search_products(search_term)
 
         if not found_products:
-            await message.answer(f"🔎 По запросу '{search_term}' товары не найдены",
-                                 reply_markup=get_warehouse_keyboard())
-            user_states[user_id] = None
+            if not await db.fetchone("SELECT 1 FROM products LIMIT 1"):
+                await message.answer("📭 Склад пуст!", reply_markup=get_warehouse_keyboard())
+            else:
+                await message.answer(f"🔎 По запросу '{search_term}' товары не найдены",
+                                     reply_markup=get_warehouse_keyboard())
+            await state.set_state(None)
             return
 
         response = f"🔍 Результаты поиска ('{search_term}'):\n\n"
         for product in found_products:
-            response += (f"{'⚠️' if product[2] < 10 else '🔹'} ID: {product[0]}\n"
+            response += (f"{'⚠️' if product[2] < product[5] else '🔹'} ID: {product[0]}\n"
                          f"Название: {product[1]}\n"
                          f"Количество: {product[2]}\n"
                          f"Категория: {product[3] if product[3] else 'не указана'}\n\n")
 
+        if len(found_products) == SEARCH_RESULT_LIMIT:
+            response += f"Показаны первые {SEARCH_RESULT_LIMIT} совпадений, уточните запрос."
+
         if len(response) > 4000:
             for x in range(0, len(response), 4000):
                 await message.answer(response[x:x + 4000])
@@ -1757,192 +4101,419 @@ async def search_product_execute(message: types.Message):
         logger.error(f"Ошибка при поиске товара: {e}")
         await message.answer("❌ Произошла ошибка при поиске товара!", reply_markup=get_warehouse_keyboard())
     finally:
-        user_states[user_id] = None
+        await state.set_state(None)
+
+
+# ===== ПОСТРАНИЧНЫЙ ВЫВОД ТОВАРОВ =====
+# Списки товаров листаются inline-кнопками. Страница выбирается по ключу
+# крайней показанной строки (keyset), поэтому запрос читает не больше
+# PRODUCTS_PAGE_SIZE + 1 строк независимо от номера страницы и размера склада.
+PRODUCTS_PAGE_SIZE = 10
+
+# Ключ сортировки для каждого режима просмотра
+PRODUCT_PAGE_ORDER = {
+    "list": ("quantity", "id"),
+    "edit": ("id",),
+    "delete": ("id",),
+}
+
+
+def product_page_key(mode, product):
+    # product: (id, name, quantity, category, added_date)
+    return (product[2], product[0]) if mode == "list" else (product[0],)
+
+
+async def fetch_products_page(mode, direction="next", key=None, page_size=PRODUCTS_PAGE_SIZE):
+    """Возвращает (товары, есть_предыдущая, есть_следующая) для одной страницы."""
+    columns = PRODUCT_PAGE_ORDER[mode]
+    backward = direction == "prev"
+
+    where = ""
+    params = ()
+    if key is not None:
+        placeholders = ", ".join("?" * len(columns))
+        where = f"WHERE ({', '.join(columns)}) {'<' if backward else '>'} ({placeholders})"
+        params = tuple(key)
+    order = ", ".join(f"{column} DESC" if backward else column for column in columns)
+
+    products = await db.fetchall(
+        f"SELECT id, name, quantity, category, added_date, reorder_threshold FROM products "
+        f"{where} ORDER BY {order} LIMIT ?",
+        (*params, page_size + 1)
+    )
+    has_more = len(products) > page_size
+    products = products[:page_size]
+
+    if backward:
+        products.reverse()
+        return products, has_more, True
+    return products, key is not None, has_more
+
+
+def products_page_callback_data(mode, direction, page, product):
+    key = ":".join(str(value) for value in product_page_key(mode, product))
+    return f"products:{mode}:{direction}:{page}:{key}"
+
+
+async def render_products_page(mode, direction="next", key=None, page=1):
+    """Собирает текст и inline-клавиатуру страницы; None, если склад пуст."""
+    products, has_prev, has_next = await fetch_products_page(mode, direction, key)
+    if not products and key is not None:
+        # Страница опустела после удаления товаров - начинаем с первой
+        products, has_prev, has_next = await fetch_products_page(mode)
+        page = 1
+    if not products:
+        return None, None
+
+    keyboard = []
+    if mode == "list":
+        text = f"📋 Список товаров (стр. {page}):\n\n"
+        if page == 1:
+            low_stock_count = (await db.fetchone(
+                "SELECT value FROM stats_counters WHERE name = 'products_low_stock'"
+            ))[0]
+            if low_stock_count:
+                text = (
+                    f"🚨 Внимание! Заканчивается товаров: {low_stock_count}\n"
+                    f"Подробнее: '🚨 Проверить остатки'\n\n"
+                ) + text
+        for product in products:
+            text += (
+                f"{'⚠️' if product[2] < product[5] else '🔹'} ID: {product[0]}\n"
+                f"Название: {product[1]}\n"
+                f"Количество: {product[2]}\n"
+                f"Категория: {product[3] if product[3] else 'не указана'}\n"
+                f"Добавлен: {product[4]}\n\n"
+            )
+    else:
+        if mode == "edit":
+            text = f"Выберите товар для редактирования (стр. {page}):"
+        else:
+            text = f"Выберите товар для удаления (стр. {page}):"
+        icon = "✏️" if mode == "edit" else "❌"
+        for product in products:
+            keyboard.append([InlineKeyboardButton(
+                text=f"{icon} {product[1]} (Кол-во: {product[2]})",
+                callback_data=f"{mode}_product:{product[0]}"
+            )])
+
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(
+            text="⬅️ Назад", callback_data=products_page_callback_data(mode, "prev", page - 1, products[0])
+        ))
+    if has_next:
+        navigation.append(InlineKeyboardButton(
+            text="Вперёд ➡️", callback_data=products_page_callback_data(mode, "next", page + 1, products[-1])
+        ))
+    if navigation:
+        keyboard.append(navigation)
+
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+# Листание страниц: products:<режим>:<направление>:<номер страницы>:<ключ>
+@warehouse_router.callback_query(F.data.startswith("products:"))
+@access_required
+async def products_page_handler(callback: types.CallbackQuery):
+    try:
+        _, mode, direction, page, *key = callback.data.split(":")
+        text, keyboard = await render_products_page(mode, direction, tuple(int(v) for v in key), int(page))
+
+        if text is None:
+            await callback.message.edit_text("📭 Склад пуст!")
+        else:
+            await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.answer()
+
+    except Exception as e:
+        logger.error(f"Ошибка при листании списка товаров: {e}")
+        await callback.answer("❌ Ошибка при загрузке страницы")
 
 
 # ===== РЕДАКТИРОВАНИЕ ТОВАРА =====
-@dp.message(F.text == "✏️ Редактировать")
+@warehouse_router.button("✏️ Редактировать")
 @access_required
 async def edit_product_start(message: types.Message):
-    cursor.execute("SELECT id, name, quantity FROM products")
-    products = cursor.fetchall()
+    text, keyboard = await render_products_page("edit")
 
-    if not products:
+    if text is None:
         await message.answer("📭 Склад пуст! Нечего редактировать.", reply_markup=get_warehouse_keyboard())
         return
 
-    keyboard = []
-    for product in products:
-        keyboard.append([KeyboardButton(text=f"✏️ {product[1]} (ID: {product[0]}, Кол-во: {product[2]})")])
-
-    keyboard.append([KeyboardButton(text="🔙 Назад")])
-
-    await message.answer(
-        "Выберите товар для редактирования:",
-        reply_markup=ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
-    )
+    await message.answer(text, reply_markup=keyboard)
 
 
-@dp.message(F.text.startswith("✏️ "))
-async def edit_product_selected(message: types.Message):
+@warehouse_router.callback_query(F.data.startswith("edit_product:"))
+@access_required
+async def edit_product_selected(callback: types.CallbackQuery, state: FSMContext):
     try:
-        product_id = int(message.text.split("(ID: ")[1].split(",")[0])
-        cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-        product = cursor.fetchone()
+        product_id = int(callback.data.split(":")[1])
+        product = await db.fetchone("SELECT * FROM products WHERE id = ?", (product_id,))
 
         if not product:
-            await message.answer("❌ Товар не найден!", reply_markup=get_warehouse_keyboard())
+            await callback.answer("❌ Товар не найден!")
             return
 
-        user_data[message.from_user.id] = {
+        await state.set_data({
             "edit_id": product_id,
             "current_name": product[1],
             "current_quantity": product[2],
             "current_category": product[3]
-        }
+        })
 
-        await message.answer(
+        await callback.message.answer(
             f"Выбран товар:\n"
             f"ID: {product[0]}\n"
             f"Название: {product[1]}\n"
             f"Количество: {product[2]}\n"
-            f"Категория: {product[3] if product[3] else 'не указана'}\n\n"
+            f"Категория: {product[3] if product[3] else 'не указана'}\n"
+            f"Порог заказа: {product[5]} шт.{'' if product[6] else ' (по умолчанию)'}\n\n"
             "Что хотите изменить?",
             reply_markup=ReplyKeyboardMarkup(
                 keyboard=[
                     [KeyboardButton(text="🖊 Изменить название")],
                     [KeyboardButton(text="🔢 Изменить количество")],
-                    [KeyboardButton(text="🏷 Изменить категориу")],
+                    [KeyboardButton(text="🏷 Изменить категорию")],
+                    [KeyboardButton(text="🎯 Изменить порог")],
+                    [KeyboardButton(text="📜 История движения")],
                     [KeyboardButton(text="🔙 К списку товаров")]
                 ],
                 resize_keyboard=True
             )
         )
+        await callback.answer()
 
     except Exception as e:
         logger.error(f"Ошибка при выборе товара: {e}")
-        await message.answer("❌ Ошибка при выборе товара!", reply_markup=get_warehouse_keyboard())
+        await callback.answer("❌ Ошибка при выборе товара!")
 
 
-@dp.message(F.text == "🔙 К списку товаров")
+@warehouse_router.button("🔙 К списку товаров")
 async def back_to_products_list(message: types.Message):
     await edit_product_start(message)
 
 
-@dp.message(F.text == "🖊 Изменить название")
-async def edit_name_handler(message: types.Message):
-    user_states[message.from_user.id] = "editing_name"
+@warehouse_router.button("🖊 Изменить название")
+async def edit_name_handler(message: types.Message, state: FSMContext):
+    await state.set_state("editing_name")
     await message.answer("Введите новое название:", reply_markup=get_cancel_keyboard())
 
 
-@dp.message(F.text == "🔢 Изменить количество")
-async def edit_quantity_handler(message: types.Message):
-    user_states[message.from_user.id] = "editing_quantity"
-    await message.answer("Введите новое количество:", reply_markup=get_cancel_keyboard())
+@warehouse_router.button("🔢 Изменить количество")
+async def edit_quantity_handler(message: types.Message, state: FSMContext):
+    await state.set_state("choosing_movement")
+    await message.answer("Выберите тип движения товара:", reply_markup=get_stock_movement_keyboard())
+
+
+@warehouse_router.button("📜 История движения")
+@access_required
+async def stock_history_handler(message: types.Message, state: FSMContext):
+    product_id = (await state.get_data()).get("edit_id")
+    if product_id is None:
+        await message.answer("❌ Сначала выберите товар.", reply_markup=get_warehouse_keyboard())
+        return
+
+    try:
+        await send_stock_history(message, product_id)
+    except Exception as e:
+        logger.error(f"Ошибка при получении движения товара: {e}")
+        await message.answer("❌ Ошибка при получении движения товара.")
 
 
-@dp.message(F.text == "🏷 Изменить категорию")
-async def edit_category_handler(message: types.Message):
-    user_states[message.from_user.id] = "editing_category"
+@warehouse_router.button("🏷 Изменить категорию")
+async def edit_category_handler(message: types.Message, state: FSMContext):
+    await state.set_state("editing_category")
     await message.answer(
         "Введите новую категорию или 'удалить' чтобы удалить категорию:",
         reply_markup=get_cancel_keyboard()
     )
 
 
-@dp.message(F.text, lambda message: user_states.get(message.from_user.id) == "editing_name")
-async def save_new_name(message: types.Message):
+@warehouse_router.state("editing_name")
+async def save_new_name(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
-        user_states[message.from_user.id] = None
+        await state.set_state(None)
         await message.answer("❌ Изменение названия отменено", reply_markup=get_warehouse_keyboard())
         return
 
-    product_id = user_data[message.from_user.id]["edit_id"]
-    cursor.execute("UPDATE products SET name = ? WHERE id = ?", (message.text, product_id))
-    conn.commit()
+    product_id = (await state.get_data())["edit_id"]
+    await db.execute("UPDATE products SET name = ? WHERE id = ?", (message.text, product_id))
     await message.answer(f"✅ Название изменено на: {message.text}", reply_markup=get_warehouse_keyboard())
-    user_states[message.from_user.id] = None
+    await state.set_state(None)
 
 
-@dp.message(F.text, lambda message: user_states.get(message.from_user.id) == "editing_quantity")
-async def save_new_quantity(message: types.Message):
+@warehouse_router.state("choosing_movement")
+async def choose_stock_movement(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
-        user_states[message.from_user.id] = None
+        await state.set_state(None)
         await message.answer("❌ Изменение количества отменено", reply_markup=get_warehouse_keyboard())
         return
 
-    if not message.text.isdigit():
-        await message.answer("❌ Введите число!", reply_markup=get_cancel_keyboard())
+    kind = STOCK_MOVEMENT_KINDS.get(message.text)
+    if kind is None:
+        await message.answer("❌ Выберите тип движения кнопкой!", reply_markup=get_stock_movement_keyboard())
+        return
+
+    await state.update_data(movement_kind=kind)
+    await state.set_state("editing_quantity")
+    if kind == "correction":
+        prompt = "Введите изменение со знаком, например +5 или -3:"
+    else:
+        prompt = f"{STOCK_MOVEMENT_NAMES[kind]}: введите количество:"
+    await message.answer(prompt, reply_markup=get_cancel_keyboard())
+
+
+@warehouse_router.state("editing_quantity")
+async def save_new_quantity(message: types.Message, state: FSMContext):
+    if message.text == "❌ Отмена":
+        await state.set_state(None)
+        await message.answer("❌ Изменение количества отменено", reply_markup=get_warehouse_keyboard())
+        return
+
+    data = await state.get_data()
+    kind = data.get("movement_kind", "correction")
+    text = message.text.strip()
+    if kind == "correction":
+        valid = re.fullmatch(r"[+-]?\d+", text) is not None and int(text) != 0
+    else:
+        valid = text.isdigit() and int(text) > 0
+    if not valid:
+        await message.answer(
+            "❌ Введите изменение со знаком, например +5 или -3!" if kind == "correction"
+            else "❌ Введите положительное число!",
+            reply_markup=get_cancel_keyboard()
+        )
         return
 
-    product_id = user_data[message.from_user.id]["edit_id"]
-    new_quantity = int(message.text)
-    cursor.execute("UPDATE products SET quantity = ? WHERE id = ?", (new_quantity, product_id))
-    conn.commit()
+    user_id = message.from_user.id
+    product_id = data["edit_id"]
+    product_name = data["current_name"]
+    delta = -int(text) if kind in ("sale", "writeoff") else int(text)
+    try:
+        result = await apply_stock_movement(product_id, kind, delta, user_id)
+        if result is None:
+            product = await db.fetchone("SELECT quantity FROM products WHERE id = ?", (product_id,))
+            if product:
+                response = f"❌ Недостаточно товара! На складе: {product[0]} шт."
+            else:
+                response = "❌ Товар не найден!"
+            await message.answer(response, reply_markup=get_warehouse_keyboard())
+            return
 
-    response = f"✅ Количество изменено на: {new_quantity}"
-    if new_quantity < 10:
-        product_name = user_data[message.from_user.id]["current_name"]
-        response += f"\n⚠️ Внимание! Товар '{product_name}' теперь имеет низкий запас: {new_quantity} шт."
+        new_quantity, threshold = result
+        response = (
+            f"✅ {STOCK_MOVEMENT_NAMES[kind]}: {delta:+d} шт.\n"
+            f"Остаток: {new_quantity} шт."
+        )
+        if new_quantity < threshold:
+            response += f"\n⚠️ Внимание! Товар '{product_name}' теперь имеет низкий запас: {new_quantity} шт."
 
-    await message.answer(response, reply_markup=get_warehouse_keyboard())
-    user_states[message.from_user.id] = None
+        await message.answer(response, reply_markup=get_warehouse_keyboard())
+        await log_action(user_id, "Движение товара",
+                         f"{product_name}: {STOCK_MOVEMENT_NAMES[kind].lower()} {delta:+d}, остаток {new_quantity}")
+    except Exception as e:
+        logger.error(f"Ошибка при изменении количества товара: {e}")
+        await message.answer("❌ Произошла ошибка при изменении количества!", reply_markup=get_warehouse_keyboard())
+    finally:
+        await state.set_state(None)
 
 
-@dp.message(F.text, lambda message: user_states.get(message.from_user.id) == "editing_category")
-async def save_new_category(message: types.Message):
+@warehouse_router.state("editing_category")
+async def save_new_category(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
-        user_states[message.from_user.id] = None
+        await state.set_state(None)
         await message.answer("❌ Изменение категории отменено", reply_markup=get_warehouse_keyboard())
         return
 
-    product_id = user_data[message.from_user.id]["edit_id"]
+    product_id = (await state.get_data())["edit_id"]
     new_category = None if message.text.lower() == "удалить" else message.text
-    cursor.execute("UPDATE products SET category = ? WHERE id = ?", (new_category, product_id))
-    conn.commit()
+    await db.execute("UPDATE products SET category = ? WHERE id = ?", (new_category, product_id))
+    stock_alerts.wake()  # порог категории мог измениться
     action = "удалена" if new_category is None else "изменена"
     await message.answer(f"✅ Категория {action}", reply_markup=get_warehouse_keyboard())
-    user_states[message.from_user.id] = None
+    await state.set_state(None)
+
+
+@warehouse_router.button("🎯 Изменить порог")
+@access_required
+async def edit_threshold_handler(message: types.Message, state: FSMContext):
+    await state.set_state("editing_threshold")
+    await message.answer(
+        "Введите порог заказа (при остатке ниже него придёт уведомление) "
+        "или 'сброс', чтобы вернуть порог категории:",
+        reply_markup=get_cancel_keyboard()
+    )
+
+
+@warehouse_router.state("editing_threshold")
+async def save_new_threshold(message: types.Message, state: FSMContext):
+    if message.text == "❌ Отмена":
+        await state.set_state(None)
+        await message.answer("❌ Изменение порога отменено", reply_markup=get_warehouse_keyboard())
+        return
+
+    text = message.text.strip().lower()
+    if not (text.isdigit() or text == "сброс"):
+        await message.answer("❌ Введите число или 'сброс'!", reply_markup=get_cancel_keyboard())
+        return
+
+    data = await state.get_data()
+    product_id = data["edit_id"]
+    try:
+        if text == "сброс":
+            await reset_product_threshold(product_id)
+        else:
+            await set_product_threshold(product_id, int(text))
+        threshold = await db.fetchone("SELECT reorder_threshold FROM products WHERE id = ?", (product_id,))
+        if threshold is None:
+            await message.answer("❌ Товар не найден!", reply_markup=get_warehouse_keyboard())
+            return
+
+        await message.answer(f"✅ Порог заказа: {threshold[0]} шт.", reply_markup=get_warehouse_keyboard())
+        await log_action(message.from_user.id, "Порог товара", f"{data['current_name']}: {threshold[0]}")
+    except Exception as e:
+        logger.error(f"Ошибка при изменении порога товара: {e}")
+        await message.answer("❌ Произошла ошибка при изменении порога!", reply_markup=get_warehouse_keyboard())
+    finally:
+        await state.set_state(None)
 
 
 # ===== УДАЛЕНИЕ ТОВАРА =====
-@dp.message(F.text == "❌ Удалить товар")
+@warehouse_router.button("❌ Удалить товар")
 @access_required
 async def delete_product_start(message: types.Message):
-    cursor.execute("SELECT id, name FROM products")
-    products = cursor.fetchall()
+    text, keyboard = await render_products_page("delete")
 
-    if not products:
+    if text is None:
         await message.answer("📭 Склад пуст! Нечего удалять.", reply_markup=get_warehouse_keyboard())
         return
 
-    keyboard = []
-    for product in products:
-        keyboard.append([KeyboardButton(text=f"❌ Удалить {product[1]} (ID: {product[0]})")])
-
-    keyboard.append([KeyboardButton(text="🔙 Назад")])
-
-    await message.answer(
-        "Выберите товар для удаления:",
-        reply_markup=ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
-    )
+    await message.answer(text, reply_markup=keyboard)
 
 
-@dp.message(F.text.startswith("❌ Удалить "))
-async def delete_product_selected(message: types.Message):
+@warehouse_router.callback_query(F.data.startswith("delete_product:"))
+@access_required
+async def delete_product_selected(callback: types.CallbackQuery):
     try:
-        product_id = int(message.text.split("(ID: ")[1].rstrip(")"))
-        cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-        product = cursor.fetchone()
+        product_id = int(callback.data.split(":")[1])
+        product = await db.fetchone("SELECT * FROM products WHERE id = ?", (product_id,))
 
         if not product:
-            await message.answer("❌ Товар не найден!", reply_markup=get_warehouse_keyboard())
+            await callback.answer("❌ Товар не найден!")
             return
 
-        cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
-        conn.commit()
+        await db.execute("DELETE FROM products WHERE id = ?", (product_id,))
 
-        await message.answer(
+        # Убираем кнопку удалённого товара, не перечитывая страницу
+        if callback.message.reply_markup:
+            keyboard = [
+                row for row in callback.message.reply_markup.inline_keyboard
+                if row[0].callback_data != callback.data
+            ]
+            await callback.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+
+        await callback.message.answer(
             f"🗑 Товар успешно удален!\n"
             f"ID: {product[0]}\n"
             f"Название: {product[1]}\n"
@@ -1950,54 +4521,30 @@ async def delete_product_selected(message: types.Message):
             f"Категория: {product[3] if product[3] else 'не указана'}",
             reply_markup=get_warehouse_keyboard()
         )
+        await callback.answer()
 
-        await log_action(message.from_user.id, "Удаление товара",
+        await log_action(callback.from_user.id, "Удаление товара",
                          f"{product[1]} (ID: {product[0]}, кол-во: {product[2]})")
 
     except Exception as e:
         logger.error(f"Ошибка при удалении товара: {e}")
-        await message.answer("❌ Произошла ошибка при удалении товара!", reply_markup=get_warehouse_keyboard())
+        await callback.answer("❌ Произошла ошибка при удалении товара!")
 
 
 # ===== ВЫВОД СПИСКА ТОВАРОВ =====
-@dp.message(F.text == "📋 Посмотреть склад")
+@warehouse_router.button("📋 Посмотреть склад")
 @access_required
-async def show_warehouse(message: types.Message):
-    user_id = message.from_user.id
-    user_states[user_id] = None
+async def show_warehouse(message: types.Message, state: FSMContext):
+    await state.set_state(None)
 
     try:
-        cursor.execute("SELECT * FROM products ORDER BY quantity ASC")
-        products = cursor.fetchall()
+        text, keyboard = await render_products_page("list")
 
-        if not products:
+        if text is None:
             await message.answer("📭 Склад пуст!", reply_markup=get_warehouse_keyboard())
             return
 
-        cursor.execute("SELECT * FROM products WHERE quantity < 10 ORDER BY quantity ASC")
-        low_stock = cursor.fetchall()
-
-        response = "📋 Список товаров:\n\n"
-        for product in products:
-            response += (
-                f"{'⚠️' if product[2] < 10 else '🔹'} ID: {product[0]}\n"
-                f"Название: {product[1]}\n"
-                f"Количество: {product[2]}\n"
-                f"Категория: {product[3] if product[3] else 'не указана'}\n"
-                f"Добавлен: {product[4]}\n\n"
-            )
-
-        if low_stock:
-            warning = "🚨 Внимание! Заканчиваются следующие товары:\n\n"
-            for product in low_stock:
-                warning += (
-                    f"▪️ {product[1]} (ID: {product[0]}) - осталось {product[2]} шт.\n"
-                )
-            response = warning + "\n" + response
-
-        max_length = 4000
-        for i in range(0, len(response), max_length):
-            await message.answer(response[i:i + max_length])
+        await message.answer(text, reply_markup=keyboard)
 
     except Exception as e:
         logger.error(f"Ошибка при выводе склада: {e}")
@@ -2005,24 +4552,27 @@ async def show_warehouse(message: types.Message):
 
 
 # ===== ПРОВЕРКА ЗАКАНЧИВАЮЩИХСЯ ТОВАРОВ =====
-@dp.message(F.text == "🚨 Проверить остатки")
+@warehouse_router.button("🚨 Проверить остатки")
 @access_required
 async def check_low_stock(message: types.Message):
     try:
-        cursor.execute("SELECT * FROM products WHERE quantity < 10 ORDER BY quantity ASC")
-        low_stock = cursor.fetchall()
+        # Условие совпадает с частичным индексом idx_products_low_stock
+        low_stock = await db.fetchall(
+            "SELECT id, name, quantity, category, reorder_threshold FROM products "
+            "WHERE quantity < reorder_threshold ORDER BY quantity, id"
+        )
 
         if not low_stock:
-            await message.answer("✅ Все товары в достаточном количестве (10+ шт.)",
+            await message.answer("✅ Все товары в достаточном количестве",
                                  reply_markup=get_warehouse_keyboard())
             return
 
-        response = "🚨 Товары с низким запасом (<10 шт.):\n\n"
+        response = "🚨 Товары ниже порога заказа:\n\n"
         for product in low_stock:
             response += (
                 f"▪️ ID: {product[0]}\n"
                 f"Название: {product[1]}\n"
-                f"Осталось: {product[2]} шт.\n"
+                f"Осталось: {product[2]} шт. (порог: {product[4]})\n"
                 f"Категория: {product[3] if product[3] else 'не указана'}\n\n"
             )
 
@@ -2034,61 +4584,758 @@ async def check_low_stock(message: types.Message):
 
 
 # ===== ЭКСПОРТ В EXCEL =====
-@dp.message(F.text == "📥 Экспорт в Excel")
-@access_required
-async def export_to_excel(message: types.Message):
+# Книга строится в отдельном потоке через write-only режим openpyxl: строки
+# читаются курсором отдельного соединения и сразу пишутся в файл, поэтому
+# ни таблица целиком, ни книга не держатся в памяти и цикл событий свободен.
+EXPORT_DEFAULT_DAYS = 30
+EXPORT_CACHE_MAX_FILES = 20
+EXPORT_PROGRESS_MIN_ROWS = 5000  # с какого размера склада показывать прогресс
+EXPORT_PROGRESS_STEP = 1000
+EXPORT_PROGRESS_INTERVAL = 2.0  # секунды между обновлениями сообщения
+EXPORT_WORKERS = 1
+LOW_STOCK_COLOR = "FFC7CE"  # заливка строк с низким запасом
+
+
+def build_excel_export(path, date_from=None, date_to=None, include_logs=False, progress=None):
+    """Записывает книгу в path и возвращает количество выгруженных товаров.
+
+    progress(n) вызывается из рабочего потока каждые EXPORT_PROGRESS_STEP строк склада.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import PatternFill
+
+    low_stock_fill = PatternFill(start_color=LOW_STOCK_COLOR, end_color=LOW_STOCK_COLOR, fill_type="solid")
+    conn = connect_db(get_current_club().path)
     try:
-        cursor.execute("SELECT id, name, quantity, category, added_date FROM products")
-        columns = [column[0] for column in cursor.description]
-        data = cursor.fetchall()
+        workbook = Workbook(write_only=True)
+
+        sheet = workbook.create_sheet("Склад")
+        sheet.append(["id", "name", "quantity", "category", "added_date", "reorder_threshold"])
+        product_count = 0
+        for row in conn.execute(
+                "SELECT id, name, quantity, category, added_date, reorder_threshold FROM products ORDER BY id"):
+            if row[2] < row[5]:
+                cells = []
+                for value in row:
+                    cell = WriteOnlyCell(sheet, value=value)
+                    cell.fill = low_stock_fill
+                    cells.append(cell)
+                sheet.append(cells)
+            else:
+                sheet.append(row)
+            product_count += 1
+            if progress and product_count % EXPORT_PROGRESS_STEP == 0:
+                progress(product_count)
+
+        if date_from and date_to:
+            sheet = workbook.create_sheet("Отчёты")
+            sheet.append(["report_date", "user_id", "first_name", "total", "cash", "card",
+                          "bar", "hookah_count", "expenses", "initial_cash", "balance"])
+            for row in conn.execute(
+                    """
+                    SELECT sr.report_date, sr.user_id, u.first_name, sr.total, sr.cash, sr.card,
+                           sr.bar, sr.hookah_count, sr.expenses, sr.initial_cash, sr.balance
+                    FROM shift_reports sr
+                             LEFT JOIN users u ON sr.user_id = u.user_id
+                    WHERE sr.report_date BETWEEN ? AND ?
+                    ORDER BY sr.report_date
+                    """, (date_from, date_to)):
+                sheet.append(row)
+
+            if include_logs:
+                sheet = workbook.create_sheet("Журнал действий")
+                sheet.append(["timestamp", "user_id", "first_name", "action", "details"])
+                for row in conn.execute(
+                        """
+                        SELECT al.timestamp, al.user_id, u.first_name, al.action, al.details
+                        FROM action_logs al
+                                 LEFT JOIN users u ON al.user_id = u.user_id
+                        WHERE al.timestamp >= ?
+                          AND al.timestamp < date(?, '+1 day')
+                        ORDER BY al.timestamp
+                        """, (date_from, date_to)):
+                    sheet.append(row)
+
+        workbook.save(path)
+        return product_count
+    finally:
+        conn.close()
 
-        if not data:
-            await message.answer("📭 Склад пуст! Нет данных для экспорта.",
-                                 reply_markup=get_main_keyboard(message.from_user.id))
-            return
 
-        output = BytesIO()
-        workbook = Workbook()
-        sheet = workbook.active
-        sheet.title = "Склад"
-        sheet.append(columns)
+# ===== АНАЛИТИЧЕСКИЙ ОТЧЁТ (PANDAS) =====
+# Отчёты за период загружаются одним запросом в DataFrame, все показатели
+# считаются векторно (groupby/rolling) и пишутся в многолистовую книгу.
+ANALYTICS_DEFAULT_DAYS = 90
+WEEKDAY_NAMES = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+REPORT_METRICS = ["total", "cash", "card", "bar", "hookah_count", "expenses", "net_profit"]
 
-        for row in data:
-            sheet.append(row)
-            if row[2] < 10:
-                pass
 
-        workbook.save(output)
-        output.seek(0)
+def _share(numerator, denominator):
+    # Доля с пустым значением там, где знаменатель равен нулю
+    return (numerator / denominator.where(denominator != 0)).round(4)
 
-        file_data = output.getvalue()
-        filename = f"склад_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.xlsx"
 
-        excel_file = BufferedInputFile(
-            file=file_data,
-            filename=filename
+def build_analytics_export(path, date_from, date_to, progress=None):
+    """Записывает аналитическую книгу в path и возвращает количество отчётов."""
+    import pandas as pd
+
+    conn = connect_db(get_current_club().path)
+    try:
+        df = pd.read_sql_query(
+            """
+            SELECT sr.report_date, sr.user_id, u.first_name, sr.total, sr.cash, sr.card,
+                   sr.bar, sr.hookah_count, sr.expenses
+            FROM shift_reports sr
+                     LEFT JOIN users u ON sr.user_id = u.user_id
+            WHERE sr.report_date BETWEEN ? AND ?
+            """,
+            conn,
+            params=(date_from, date_to),
+            parse_dates=["report_date"]
         )
+    finally:
+        conn.close()
+    if progress:
+        progress(len(df))
+
+    df["employee"] = df["first_name"].fillna(df["user_id"].astype(str))
+    df["net_profit"] = df["total"] - df["expenses"]
+
+    # По дням: дни без отчётов заполняются нулями, чтобы скользящие средние
+    # считались по календарным дням
+    reported = df.groupby("report_date")[REPORT_METRICS].sum()
+    daily = reported.asfreq("D", fill_value=0)
+    daily["total_ma7"] = daily["total"].rolling(7, min_periods=1).mean().round(2)
+    daily["total_ma30"] = daily["total"].rolling(30, min_periods=1).mean().round(2)
+    daily["net_profit_ma7"] = daily["net_profit"].rolling(7, min_periods=1).mean().round(2)
+    daily["cash_share"] = _share(daily["cash"], daily["cash"] + daily["card"])
+    daily["expense_ratio"] = _share(daily["expenses"], daily["total"])
+    daily.index = daily.index.date
+
+    # Сезонность по дням недели среди дней, за которые есть отчёты
+    seasonality = reported.groupby(reported.index.dayofweek).agg(
+        days=("total", "size"),
+        avg_total=("total", "mean"),
+        avg_net_profit=("net_profit", "mean"),
+        avg_hookah_count=("hookah_count", "mean"),
+    ).round(2)
+    seasonality["total_index"] = (seasonality["avg_total"] / reported["total"].mean()).round(3)
+    seasonality.index = seasonality.index.map(lambda day: WEEKDAY_NAMES[day])
+
+    employees = df.groupby("employee").agg(
+        reports=("total", "size"),
+        **{metric: (metric, "sum") for metric in REPORT_METRICS},
+        avg_total=("total", "mean"),
+    )
+    employees["avg_total"] = employees["avg_total"].round(2)
+    employees["cash_share"] = _share(employees["cash"], employees["cash"] + employees["card"])
+    employees["expense_ratio"] = _share(employees["expenses"], employees["total"])
+    employees["rank"] = employees["total"].rank(ascending=False, method="min").astype(int)
+    employees = employees.sort_values("rank")
+
+    totals = df[REPORT_METRICS].sum()
+    summary = pd.DataFrame([
+        ("period", f"{date_from} — {date_to}"),
+        ("reports", len(df)),
+        ("days_with_reports", len(reported)),
+        *((metric, totals[metric]) for metric in REPORT_METRICS),
+        ("avg_daily_total", round(reported["total"].mean(), 2)),
+        ("cash_share", round(totals["cash"] / (totals["cash"] + totals["card"]), 4)
+            if totals["cash"] + totals["card"] else None),
+        ("expense_ratio", round(totals["expenses"] / totals["total"], 4) if totals["total"] else None),
+        ("best_weekday", seasonality["avg_total"].idxmax()),
+        ("top_employee", employees.index[0]),
+    ], columns=["metric", "value"])
+
+    with pd.ExcelWriter(path, engine="openpyxl") as writer:
+        summary.to_excel(writer, sheet_name="Сводка", index=False)
+        daily.to_excel(writer, sheet_name="По дням", index_label="date")
+        seasonality.to_excel(writer, sheet_name="Дни недели", index_label="weekday")
+        employees.to_excel(writer, sheet_name="Сотрудники", index_label="employee")
+    return len(df)
+
+
+# ===== ОЧЕРЕДЬ ЗАДАЧ ЭКСПОРТА =====
+# Готовые файлы хранятся в папке выгрузок клуба под именем, включающим версии данных
+# (data_versions), поэтому файл пересобирается только после изменения
+# данных. Одинаковые запросы во время сборки ждут одну общую задачу, а
+# после первой отправки файл пересылается по file_id без повторной загрузки.
+class ExportJobQueue:
+    def __init__(self, workers=EXPORT_WORKERS):
+        self.in_flight = {}
+        self.file_ids = {}
+        self.semaphore = asyncio.Semaphore(workers)
+
+    async def get_file(self, path, build_args, progress_message=None, total_rows=0, builder=build_excel_export):
+        """Возвращает путь к готовому файлу, собирая его не более одного раза."""
+        if path.exists():
+            return path
+
+        job = self.in_flight.get(path)
+        if job is None:
+            job = asyncio.ensure_future(self._build(path, build_args, progress_message, total_rows, builder))
+            self.in_flight[path] = job
+            job.add_done_callback(lambda _: self.in_flight.pop(path, None))
+        elif progress_message:
+            await progress_message.edit_text("⏳ Такой экспорт уже формируется, ожидайте...")
+
+        await asyncio.shield(job)
+        return path
+
+    async def _build(self, path, build_args, progress_message, total_rows, builder):
+        async with self.semaphore:
+            progress = {"rows": 0}
+            updater = None
+            if progress_message:
+                updater = asyncio.create_task(self._show_progress(progress_message, progress, total_rows))
+
+            tmp_path = path.with_suffix(".tmp")
+            try:
+                await asyncio.to_thread(builder, tmp_path, *build_args,
+                                        progress=lambda rows: progress.__setitem__("rows", rows))
+                tmp_path.replace(path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+                if updater:
+                    updater.cancel()
+
+        self._cleanup(path)
+
+    async def _show_progress(self, progress_message, progress, total_rows):
+        shown = -1
+        while True:
+            await asyncio.sleep(EXPORT_PROGRESS_INTERVAL)
+            rows = progress["rows"]
+            if rows != shown:
+                shown = rows
+                try:
+                    await progress_message.edit_text(
+                        f"⏳ Формирование экспорта: {rows} из {total_rows} товаров ({rows * 100 // total_rows}%)"
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка обновления прогресса экспорта: {e}")
+
+    def _cleanup(self, path):
+        # Удаляем устаревшие версии этого же набора данных и лишние старые файлы
+        variant = path.name.rsplit("_", 1)[0]
+        files = sorted(path.parent.glob("export_*.xlsx"), key=lambda f: f.stat().st_mtime, reverse=True)
+        for number, file in enumerate(files):
+            outdated = file != path and file.name.rsplit("_", 1)[0] == variant
+            if outdated or number >= EXPORT_CACHE_MAX_FILES:
+                file.unlink(missing_ok=True)
+                self.file_ids.pop(file, None)
+
+
+export_jobs = ExportJobQueue()
+
+
+async def get_export_path(date_from, date_to, include_logs):
+    versions = dict(await db.fetchall("SELECT name, version FROM data_versions"))
+    variant = "products"
+    version = f"p{versions.get('products', 0)}"
+    if date_from:
+        variant = f"{date_from}_{date_to}"
+        version += f"r{versions.get('shift_reports', 0)}"
+        if include_logs:
+            variant += "_logs"
+            version += f"l{(await db.fetchone('SELECT MAX(id) FROM action_logs'))[0] or 0}"
+    return get_current_club().export_dir / f"export_{variant}_{version}.xlsx"
+
+
+async def send_excel_export(message: types.Message, date_from=None, date_to=None, include_logs=False):
+    user_id = message.from_user.id
+    try:
+        if not date_from and not await db.fetchone("SELECT 1 FROM products LIMIT 1"):
+            await message.answer("📭 Склад пуст! Нет данных для экспорта.",
+                                 reply_markup=await get_main_keyboard(user_id))
+            return
 
-        await message.answer_document(
-            document=excel_file,
-            caption="📊 Экспорт данных склада в Excel",
-            reply_markup=get_main_keyboard(message.from_user.id)
+        filename = f"склад_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.xlsx"
+        caption = "📊 Экспорт данных склада в Excel"
+        if date_from:
+            caption += f"\n📅 Отчёты{' и журнал действий' if include_logs else ''}: {date_from} — {date_to}"
+
+        path = await get_export_path(date_from, date_to, include_logs)
+
+        # Файл уже загружался в Telegram - отправляем по file_id
+        file_id = export_jobs.file_ids.get(path)
+        if file_id:
+            try:
+                await message.answer_document(document=file_id, caption=caption,
+                                              reply_markup=await get_main_keyboard(user_id))
+                return
+            except Exception as e:
+                logger.warning(f"Не удалось отправить экспорт по file_id, файл будет загружен заново: {e}")
+                export_jobs.file_ids.pop(path, None)
+
+        progress_message = None
+        total_rows = 0
+        if not path.exists():
+            total_rows = (await db.fetchone("SELECT COUNT(*) FROM products"))[0]
+            if total_rows >= EXPORT_PROGRESS_MIN_ROWS:
+                progress_message = await message.answer(f"⏳ Формирование экспорта: 0 из {total_rows} товаров (0%)")
+
+        await export_jobs.get_file(path, (date_from, date_to, include_logs), progress_message, total_rows)
+
+        sent = await message.answer_document(
+            document=FSInputFile(path, filename=filename),
+            caption=caption,
+            reply_markup=await get_main_keyboard(user_id)
         )
+        if sent.document:
+            export_jobs.file_ids[path] = sent.document.file_id
+
+        if progress_message:
+            await progress_message.delete()
 
     except Exception as e:
         logger.error(f"❌ Ошибка при экспорте: {str(e)}", exc_info=True)
         await message.answer(
             "❌ Произошла ошибка при экспорте данных!\n"
             f"Ошибка: {str(e)}",
-            reply_markup=get_main_keyboard(message.from_user.id)
+            reply_markup=await get_main_keyboard(user_id)
+        )
+
+
+@warehouse_router.button("📥 Экспорт в Excel")
+@access_required
+async def export_to_excel(message: types.Message):
+    await send_excel_export(message)
+
+
+# /export [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] - склад вместе с отчётами по сменам
+# (и журналом действий для администраторов) за период, по умолчанию 30 дней
+@warehouse_router.message(Command("export"))
+@access_required
+async def export_period_to_excel(message: types.Message):
+    period = await parse_export_period(message, "export", EXPORT_DEFAULT_DAYS)
+    if period:
+        await send_excel_export(message, *period, include_logs=await is_admin(message.from_user.id))
+
+
+# Разбирает "[с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]" из аргументов команды;
+# при ошибке отвечает пользователю и возвращает None
+async def parse_export_period(message: types.Message, command, default_days):
+    args = message.text.split()[1:]
+    try:
+        dates = [datetime.strptime(arg, "%Y-%m-%d").date() for arg in args[:2]]
+    except ValueError:
+        await message.answer(f"❌ Укажите даты в формате ГГГГ-ММ-ДД, например: /{command} 2024-01-01 2024-01-31")
+        return None
+
+    today = datetime.now().date()
+    date_to = dates[1] if len(dates) > 1 else today
+    date_from = dates[0] if dates else date_to - timedelta(days=default_days)
+    if date_from > date_to:
+        date_from, date_to = date_to, date_from
+    return date_from.isoformat(), date_to.isoformat()
+
+
+# /analytics [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] - аналитика по отчётам за период
+# (скользящие средние, дни недели, доли оплат, рейтинг сотрудников), по умолчанию 90 дней
+@reports_router.message(Command("analytics"))
+@admin_required
+async def export_analytics(message: types.Message):
+    period = await parse_export_period(message, "analytics", ANALYTICS_DEFAULT_DAYS)
+    if not period:
+        return
+    date_from, date_to = period
+
+    try:
+        if not await db.fetchone(
+                "SELECT 1 FROM report_rollups WHERE period = 'day' AND period_start BETWEEN ? AND ? LIMIT 1",
+                period):
+            await message.answer(f"📭 Нет отчётов за период {date_from} — {date_to}.")
+            return
+
+        version = (await db.fetchone("SELECT version FROM data_versions WHERE name = 'shift_reports'"))[0]
+        path = get_current_club().export_dir / f"export_analytics_{date_from}_{date_to}_r{version}.xlsx"
+        caption = f"📈 Аналитика по отчётам: {date_from} — {date_to}"
+
+        file_id = export_jobs.file_ids.get(path)
+        if file_id:
+            try:
+                await message.answer_document(document=file_id, caption=caption)
+                return
+            except Exception as e:
+                logger.warning(f"Не удалось отправить аналитику по file_id, файл будет загружен заново: {e}")
+                export_jobs.file_ids.pop(path, None)
+
+        await export_jobs.get_file(path, period, builder=build_analytics_export)
+
+        sent = await message.answer_document(
+            document=FSInputFile(path, filename=f"аналитика_{date_from}_{date_to}.xlsx"),
+            caption=caption
+        )
+        if sent.document:
+            export_jobs.file_ids[path] = sent.document.file_id
+
+        await log_action(message.from_user.id, "Экспорт аналитики", f"{date_from} — {date_to}")
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка при формировании аналитики: {e}", exc_info=True)
+        await message.answer("❌ Произошла ошибка при формировании аналитики!")
+
+
+# ===== ИМПОРТ ТОВАРОВ =====
+# Администратор присылает .xlsx или .csv со столбцами как в экспорте склада
+# (id, name, quantity, category, reorder_threshold) или их русскими
+# названиями. Файл читается построчно в отдельном потоке (read-only режим
+# openpyxl, csv.reader) и сверяется со складом; бот показывает сводку
+# изменений и ошибки по строкам, а после подтверждения все строки
+# применяются одной транзакцией пакетными запросами.
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # больше Bot API скачать не даёт
+IMPORT_PREVIEW_LINES = 10
+IMPORT_PENDING_TTL = 30 * 60  # секунды, в течение которых можно подтвердить проверенный импорт
+IMPORT_COLUMNS = {
+    "id": "id",
+    "name": "name", "название": "name", "товар": "name",
+    "quantity": "quantity", "количество": "quantity", "остаток": "quantity",
+    "category": "category", "категория": "category",
+    "reorder_threshold": "threshold", "порог": "threshold",
+}
+
+ProductImport = namedtuple("ProductImport", "rows created updated unchanged errors preview")
+
+# Проверенные импорты, ожидающие подтверждения: (клуб, user_id) -> (время проверки, ProductImport)
+pending_imports = {}
+
+
+def purge_stale_imports():
+    """Удаляет неподтверждённые импорты старше IMPORT_PENDING_TTL и забытые загруженные файлы клуба.
+
+    Вызывается перед каждой новой проверкой, поэтому словарь не растёт
+    от импортов, которые так и не подтвердили и не отменили.
+    """
+    cutoff = time.time() - IMPORT_PENDING_TTL
+    for key in [key for key, (checked_at, _) in pending_imports.items() if checked_at < cutoff]:
+        del pending_imports[key]
+    # Файлы обычно удаляются сразу после проверки; остаются только после сбоя процесса
+    for path in get_current_club().export_dir.glob("import_*"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def take_pending_import(user_id):
+    """Забирает проверенный импорт пользователя; None, если его нет или он устарел."""
+    checked_at, result = pending_imports.pop((get_current_club().slug, user_id), (0, None))
+    return result if checked_at >= time.time() - IMPORT_PENDING_TTL else None
+
+
+def _read_import_rows(path):
+    """Построчно отдаёт строки файла импорта в виде кортежей значений."""
+    if path.suffix.lower() == ".csv":
+        with open(path, newline="", encoding="utf-8-sig") as file:
+            sample = file.read(4096)
+            file.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=";,\t")
+            except csv.Error:
+                dialect = csv.excel
+            yield from csv.reader(file, dialect)
+        return
+
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _import_number(value, field):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value.strip())
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise ValueError(f"{field}: ожидается целое число не меньше 0, получено '{value}'")
+    return value
+
+
+def _import_text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def parse_product_import(path):
+    """Сверяет файл со складом и возвращает ProductImport без записи в базу.
+
+    rows - строки (line, product_id, name, quantity, category, threshold) только
+    для новых и изменившихся товаров; product_id None означает новый товар,
+    threshold None - оставить порог как есть.
+    """
+    conn = connect_db(get_current_club().path)
+    try:
+        products = {}
+        names = {}
+        for row in conn.execute(
+                "SELECT id, name, quantity, category, reorder_threshold FROM products ORDER BY id"):
+            products[row[0]] = row
+            names.setdefault(row[1], row[0])
+    finally:
+        conn.close()
+
+    rows = []
+    errors = []
+    preview = []
+    created = updated = unchanged = 0
+    columns = None
+    seen = {}
+
+    for line, values in enumerate(_read_import_rows(path), start=1):
+        if not any(_import_text(value) for value in values):
+            continue
+        if columns is None:
+            columns = {IMPORT_COLUMNS[header]: index for index, value in enumerate(values)
+                       if (header := (_import_text(value) or "").lower()) in IMPORT_COLUMNS}
+            if "name" not in columns or "quantity" not in columns:
+                raise ValueError("в первой строке нужны столбцы name и quantity (или Название и Количество)")
+            continue
+
+        def cell(column):
+            index = columns.get(column)
+            return values[index] if index is not None and index < len(values) else None
+
+        try:
+            name = _import_text(cell("name"))
+            if not name:
+                raise ValueError("не указано название")
+            quantity = _import_number(cell("quantity"), "количество")
+            threshold = cell("threshold")
+            threshold = None if _import_text(threshold) is None else _import_number(threshold, "порог")
+
+            product_id = _import_text(cell("id"))
+            if product_id is not None:
+                product_id = _import_number(cell("id"), "id")
+                if product_id not in products:
+                    raise ValueError(f"товар с ID {product_id} не найден")
+            else:
+                product_id = names.get(name)
+
+            key = product_id or name
+            if key in seen:
+                raise ValueError(f"товар уже указан в строке {seen[key]}")
+            seen[key] = line
+        except ValueError as e:
+            errors.append((line, str(e)))
+            continue
+
+        category = _import_text(cell("category"))
+        if product_id is None:
+            created += 1
+            rows.append((line, None, name, quantity, category, threshold))
+            if len(preview) < IMPORT_PREVIEW_LINES:
+                preview.append(f"➕ {name}: {quantity} шт.")
+            continue
+
+        _, old_name, old_quantity, old_category, old_threshold = products[product_id]
+        if "category" not in columns:
+            category = old_category
+        if threshold == old_threshold:
+            threshold = None
+        if (name, quantity, category, threshold) == (old_name, old_quantity, old_category, None):
+            unchanged += 1
+            continue
+
+        updated += 1
+        rows.append((line, product_id, name, quantity, category, threshold))
+        if len(preview) < IMPORT_PREVIEW_LINES:
+            change = f"{old_quantity} → {quantity} шт." if quantity != old_quantity else "данные обновлены"
+            preview.append(f"✏️ {name} (ID: {product_id}): {change}")
+
+    if columns is None:
+        raise ValueError("файл пуст")
+    return ProductImport(rows, created, updated, unchanged, errors, preview)
+
+
+def _apply_product_import(conn, rows, user_id):
+    """Применяет строки импорта; возвращает (добавлено, обновлено)."""
+    conn.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS import_rows "
+        "(line INTEGER PRIMARY KEY, product_id INTEGER, name TEXT NOT NULL, quantity INTEGER NOT NULL, "
+        "category TEXT, threshold INTEGER)"
+    )
+    conn.execute("DELETE FROM import_rows")
+    conn.executemany("INSERT INTO import_rows VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    # Товар с таким названием мог появиться после проверки файла - обновляем его, а не дублируем
+    conn.execute(
+        "UPDATE import_rows SET product_id = p.id "
+        "FROM (SELECT name, MIN(id) AS id FROM products GROUP BY name) p "
+        "WHERE import_rows.product_id IS NULL AND p.name = import_rows.name"
+    )
+
+    # Изменения остатка записываются корректировкой до обновления, пока в products старое значение
+    conn.execute(
+        "INSERT INTO stock_movements (product_id, kind, delta, quantity_after, user_id, comment) "
+        "SELECT p.id, 'correction', i.quantity - p.quantity, i.quantity, ?, 'Импорт товаров' "
+        "FROM import_rows i JOIN products p ON p.id = i.product_id WHERE i.quantity != p.quantity",
+        (user_id,)
+    )
+    updated = conn.execute(
+        "UPDATE products SET name = i.name, quantity = i.quantity, category = i.category, "
+        "reorder_threshold = COALESCE(i.threshold, products.reorder_threshold), "
+        "threshold_custom = products.threshold_custom OR i.threshold IS NOT NULL "
+        "FROM import_rows i WHERE products.id = i.product_id"
+    ).rowcount
+
+    # Пишет только эта транзакция, поэтому все id больше прежнего максимума - добавленные ею товары
+    last_id = conn.execute("SELECT IFNULL(MAX(id), 0) FROM products").fetchone()[0]
+    created = conn.execute(
+        "INSERT INTO products (name, quantity, category, reorder_threshold, threshold_custom) "
+        "SELECT i.name, i.quantity, i.category, COALESCE(i.threshold, ct.threshold, ?), i.threshold IS NOT NULL "
+        "FROM import_rows i LEFT JOIN category_thresholds ct ON ct.category = i.category "
+        "WHERE i.product_id IS NULL ORDER BY i.line",
+        (DEFAULT_REORDER_THRESHOLD,)
+    ).rowcount
+    conn.execute(
+        "INSERT INTO stock_movements (product_id, kind, delta, quantity_after, user_id, comment) "
+        "SELECT id, 'receipt', quantity, quantity, ?, 'Импорт товаров' FROM products WHERE id > ?",
+        (user_id, last_id)
+    )
+    conn.execute("DELETE FROM import_rows")
+    return created, updated
+
+
+def write_import_errors(path, errors):
+    with open(path, "w", newline="", encoding="utf-8-sig") as file:
+        writer = csv.writer(file, delimiter=";")
+        writer.writerow(["line", "error"])
+        writer.writerows(errors)
+
+
+def get_import_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ Применить", callback_data="import_apply"),
+        InlineKeyboardButton(text="❌ Отменить", callback_data="import_cancel"),
+    ]])
+
+
+@warehouse_router.button("📤 Импорт товаров")
+@admin_required
+async def import_products_start(message: types.Message, state: FSMContext):
+    await state.set_state("importing_products")
+    await message.answer(
+        "📤 Отправьте файл .xlsx или .csv со списком товаров.\n\n"
+        "Первая строка - заголовки: name (Название) и quantity (Количество) обязательны, "
+        "id, category (Категория) и reorder_threshold (Порог) - по желанию.\n"
+        "Товары находятся по id, а без него - по названию; остальные добавляются. "
+        "Подойдёт и файл экспорта склада.\n\n"
+        "Перед записью бот покажет, что изменится.",
+        reply_markup=get_cancel_keyboard()
+    )
+
+
+@warehouse_router.message(F.document, StateFilter("importing_products"))
+@admin_required
+async def import_products_file(message: types.Message, state: FSMContext):
+    document = message.document
+    suffix = Path(document.file_name or "").suffix.lower()
+    if suffix not in (".xlsx", ".csv"):
+        await message.answer("❌ Поддерживаются только файлы .xlsx и .csv.", reply_markup=get_cancel_keyboard())
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await message.answer("❌ Файл больше 20 МБ.", reply_markup=get_cancel_keyboard())
+        return
+
+    purge_stale_imports()
+    user_id = message.from_user.id
+    path = get_current_club().export_dir / f"import_{user_id}_{int(time.time())}{suffix}"
+    errors_path = path.with_suffix(".errors.csv")
+    try:
+        progress_message = await message.answer("⏳ Проверка файла...")
+        await bot.download(document, destination=path)
+        try:
+            result = await asyncio.to_thread(parse_product_import, path)
+        except ValueError as e:
+            await progress_message.edit_text(f"❌ Не удалось прочитать файл: {e}")
+            return
+
+        await state.set_state(None)
+        text = (
+            f"📋 Проверка файла {document.file_name}:\n\n"
+            f"➕ Новых товаров: {result.created}\n"
+            f"✏️ Изменится: {result.updated}\n"
+            f"▫️ Без изменений: {result.unchanged}\n"
+            f"⚠️ Строк с ошибками: {len(result.errors)}"
         )
+        if result.preview:
+            text += "\n\n" + "\n".join(result.preview)
+            if result.created + result.updated > len(result.preview):
+                text += f"\n… и ещё {result.created + result.updated - len(result.preview)}"
+        if result.errors:
+            text += "\n\nОшибки:\n" + "\n".join(
+                f"• строка {line}: {error}" for line, error in result.errors[:IMPORT_PREVIEW_LINES])
+            if len(result.errors) > IMPORT_PREVIEW_LINES:
+                text += "\n… полный список в файле ниже"
+                await asyncio.to_thread(write_import_errors, errors_path, result.errors)
+
+        if result.rows:
+            pending_imports[get_current_club().slug, user_id] = (time.time(), result)
+            text += "\n\nСтроки с ошибками будут пропущены." if result.errors else ""
+            await progress_message.edit_text(text, reply_markup=get_import_keyboard())
+        else:
+            pending_imports.pop((get_current_club().slug, user_id), None)
+            await progress_message.edit_text(text + "\n\n📭 Применять нечего.")
+        await message.answer("👑 Панель администратора", reply_markup=get_admin_keyboard())
+
+        if errors_path.exists():
+            await message.answer_document(
+                document=FSInputFile(errors_path, filename=f"ошибки_импорта_{Path(document.file_name).stem}.csv"),
+                caption=f"⚠️ Ошибки импорта: {len(result.errors)} строк"
+            )
+
+    except Exception as e:
+        logger.error(f"Ошибка проверки файла импорта: {e}", exc_info=True)
+        await message.answer("❌ Произошла ошибка при проверке файла!", reply_markup=get_admin_keyboard())
+        await state.set_state(None)
+
     finally:
-        if 'output' in locals():
-            output.close()
+        path.unlink(missing_ok=True)
+        errors_path.unlink(missing_ok=True)
+
+
+@warehouse_router.callback_query(F.data == "import_apply")
+@admin_required
+async def import_products_apply(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    result = take_pending_import(user_id)
+    if result is None:
+        await callback.answer("❌ Импорт устарел, отправьте файл заново", show_alert=True)
+        return
+
+    try:
+        await callback.answer("⏳ Применение импорта...")
+        created, updated = await db.transaction(_apply_product_import, result.rows, user_id)
+        stock_alerts.wake()
+        await callback.message.edit_text(
+            f"✅ Импорт применён!\n➕ Добавлено товаров: {created}\n✏️ Обновлено: {updated}"
+        )
+        await log_action(user_id, "Импорт товаров", f"Добавлено: {created}, обновлено: {updated}")
+
+    except Exception as e:
+        logger.error(f"Ошибка применения импорта: {e}", exc_info=True)
+        await callback.message.answer("❌ Ошибка при применении импорта, склад не изменён.")
+
+
+@warehouse_router.callback_query(F.data == "import_cancel")
+@admin_required
+async def import_products_cancel(callback: types.CallbackQuery):
+    pending_imports.pop((get_current_club().slug, callback.from_user.id), None)
+    await callback.message.edit_text("❌ Импорт отменён.")
+    await callback.answer()
 
 
 # ===== ОТЧЕТ ПО СМЕНЕ =====
-@dp.message(F.text == "📝 Отчёт по смене")
+@reports_router.button("📝 Отчёт по смене")
 @access_required
 async def shift_report_menu(message: types.Message):
     await message.answer(
@@ -2098,106 +5345,101 @@ async def shift_report_menu(message: types.Message):
     )
 
 
-@dp.message(F.text == "📋 Создать отчёт")
+@reports_router.button("📋 Создать отчёт")
 @access_required
-async def create_report_start(message: types.Message):
+async def create_report_start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     today = datetime.now().strftime('%Y-%m-%d')
 
-    cursor.execute("SELECT id FROM shift_reports WHERE user_id = ? AND report_date = ?", (user_id, today))
-    if cursor.fetchone():
+    if await db.fetchone("SELECT id FROM shift_reports WHERE user_id = ? AND report_date = ?", (user_id, today)):
         await message.answer("⚠️ Отчёт за сегодня уже существует! Используйте 'Обновить отчёт'.")
         return
 
-    user_states[user_id] = "report_date"
-    user_data[user_id] = {
-        'report': {
-            'report_date': today,
-            'fields': ['total', 'cash', 'card', 'bar', 'hookah_count', 'expenses'],
-            'current_field': 0,
-            'labels': [
-                "общую сумму выручки",
-                "сумму наличных",
-                "сумму безналичных",
-                "выручку по бару",
-                "количество проданных кальянов",
-                "сумму расходов"
-            ]
-        }
+    report_data = {
+        'report_date': today,
+        'fields': ['total', 'cash', 'card', 'bar', 'hookah_count', 'expenses'],
+        'current_field': 0,
+        'labels': [
+            "общую сумму выручки",
+            "сумму наличных",
+            "сумму безналичных",
+            "выручку по бару",
+            "количество проданных кальянов",
+            "сумму расходов"
+        ]
     }
+    await state.set_state("report_date")
+    await state.set_data({'report': report_data})
 
     await message.answer(
         f"📅 Создание отчёта за {today}\n"
-        f"Введите {user_data[user_id]['report']['labels'][0]}:",
+        f"Введите {report_data['labels'][0]}:",
         reply_markup=get_cancel_keyboard()
     )
 
 
-@dp.message(F.text == "🔄 Обновить отчёт")
+@reports_router.button("🔄 Обновить отчёт")
 @access_required
-async def update_report_start(message: types.Message):
+async def update_report_start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     today = datetime.now().strftime('%Y-%m-%d')
 
-    cursor.execute(
+    report = await db.fetchone(
         "SELECT total, cash, card, bar, hookah_count, expenses "
         "FROM shift_reports WHERE user_id = ? AND report_date = ?",
         (user_id, today)
     )
-    report = cursor.fetchone()
 
     if not report:
         await message.answer("ℹ️ Отчёт за сегодня ещё не создан. Используйте 'Создать отчёт'.")
         return
 
-    user_states[user_id] = "update_report"
-    user_data[user_id] = {
-        'report': {
-            'report_date': today,
-            'fields': ['total', 'cash', 'card', 'bar', 'hookah_count', 'expenses'],
-            'current_field': 0,
-            'values': list(report),
-            'labels': [
-                "общую сумму выручки",
-                "сумму наличных",
-                "сумму безналичных",
-                "выручку по бару",
-                "количество проданных кальянов",
-                "сумму расходов"
-            ]
-        }
+    report_data = {
+        'report_date': today,
+        'fields': ['total', 'cash', 'card', 'bar', 'hookah_count', 'expenses'],
+        'current_field': 0,
+        'values': list(report),
+        'labels': [
+            "общую сумму выручки",
+            "сумму наличных",
+            "сумму безналичных",
+            "выручку по бару",
+            "количество проданных кальянов",
+            "сумму расходов"
+        ]
     }
+    await state.set_state("update_report")
+    await state.set_data({'report': report_data})
 
     await message.answer(
         f"🔄 Обновление отчёта за {today}\n"
-        f"Текущее значение {user_data[user_id]['report']['labels'][0]}: "
-        f"{user_data[user_id]['report']['values'][0]}\n"
+        f"Текущее значение {report_data['labels'][0]}: "
+        f"{report_data['values'][0]}\n"
         f"Введите новое значение или нажмите '⏭ Пропустить':",
         reply_markup=get_skip_keyboard()
     )
 
 
-@dp.message(F.text, lambda message: user_states.get(message.from_user.id) in ["report_date", "update_report"])
-async def process_report_data(message: types.Message):
+@reports_router.state("report_date", "update_report")
+async def process_report_data(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    state = user_states[user_id]
-    report_data = user_data[user_id]['report']
+    report_state = await state.get_state()
+    report_data = (await state.get_data())['report']
     current_field = report_data['current_field']
     field_name = report_data['fields'][current_field]
 
     # Обработка отмены
     if message.text == "❌ Отмена":
-        user_states[user_id] = None
-        if 'report' in user_data[user_id]:
-            del user_data[user_id]['report']
+        await state.clear()
         await message.answer("❌ Создание отчета отменено", reply_markup=get_report_keyboard())
         return
 
     # Обработка пропуска (только для обновления)
-    if state == "update_report" and message.text == "⏭ Пропустить":
+    if report_state == "update_report" and message.text == "⏭ Пропустить":
         report_data['current_field'] += 1
 
         if report_data['current_field'] < len(report_data['fields']):
+            await state.update_data(report=report_data)
             next_index = report_data['current_field']
             next_label = report_data['labels'][next_index]
             current_value = report_data['values'][next_index]
@@ -2208,7 +5450,7 @@ async def process_report_data(message: types.Message):
                 reply_markup=get_skip_keyboard()
             )
         else:
-            await save_report(message, user_id, state, report_data)
+            await save_report(message, state, report_state, report_data)
         return
 
     # Проверка введенных данных
@@ -2222,14 +5464,14 @@ async def process_report_data(message: types.Message):
             raise ValueError("Отрицательное значение")
     except:
         error_msg = "❌ Ошибка! Введите корректное положительное число."
-        if state == "update_report":
+        if report_state == "update_report":
             error_msg += "\nИли нажмите '⏭ Пропустить' чтобы оставить текущее значение."
             await message.answer(error_msg, reply_markup=get_skip_keyboard())
         else:
             await message.answer(error_msg, reply_markup=get_cancel_keyboard())
         return
 
-    if state == "report_date":
+    if report_state == "report_date":
         report_data[field_name] = value
     else:
         report_data['values'][current_field] = value
@@ -2237,10 +5479,11 @@ async def process_report_data(message: types.Message):
     report_data['current_field'] += 1
 
     if report_data['current_field'] < len(report_data['fields']):
+        await state.update_data(report=report_data)
         next_index = report_data['current_field']
         next_label = report_data['labels'][next_index]
 
-        if state == "update_report":
+        if report_state == "update_report":
             current_value = report_data['values'][next_index]
             await message.answer(
                 f"Текущее значение {next_label}: {current_value}\n"
@@ -2250,19 +5493,20 @@ async def process_report_data(message: types.Message):
         else:
             await message.answer(f"Введите {next_label}:", reply_markup=get_cancel_keyboard())
     else:
-        await save_report(message, user_id, state, report_data)
+        await save_report(message, state, report_state, report_data)
 
 
-async def save_report(message: types.Message, user_id: int, state: str, report_data: dict):
+async def save_report(message: types.Message, state: FSMContext, report_state: str, report_data: dict):
+    user_id = message.from_user.id
     try:
         # Рассчитываем баланс: initial_cash + cash - expenses
         initial_cash = 4000
-        cash = report_data['cash'] if state == "report_date" else report_data['values'][1]
-        expenses = report_data['expenses'] if state == "report_date" else report_data['values'][5]
+        cash = report_data['cash'] if report_state == "report_date" else report_data['values'][1]
+        expenses = report_data['expenses'] if report_state == "report_date" else report_data['values'][5]
         balance = initial_cash + cash - expenses
 
-        if state == "report_date":
-            cursor.execute(
+        if report_state == "report_date":
+            await db.execute(
                 "INSERT INTO shift_reports "
                 "(user_id, report_date, total, cash, card, bar, hookah_count, expenses, initial_cash, balance) "
                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
@@ -2278,7 +5522,7 @@ async def save_report(message: types.Message, user_id: int, state: str, report_d
                 balance
             ]
         else:
-            cursor.execute(
+            await db.execute(
                 "UPDATE shift_reports SET "
                 "total = ?, cash = ?, card = ?, bar = ?, "
                 "hookah_count = ?, expenses = ?, balance = ? "
@@ -2291,8 +5535,6 @@ async def save_report(message: types.Message, user_id: int, state: str, report_d
             action = "обновлен"
             report_values = report_data['values'] + [balance]
 
-        conn.commit()
-
         report_text = (
             f"📝 Отчёт по смене {report_data['report_date']} {action}:\n\n"
             f"• Общая сумма: {report_values[0]} ₽\n"
@@ -2310,11 +5552,10 @@ async def save_report(message: types.Message, user_id: int, state: str, report_d
         await log_action(user_id, f"Отчёт {action}", f"Дата: {report_data['report_date']}")
 
         # Отправка отчета в настроенную группу
-        report_chat_id = get_notification_chat("reports")
+        report_chat_id = await get_notification_chat("reports")
         if report_chat_id:
             try:
-                cursor.execute("SELECT first_name, username FROM users WHERE user_id = ?", (user_id,))
-                user_info = cursor.fetchone()
+                user_info = await db.fetchone("SELECT first_name, username FROM users WHERE user_id = ?", (user_id,))
                 first_name = user_info[0] if user_info and user_info[0] else "Неизвестный"
                 username = f"@{user_info[1]}" if user_info and user_info[1] else "без username"
 
@@ -2332,7 +5573,8 @@ async def save_report(message: types.Message, user_id: int, state: str, report_d
                     f"💵 Чистая прибыль: {report_values[0] - report_values[5]} ₽"
                 )
 
-                await bot.send_message(report_chat_id, group_report)
+                if not await notifier.send(report_chat_id, group_report, PRIORITY_REPORT):
+                    raise RuntimeError(f"отчет не доставлен в чат {report_chat_id}")
                 await log_action(user_id, "Отправка отчета в группу", f"Группа: {report_chat_id}")
             except Exception as e:
                 logger.error(f"Ошибка отправки отчета в группу: {e}")
@@ -2343,23 +5585,20 @@ async def save_report(message: types.Message, user_id: int, state: str, report_d
         await message.answer("❌ Ошибка сохранения отчёта!", reply_markup=get_report_keyboard())
 
     finally:
-        user_states[user_id] = None
-        if 'report' in user_data[user_id]:
-            del user_data[user_id]['report']
+        await state.clear()
 
 
-@dp.message(F.text == "📅 История отчётов")
+@reports_router.button("📅 История отчётов")
 @access_required
 async def report_history(message: types.Message):
     user_id = message.from_user.id
 
     try:
-        cursor.execute(
+        reports = await db.fetchall(
             "SELECT report_date, total, cash, card, bar, hookah_count, expenses, balance "
             "FROM shift_reports WHERE user_id = ? ORDER BY report_date DESC LIMIT 10",
             (user_id,)
         )
-        reports = cursor.fetchall()
 
         if not reports:
             await message.answer("📭 У вас ещё нет сохранённых отчётов.")
@@ -2385,111 +5624,432 @@ async def report_history(message: types.Message):
         await message.answer("❌ Ошибка получения истории отчётов!", reply_markup=get_report_keyboard())
 
 
+# ===== АНАЛИТИКА ПО ОТЧЁТАМ =====
+# Сводки читаются из report_rollups, которую триггеры обновляют при каждом
+# сохранении отчёта, поэтому итоги за любой период - это несколько строк
+# по первичному ключу, а не пересчёт всей истории shift_reports.
+ROLLUP_PERIODS = {
+    "day": "день", "день": "день",
+    "week": "неделя", "неделя": "неделя",
+    "month": "месяц", "месяц": "месяц",
+}
+ROLLUP_PERIOD_KEYS = {"день": "day", "неделя": "week", "месяц": "month"}
+TREND_DEFAULT_PERIODS = 6
+TREND_MAX_PERIODS = 36
+ANALYTICS_HELP = (
+    "Команды аналитики:\n"
+    "/summary [day|week|month] - итоги текущего периода и сравнение с прошлым\n"
+    "/trend [day|week|month] [N] - выручка и прибыль за последние N периодов\n"
+    "/analytics [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД] - подробная аналитика в Excel"
+)
+
+
+def get_period_start(day, period):
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    return day
+
+
+def parse_rollup_period(args, default="month"):
+    name = ROLLUP_PERIODS.get(args[0].lower()) if args else ROLLUP_PERIODS[default]
+    return ROLLUP_PERIOD_KEYS.get(name)
+
+
+def format_change(current, previous):
+    if not previous:
+        return ""
+    return f" ({(current - previous) * 100 / abs(previous):+.1f}%)"
+
+
+async def fetch_period_summary(period, start):
+    """Возвращает строки сводки по сотрудникам за период, начинающийся с start."""
+    return await db.fetchall(
+        """
+        SELECT r.user_id, u.first_name, r.reports, r.total, r.cash, r.card, r.bar,
+               r.hookah_count, r.expenses, r.net_profit
+        FROM report_rollups r
+                 LEFT JOIN users u ON r.user_id = u.user_id
+        WHERE r.period = ? AND r.period_start = ?
+        ORDER BY r.total DESC
+        """,
+        (period, start.isoformat())
+    )
+
+
+async def fetch_trend(period, count):
+    """Итоги по всем сотрудникам за последние count периодов, от старых к новым."""
+    start = get_period_start(datetime.now().date(), period)
+    for _ in range(count - 1):
+        start = get_period_start(start - timedelta(days=1), period)
+    return await db.fetchall(
+        """
+        SELECT period_start, SUM(reports), SUM(total), SUM(expenses), SUM(net_profit)
+        FROM report_rollups
+        WHERE period = ? AND period_start >= ?
+        GROUP BY period_start
+        ORDER BY period_start
+        """,
+        (period, start.isoformat())
+    )
+
+
+def sum_summary(rows):
+    # Колонки: reports, total, cash, card, bar, hookah_count, expenses, net_profit
+    return [sum(row[i] for row in rows) for i in range(2, 10)]
+
+
+async def build_summary_text(period):
+    start = get_period_start(datetime.now().date(), period)
+    previous_start = get_period_start(start - timedelta(days=1), period)
+
+    rows = await fetch_period_summary(period, start)
+    previous = sum_summary(await fetch_period_summary(period, previous_start))
+    if not rows:
+        return f"📭 За текущий период ({ROLLUP_PERIODS[period]} с {start}) отчётов нет."
+
+    reports, total, cash, card, bar, hookah_count, expenses, net_profit = sum_summary(rows)
+    response = (
+        f"📈 Итоги: {ROLLUP_PERIODS[period]} с {start}\n"
+        f"(сравнение с периодом с {previous_start})\n\n"
+        f"├ Отчётов: {reports}\n"
+        f"├ Выручка: {total:.2f} ₽{format_change(total, previous[1])}\n"
+        f"├ Наличные: {cash:.2f} ₽\n"
+        f"├ Безнал: {card:.2f} ₽\n"
+        f"├ Бар: {bar:.2f} ₽{format_change(bar, previous[4])}\n"
+        f"├ Кальяны: {hookah_count} шт.{format_change(hookah_count, previous[5])}\n"
+        f"├ Расходы: {expenses:.2f} ₽{format_change(expenses, previous[6])}\n"
+        f"└ Чистая прибыль: {net_profit:.2f} ₽{format_change(net_profit, previous[7])}\n\n"
+        f"👥 По сотрудникам:\n"
+    )
+    for row in rows:
+        response += (
+            f"▪️ {row[1] or row[0]}: {row[3]:.2f} ₽, "
+            f"прибыль {row[9]:.2f} ₽, отчётов {row[2]}\n"
+        )
+    return response
+
+
+@reports_router.button("📈 Аналитика")
+@admin_required
+async def analytics_menu(message: types.Message):
+    try:
+        await message.answer(await build_summary_text("month") + "\n" + ANALYTICS_HELP)
+    except Exception as e:
+        logger.error(f"Ошибка получения аналитики: {e}")
+        await message.answer("❌ Ошибка получения аналитики.")
+
+
+@reports_router.message(Command("summary"))
+@admin_required
+async def period_summary(message: types.Message):
+    period = parse_rollup_period(message.text.split()[1:])
+    if not period:
+        await message.answer(f"❌ Неизвестный период.\n\n{ANALYTICS_HELP}")
+        return
+
+    try:
+        await message.answer(await build_summary_text(period))
+    except Exception as e:
+        logger.error(f"Ошибка получения сводки: {e}")
+        await message.answer("❌ Ошибка получения сводки.")
+
+
+@reports_router.message(Command("trend"))
+@admin_required
+async def revenue_trend(message: types.Message):
+    args = message.text.split()[1:]
+    period = parse_rollup_period(args)
+    count = int(args[1]) if len(args) > 1 and args[1].isdigit() else TREND_DEFAULT_PERIODS
+    if not period or not 1 <= count <= TREND_MAX_PERIODS:
+        await message.answer(f"❌ Неверные параметры (не более {TREND_MAX_PERIODS} периодов).\n\n{ANALYTICS_HELP}")
+        return
+
+    try:
+        rows = await fetch_trend(period, count)
+        if not rows:
+            await message.answer("📭 Нет отчётов за выбранные периоды.")
+            return
+
+        response = f"📈 Динамика ({ROLLUP_PERIODS[period]}, последние {count}):\n\n"
+        previous_total = None
+        for period_start, reports, total, expenses, net_profit in rows:
+            response += (
+                f"📅 {period_start}: {total:.2f} ₽{format_change(total, previous_total)}\n"
+                f"   прибыль {net_profit:.2f} ₽, расходы {expenses:.2f} ₽, отчётов {reports}\n"
+            )
+            previous_total = total
+
+        for i in range(0, len(response), MESSAGE_MAX_LENGTH):
+            await message.answer(response[i:i + MESSAGE_MAX_LENGTH])
+
+    except Exception as e:
+        logger.error(f"Ошибка получения динамики: {e}")
+        await message.answer("❌ Ошибка получения динамики.")
+
+
 # ===== ОБРАБОТЧИК ОТМЕНЫ =====
-@dp.message(F.text == "❌ Отмена")
+@common_router.button("❌ Отмена")
 @access_required
-async def cancel_action(message: types.Message):
+async def cancel_action(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    state = user_states.get(user_id)
+    current_state = await state.get_state()
 
-    if state:
-        if state.startswith(("adding_", "searching", "editing_")):
-            user_states[user_id] = None
-            if user_id in user_data:
-                user_data[user_id] = {}
+    if current_state:
+        if current_state.startswith(("adding_", "searching", "editing_")):
+            await state.clear()
             await message.answer("❌ Действие отменено", reply_markup=get_warehouse_keyboard())
-        elif state in ["report_date", "update_report"]:
-            user_states[user_id] = None
-            if user_id in user_data and 'report' in user_data[user_id]:
-                del user_data[user_id]['report']
+        elif current_state in ["report_date", "update_report"]:
+            await state.clear()
             await message.answer("❌ Действие отменено", reply_markup=get_report_keyboard())
-        elif state.endswith(("_user")):
-            user_states[user_id] = None
+        elif current_state == "importing_products":
+            await state.set_state(None)
+            await message.answer("❌ Импорт отменён", reply_markup=get_admin_keyboard())
+        elif current_state.endswith(("_user")):
+            await state.set_state(None)
             await message.answer("❌ Действие отменено", reply_markup=get_user_management_keyboard())
     else:
-        await message.answer("❌ Нет активных действий для отмены", reply_markup=get_main_keyboard(user_id))
+        await message.answer("❌ Нет активных действий для отмены", reply_markup=await get_main_keyboard(user_id))
 
 
 # ===== ОБРАБОТЧИК КНОПКИ "НАЗАД" =====
-@dp.message(F.text == "🔙 Назад")
-async def back_handler(message: types.Message):
+@common_router.button("🔙 Назад")
+async def back_handler(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
 
-    if user_states.get(user_id) in ["editing_name", "editing_quantity", "editing_category"]:
-        user_states[user_id] = None
+    if await state.get_state() in ["editing_name", "choosing_movement", "editing_quantity", "editing_category",
+                                   "editing_threshold"]:
+        await state.set_state(None)
         await message.answer("❌ Изменение товара отменено", reply_markup=get_warehouse_keyboard())
         return
 
-    if user_data.get(user_id) and "edit_id" in user_data[user_id]:
+    if "edit_id" in await state.get_data():
         await edit_product_start(message)
         return
 
-    await message.answer("Главное меню:", reply_markup=get_main_keyboard(user_id))
+    await message.answer("Главное меню:", reply_markup=await get_main_keyboard(user_id))
 
 
-# ===== ОБРАБОТЧИК КНОПКИ "НАЗАД В ГЛАВНОЕ МЕНЮ" =====
-@dp.message(F.text == "🔙 Назад в главное меню")
-async def back_to_main_menu(message: types.Message):
-    await message.answer("Главное меню:", reply_markup=get_main_keyboard(message.from_user.id))
+# ===== ТАБЛИЦА МЕНЮ =====
+# Регистрируется после всех команд, чтобы команда в середине диалога
+# выполнялась, а не принималась за ответ на вопрос бота
+menu_index.build()
+common_router.message.register(menu_index.dispatch, menu_index.match)
 
 
 # ===== ОБРАБОТЧИКИ ДЛЯ ГРУПП И НЕИЗВЕСТНЫХ КОМАНД =====
-@dp.message(F.chat.type.in_({"group", "supergroup"}))
+@common_router.message(F.chat.type.in_({"group", "supergroup"}))
 async def handle_group_messages(message: types.Message):
     pass
 
 
-@dp.message(F.chat.type == "private")
+@common_router.message(F.chat.type == "private")
 @access_required
 async def unknown_command(message: types.Message):
     user_id = message.from_user.id
     await message.answer(
         "❌ Неизвестная команда. Возвращаю вас в главное меню.",
-        reply_markup=get_main_keyboard(user_id)
+        reply_markup=await get_main_keyboard(user_id)
     )
     await log_action(user_id, "Неизвестная команда", f"Введен текст: {message.text}")
 
 
+dp.include_routers(warehouse_router, reports_router, admin_router, notifications_router, common_router)
+
+
+# ===== РЕЖИМ WEBHOOK =====
+# BOT_MODE=webhook поднимает HTTP-сервер вместо long polling. Если задан
+# WEBHOOK_URL, адрес регистрируется в Telegram при запуске; без него сервер
+# принимает обновления только локально (например, записанные JSON через curl).
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # внешний адрес, например https://example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "32"))
+WEBHOOK_DRAIN_TIMEOUT = 30.0  # секунды на завершение начатых обработчиков при остановке
+
+
+class WebhookServer:
+    """aiohttp-приложение, передающее обновления Telegram диспетчеру.
+
+    Запрос проверяется по заголовку X-Telegram-Bot-Api-Secret-Token и
+    подтверждается сразу, а обработка идёт в фоне. Одновременно выполняется
+    не больше max_concurrency обработчиков: при заполнении лимита сервер
+    не отвечает на новые запросы, пока не освободится место, и Telegram
+    сам придерживает следующие обновления. При остановке новые запросы
+    отклоняются, а уже начатые обработчики дорабатывают до конца.
+    """
+
+    def __init__(self, dispatcher, bot, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                 max_concurrency=WEBHOOK_MAX_CONCURRENCY):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.tasks = set()
+        self.accepting = False
+        self.handled_count = 0
+        self.failed_count = 0
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle)
+        self._runner = None
+
+    async def handle(self, request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if self.secret and not secrets.compare_digest(token, self.secret):
+            logger.warning(f"Отклонён запрос webhook с неверным секретом от {request.remote}")
+            return web.Response(status=401)
+        if not self.accepting:
+            return web.Response(status=503)
+
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        await self.semaphore.acquire()
+        if not self.accepting:
+            self.semaphore.release()
+            return web.Response(status=503)
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        try:
+            await self.dispatcher.feed_raw_update(self.bot, update)
+            self.handled_count += 1
+        except Exception as e:
+            self.failed_count += 1
+            logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+        finally:
+            self.semaphore.release()
+
+    async def start(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT, url=WEBHOOK_URL):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.accepting = True
+        logger.info(f"🌐 Webhook-сервер слушает {host}:{port}{self.path}")
+
+        if url:
+            await self.bot.set_webhook(
+                url=url.rstrip("/") + self.path,
+                secret_token=self.secret or None,
+                max_connections=self.max_concurrency,
+                allowed_updates=self.dispatcher.resolve_used_update_types()
+            )
+            logger.info(f"🌐 Webhook зарегистрирован: {url.rstrip('/')}{self.path}")
+
+    async def stop(self, timeout=WEBHOOK_DRAIN_TIMEOUT):
+        self.accepting = False
+        if self.tasks:
+            logger.info(f"⏳ Ожидание завершения обработчиков: {len(self.tasks)}")
+            done, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning(f"Прервано обработчиков по таймауту: {len(pending)}")
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def wait_for_stop_signal():
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: остановка через KeyboardInterrupt
+    await stop_event.wait()
+
+
+webhook_server = WebhookServer(dp, bot)
+
+
+# ===== ЭНДПОИНТ МЕТРИК =====
+# При METRICS_PORT > 0 метрики обработчиков отдаются в текстовом формате
+# Prometheus по адресу http://METRICS_HOST:METRICS_PORT/metrics. По умолчанию
+# сервер слушает только локальный интерфейс.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 - эндпоинт выключен
+
+
+class MetricsServer:
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.app = web.Application()
+        self.app.router.add_get("/metrics", self.handle)
+        self._runner = None
+
+    async def handle(self, request):
+        return web.Response(text=self.metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    async def start(self, host=METRICS_HOST, port=METRICS_PORT):
+        if port <= 0 or self._runner is not None:
+            return
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer(handler_metrics)
+
+
 # ===== ЗАПУСК БОТА =====
 async def main():
     logger.info("=" * 50)
     logger.info(f"🤖 ЗАПУСК СИСТЕМЫ SoraEcoSystemBot")
     logger.info(f"⏰ Время запуска: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     logger.info(f"🔑 ID главного администратора: {MAIN_ADMIN_ID}")
+    logger.info(f"💾 Профиль базы данных: {DB_PROFILE}")
+    logger.info(f"🏢 Клубов: {len(clubs.clubs)}, открытых баз одновременно: до {CLUBS_MAX_OPEN}")
 
-    if not is_registered(MAIN_ADMIN_ID):
-        cursor.execute(
-            "INSERT INTO users (user_id, username, first_name, is_admin, is_approved) VALUES (?, ?, ?, ?, ?)",
-            (MAIN_ADMIN_ID, "sora_admin", "Sora Admin", 1, 1)
-        )
-        conn.commit()
-        logger.info("✅ Главный администратор зарегистрирован")
-
-    try:
-        cursor.execute("SELECT COUNT(*) FROM users")
-        user_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM products")
-        product_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM action_logs")
-        log_count = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_approved = 1")
-        approved_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_approved = 0 AND is_banned = 0")
-        pending_count = cursor.fetchone()[0]
-
-        logger.info(f"👥 Пользователей в системе: {user_count}")
-        logger.info(f"├ Одобренные: {approved_count}")
-        logger.info(f"└ Ожидают одобрения: {pending_count}")
-        logger.info(f"📦 Товаров на складе: {product_count}")
-        logger.info(f"📝 Лог-записей действий: {log_count}")
+    try:
+        # Основной клуб открывается сразу: администратор регистрируется при открытии базы
+        async with clubs.use(DEFAULT_CLUB):
+            stats = await get_stats()
+
+        logger.info(f"👥 Пользователей в системе: {stats['users_total']}")
+        logger.info(f"├ Одобренные: {stats['users_approved']}")
+        logger.info(f"└ Ожидают одобрения: {stats['users_pending']}")
+        logger.info(f"📦 Товаров на складе: {stats['products_total']}")
+        logger.info(f"📝 Лог-записей действий: {stats['action_logs_total']}")
         logger.info("=" * 50)
     except Exception as e:
         logger.error(f"Ошибка при получении статистики: {e}")
 
-    logger.info("🟢 Бот запущен и готов к работе")
+    clubs.start()
+    fsm_storage.start_cleanup()
+    action_log.start()
+    log_archiver.start()
+    notifier.start()
+    stock_alerts.start()
+    await metrics_server.start()
+
+    logger.info(f"🟢 Бот запущен и готов к работе (режим: {BOT_MODE})")
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await webhook_server.start()
+            await wait_for_stop_signal()
+        else:
+            # Polling не работает, пока у бота зарегистрирован webhook
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except KeyboardInterrupt:
         logger.info("⏹️ Получен сигнал остановки (Ctrl+C)")
     except Exception as e:
@@ -2499,16 +6059,37 @@ async def main():
         logger.info(f"🛑 ЗАВЕРШЕНИЕ РАБОТЫ SoraEcoSystemBot")
         logger.info(f"⏰ Время остановки: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
+        if BOT_MODE == "webhook":
+            await webhook_server.stop()
+            logger.info(f"🌐 Обработано обновлений: {webhook_server.handled_count}, "
+                        f"с ошибкой: {webhook_server.failed_count}")
+
+        await metrics_server.stop()
+        await stock_alerts.stop()
+        await log_archiver.stop()
+        await fsm_storage.close()
+        logger.info("📝 Запись буфера журнала действий...")
+        await action_log.stop()
+        logger.info(f"├ Записано: {action_log.flushed_count}")
+        logger.info(f"└ Отброшено: {action_log.dropped_count}")
+
+        logger.info("🔔 Отправка оставшихся уведомлений...")
+        await notifier.stop()
+        logger.info(f"├ Отправлено: {notifier.sent_count}")
+        logger.info(f"├ Повторов: {notifier.retry_count}")
+        logger.info(f"└ Ошибок: {notifier.failed_count}")
+        await bot.session.close()
+
         try:
-            cursor.execute("SELECT COUNT(*) FROM action_logs WHERE timestamp > datetime('now', '-1 day')")
-            actions_24h = cursor.fetchone()[0]
-            logger.info(f"⚡ Активность за 24 часа: {actions_24h} действий")
+            async with clubs.use(DEFAULT_CLUB):
+                stats = await get_stats()
+            logger.info(f"⚡ Активность за 24 часа: {stats['actions_24h']} действий")
         except:
             pass
 
-        logger.info("📦 Закрытие соединения с базой данных...")
-        conn.close()
-        logger.info("✅ Соединение с базой данных закрыто")
+        logger.info(f"📦 Закрытие баз данных клубов (открыто: {len(clubs.open)})...")
+        await clubs.close()
+        logger.info("✅ Соединения с базами данных закрыты")
         logger.info("=" * 50)
         logger.info("👋 Работа бота завершена")
 
@@ -0,0 +1,891 @@
+"""
+Бенчмарки отдельных подсистем SoraEcoSystemBot на синтетических данных, без сети.
+
+Бот поднимается на временной базе так же, как в loadtest.py. Каждый сценарий
+сравнивает текущую реализацию с прежней, воспроизведённой здесь же по
+исходному коду, печатает таблицу и при --output сохраняет её в JSON:
+
+    python bench.py search --products 100000
+    python bench.py profiles
+    python bench.py export --rows 10000 100000 1000000
+    python bench.py pages --products 10000
+    python bench.py logs --rows 10000000
+    python bench.py rollups --years 5
+    python bench.py analytics --staff 200
+    python bench.py import --rows 50000
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import loadtest
+from loadtest import summarize
+
+NAME_WORDS = ["кола", "чипсы", "табак", "уголь", "сок", "вода", "мята", "лёд", "чай", "орехи",
+              "лимонад", "энергетик", "сухарики", "шоколад", "жвачка", "кофе", "сироп", "трубка"]
+NAME_KINDS = ["классический", "ледяной", "большой", "мини", "ягодный", "Двойной", "крепкий", "светлый"]
+CATEGORIES = ["Бар", "Кальян", "Снэки", "Напитки", None]
+
+
+def product_rows(count, rng):
+    """Синтетический склад: (название, количество, категория)."""
+    return [(f"{rng.choice(NAME_WORDS)} {rng.choice(NAME_KINDS)} {number}", rng.randint(0, 200),
+             rng.choice(CATEGORIES)) for number in range(count)]
+
+
+async def timed(func, *args):
+    started = time.perf_counter()
+    result = await func(*args)
+    return time.perf_counter() - started, result
+
+
+# ===== ПОИСК ТОВАРОВ =====
+SEARCH_QUERIES = ["кол", "кола", "чипсы", "ЛЁД", "лед", "мят", "двойной", "кофе ледяной", "снэки", "напитки",
+                  "сироп ягодный", "трубк", "шоколад мини", "Энергетик", "несуществующий"]
+
+
+async def bench_search(args, sora):
+    rng = random.Random(args.seed)
+    async with sora.clubs.use(sora.DEFAULT_CLUB):
+        await sora.db.executemany("INSERT INTO products (name, quantity, category) VALUES (?, ?, ?)",
+                                  product_rows(args.products, rng))
+
+        async def scan(search_term):
+            # Прежний search_product_execute: вся таблица и поиск подстроки в Python
+            found_products = []
+            for product in await sora.db.fetchall("SELECT * FROM products"):
+                name_match = search_term.lower() in product[1].lower() if product[1] else False
+                category_match = search_term.lower() in product[3].lower() if product[3] else False
+                if name_match or category_match:
+                    found_products.append(product)
+            return found_products
+
+        rows = []
+        for name, search in (("scan", scan), ("fts", sora.search_products)):
+            samples, found = [], []
+            for _ in range(args.repeat):
+                for query in SEARCH_QUERIES:
+                    duration, products = await timed(search, query)
+                    samples.append(duration)
+                    found.append(len(products))
+            summary = summarize(samples)
+            rows.append({"search": name, "products": args.products, "p50_ms": summary["p50_ms"],
+                         "p99_ms": summary["p99_ms"], "mean_found": round(sum(found) / len(found), 1)})
+        return rows
+
+
+# ===== ПРОФИЛИ SQLITE =====
+REPORT_INSERT = ("INSERT INTO shift_reports (user_id, report_date, total, cash, card, bar, hookah_count, expenses, "
+                 "balance) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+LOG_INSERT = "INSERT INTO action_logs (user_id, action, details) VALUES (?, ?, ?)"
+
+
+def write_reports(conn, count, rng):
+    # Как save_report: отчёт со сводками, пересчитываемыми триггерами, - отдельная транзакция
+    for number in range(count):
+        values = [rng.randint(1000, 50000) for _ in range(4)] + [rng.randint(0, 30), rng.randint(0, 5000), 0]
+        with conn:
+            report_date = (datetime(2024, 1, 1) + timedelta(days=number // 50)).strftime('%Y-%m-%d')
+            conn.execute(REPORT_INSERT, (number % 50, report_date, *values))
+
+
+def write_logs(conn, count, rng):
+    # Как прежний log_action: одна запись журнала - одна транзакция
+    for number in range(count):
+        with conn:
+            conn.execute(LOG_INSERT, (rng.randint(1, 50), "Поиск товара", f"Запрос: '{number}'"))
+
+
+def write_log_batches(conn, count, rng):
+    # Как буфер журнала действий: записи пачками по 100 в одной транзакции
+    for start in range(0, count, 100):
+        with conn:
+            conn.executemany(LOG_INSERT, [(rng.randint(1, 50), "Поиск товара", f"Запрос: '{number}'")
+                                          for number in range(start, min(start + 100, count))])
+
+
+async def bench_profiles(args, sora):
+    rng = random.Random(args.seed)
+    workloads = {"reports": (write_reports, args.reports), "logs": (write_logs, args.logs),
+                 "log_batches": (write_log_batches, args.logs)}
+    rows = []
+    for profile in ["legacy", *sora.DB_PROFILES]:
+        directory = Path(tempfile.mkdtemp(prefix=f"profile_{profile}_", dir=os.getcwd()))
+        if profile == "legacy":
+            # Прежнее подключение: журнал отката (DELETE) и настройки SQLite по умолчанию
+            conn = sqlite3.connect(directory / "SoraClub.db", check_same_thread=False)
+        else:
+            conn = sora.connect_db(directory / "SoraClub.db", profile)
+        sora.apply_migrations(conn)
+        row = {"profile": profile, "journal": conn.execute("PRAGMA journal_mode").fetchone()[0]}
+        for name, (workload, count) in workloads.items():
+            started = time.perf_counter()
+            workload(conn, count, rng)
+            row[f"{name}_per_s"] = round(count / (time.perf_counter() - started))
+        conn.close()
+        rows.append(row)
+    return rows
+
+
+# ===== ЭКСПОРТ В EXCEL =====
+EXPORT_PROBE_INTERVAL = 0.01  # секунды между замерами задержки цикла событий
+
+
+def old_export(sora):
+    # Прежний export_to_excel: все строки и вся книга в памяти, прямо в цикле событий
+    from io import BytesIO
+    from openpyxl import Workbook
+
+    conn = sora.connect_db(sora.get_current_club().path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, name, quantity, category, added_date FROM products")
+    columns = [column[0] for column in cursor.description]
+    data = cursor.fetchall()
+
+    output = BytesIO()
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = "Склад"
+    sheet.append(columns)
+    for row in data:
+        sheet.append(row)
+    workbook.save(output)
+    size = len(output.getvalue())
+    conn.close()
+    return size
+
+
+def peak_rss_mb():
+    # VmHWM - пик памяти именно этого процесса; ru_maxrss в Linux наследует пик родителя
+    for line in Path("/proc/self/status").read_text().splitlines():
+        if line.startswith("VmHWM:"):
+            return round(int(line.split()[1]) / 1024)
+
+
+def run_case(call):
+    """Выполняет bench.<call> в отдельном процессе, чтобы пик памяти не смешивался с другими замерами.
+
+    Возвращает словарь, который вызов печатает последней строкой в JSON.
+    """
+    process = subprocess.run([sys.executable, "-c", f"import bench; bench.{call}"], stdout=subprocess.PIPE,
+                             cwd=Path(__file__).parent)
+    if process.returncode:
+        return {"error": f"код выхода {process.returncode}"}
+    return json.loads(process.stdout.decode().strip().splitlines()[-1])
+
+
+def export_case(work_dir, mode):
+    """Один экспорт склада; запускается через run_case."""
+    sora = loadtest.import_bot(Path(work_dir))
+    rss_before = peak_rss_mb()
+
+    async def run():
+        loop_lags = []
+
+        async def probe_loop():
+            while True:
+                started = time.perf_counter()
+                await asyncio.sleep(EXPORT_PROBE_INTERVAL)
+                loop_lags.append(time.perf_counter() - started - EXPORT_PROBE_INTERVAL)
+
+        async with sora.clubs.use(sora.DEFAULT_CLUB):
+            path = sora.get_current_club().export_dir / "bench.xlsx"
+            probe = asyncio.create_task(probe_loop())
+            await asyncio.sleep(EXPORT_PROBE_INTERVAL * 2)
+            started = time.perf_counter()
+            if mode == "old":
+                size = old_export(sora)
+            else:
+                await asyncio.to_thread(sora.build_excel_export, path)
+                size = path.stat().st_size
+                path.unlink()
+            wall_time = time.perf_counter() - started
+            await asyncio.sleep(EXPORT_PROBE_INTERVAL * 2)
+            probe.cancel()
+        await sora.clubs.close()
+        return {"wall_s": round(wall_time, 2), "max_loop_lag_ms": round(max(loop_lags) * 1000, 1),
+                "file_mb": round(size / 2 ** 20, 1)}
+
+    result = asyncio.run(run())
+    result.update(rss_before_mb=rss_before, peak_rss_mb=peak_rss_mb())
+    print(json.dumps(result))
+
+
+async def bench_export(args, sora):
+    rng = random.Random(args.seed)
+    rows = []
+    async with sora.clubs.use(sora.DEFAULT_CLUB):
+        filled = 0
+        for count in sorted(args.rows):
+            await sora.db.executemany("INSERT INTO products (name, quantity, category) VALUES (?, ?, ?)",
+                                      product_rows(count - filled, rng))
+            await sora.db.checkpoint()
+            filled = count
+            for mode in ("old", "new"):
+                if mode == "old" and args.old_limit and count > args.old_limit:
+                    continue
+                rows.append({"export": mode, "rows": count,
+                             **run_case(f"export_case({os.getcwd()!r}, {mode!r})")})
+    return rows
+
+
+# ===== СПИСКИ ТОВАРОВ =====
+async def old_views(sora, chat_id):
+    """Прежние show_warehouse, edit_product_start и delete_product_start: весь склад одним ответом."""
+    from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
+
+    queries = 0
+
+    async def fetchall(sql):
+        nonlocal queries
+        queries += 1
+        return await sora.db.fetchall(sql)
+
+    async def show_warehouse():
+        products = await fetchall("SELECT * FROM products ORDER BY quantity ASC")
+        low_stock = await fetchall("SELECT * FROM products WHERE quantity < 10 ORDER BY quantity ASC")
+
+        response = "📋 Список товаров:\n\n"
+        for product in products:
+            response += (
+                f"{'⚠️' if product[2] < 10 else '🔹'} ID: {product[0]}\n"
+                f"Название: {product[1]}\n"
+                f"Количество: {product[2]}\n"
+                f"Категория: {product[3] if product[3] else 'не указана'}\n"
+                f"Добавлен: {product[4]}\n\n"
+            )
+        if low_stock:
+            warning = "🚨 Внимание! Заканчиваются следующие товары:\n\n"
+            for product in low_stock:
+                warning += f"▪️ {product[1]} (ID: {product[0]}) - осталось {product[2]} шт.\n"
+            response = warning + "\n" + response
+
+        max_length = 4000
+        for i in range(0, len(response), max_length):
+            await sora.bot.send_message(chat_id, response[i:i + max_length])
+
+    async def edit_product_start():
+        keyboard = [[KeyboardButton(text=f"✏️ {product[1]} (ID: {product[0]}, Кол-во: {product[2]})")]
+                    for product in await fetchall("SELECT id, name, quantity FROM products")]
+        keyboard.append([KeyboardButton(text="🔙 Назад")])
+        await sora.bot.send_message(chat_id, "Выберите товар для редактирования:",
+                                    reply_markup=ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True))
+
+    async def delete_product_start():
+        keyboard = [[KeyboardButton(text=f"❌ Удалить {product[1]} (ID: {product[0]})")]
+                    for product in await fetchall("SELECT id, name FROM products")]
+        keyboard.append([KeyboardButton(text="🔙 Назад")])
+        await sora.bot.send_message(chat_id, "Выберите товар для удаления:",
+                                    reply_markup=ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True))
+
+    for view, handler in (("list", show_warehouse), ("edit", edit_product_start), ("delete", delete_product_start)):
+        queries = 0
+        yield view, handler, lambda: queries
+
+
+async def bench_pages(args, sora):
+    from aiogram import types
+
+    rng = random.Random(args.seed)
+    session = loadtest.install_fake_session(sora, record=True)
+    chat_id = sora.MAIN_ADMIN_ID
+    update_ids = iter(range(1, 10 ** 9))
+    user = types.User(id=chat_id, is_bot=False, first_name="Администратор")
+    chat = types.Chat(id=chat_id, type="private")
+
+    def message_update(text):
+        update_id = next(update_ids)
+        return types.Update(update_id=update_id, message=types.Message(
+            message_id=update_id, date=datetime.now(), chat=chat, from_user=user, text=text))
+
+    def callback_update(data):
+        update_id = next(update_ids)
+        return types.Update(update_id=update_id, callback_query=types.CallbackQuery(
+            id=str(update_id), chat_instance="bench", from_user=user, data=data,
+            message=types.Message(message_id=update_id, date=datetime.now(), chat=chat, text="bench")))
+
+    async def measure(handler, queries):
+        sent, size = len(session.requests), session.bytes_sent
+        duration, _ = await timed(handler)
+        return {"api_calls": len(session.requests) - sent, "kb_sent": round((session.bytes_sent - size) / 1024, 1),
+                "queries": queries(), "ms": round(duration * 1000, 1)}
+
+    def sql_count(handler_name):
+        stats = sora.handler_metrics.handlers.get(handler_name)
+        return stats.sql_count if stats else 0
+
+    def new_view(update, handler_name):
+        before = sql_count(handler_name)
+        return lambda: sora.dp.feed_update(sora.bot, update), lambda: sql_count(handler_name) - before
+
+    rows = []
+    async with sora.clubs.use(sora.DEFAULT_CLUB):
+        await sora.db.executemany("INSERT INTO products (name, quantity, category) VALUES (?, ?, ?)",
+                                  product_rows(args.products, rng))
+        # Права администратора попадают в кэш до замеров, как у работающего бота
+        await sora.dp.feed_update(sora.bot, message_update("📊 Склад"))
+
+        async for view, handler, queries in old_views(sora, chat_id):
+            rows.append({"view": view, "impl": "old", **await measure(handler, queries)})
+
+    for view, button, handler_name in (("list", "📋 Посмотреть склад", "show_warehouse"),
+                                       ("edit", "✏️ Редактировать", "edit_product_start"),
+                                       ("delete", "❌ Удалить товар", "delete_product_start")):
+        rows.append({"view": view, "impl": "new", **await measure(*new_view(message_update(button), handler_name))})
+
+        # Следующая страница - кнопкой «Вперёд» из только что отправленного ответа
+        markup = session.requests[-1].reply_markup
+        [next_page] = [button.callback_data for button in markup.inline_keyboard[-1]
+                       if button.callback_data.split(":")[2] == "next"]
+        rows.append({"view": f"{view} page 2", "impl": "new",
+                     **await measure(*new_view(callback_update(next_page), "products_page_handler"))})
+    return rows
+
+
+# ===== АРХИВАЦИЯ ЖУРНАЛА ДЕЙСТВИЙ =====
+LOG_ACTIONS = ["Поиск товара"] * 6 + ["Просмотр склада"] * 3 + ["Добавление товара", "Удаление товара"]
+LOG_FILL_CHUNK = 200000
+
+
+def log_rows(start, count, total, days, rng):
+    """Записи журнала по порядку времени, равномерно за последние days дней (UTC, как CURRENT_TIMESTAMP)."""
+    began = datetime.now(timezone.utc) - timedelta(days=days)
+    step = days * 86400 / total
+    return [(rng.randint(1, 50), rng.choice(LOG_ACTIONS), f"Запрос: '{number}'",
+             (began + timedelta(seconds=number * step)).strftime('%Y-%m-%d %H:%M:%S'))
+            for number in range(start, start + count)]
+
+
+def database_size(conn):
+    """(размер файла базы, из него занято данными) в МБ."""
+    page_size, page_count, freelist = (conn.execute(f"PRAGMA {name}").fetchone()[0]
+                                       for name in ("page_size", "page_count", "freelist_count"))
+    return round(page_size * page_count / 2 ** 20, 1), round(page_size * (page_count - freelist) / 2 ** 20, 1)
+
+
+async def bench_logs(args, sora):
+    rng = random.Random(args.seed)
+    today = datetime.now().date()
+    views = {
+        "first page": {},
+        "user": {"user_id": 7},
+        "action": {"action": "Удаление товара"},
+        "last week": {"date_from": str(today - timedelta(days=7)), "date_to": str(today)},
+        "old month": {"date_from": str(today - timedelta(days=200)), "date_to": str(today - timedelta(days=170))},
+    }
+
+    async def measure(stage, extra):
+        await sora.db.checkpoint("TRUNCATE")
+        file_mb, used_mb = await sora.db.call(database_size)
+        row = {"stage": stage, "rows": (await sora.db.fetchone("SELECT COUNT(*) FROM action_logs"))[0],
+               "file_mb": file_mb, "used_mb": used_mb, **extra}
+        for view, filters in views.items():
+            samples = []
+            for _ in range(args.repeat):
+                duration, _ = await timed(sora.fetch_logs_page, filters)
+                samples.append(duration)
+            row[f"{view} ms"] = summarize(samples)["p50_ms"]
+        return row
+
+    async with sora.clubs.use(sora.DEFAULT_CLUB):
+        started = time.perf_counter()
+        for start in range(0, args.rows, LOG_FILL_CHUNK):
+            await sora.db.executemany(
+                "INSERT INTO action_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
+                log_rows(start, min(LOG_FILL_CHUNK, args.rows - start), args.rows, args.days, rng))
+        rows = [await measure("before", {"seconds": round(time.perf_counter() - started, 1)})]
+
+        duration, archived = await timed(sora.log_archiver.archive)
+        archive_mb = sum(path.stat().st_size for path in sora.get_current_club().archive_dir.glob("*.db"))
+        rows.append(await measure("archived", {"seconds": round(duration, 1),
+                                               "archive_mb": round(archive_mb / 2 ** 20, 1)}))
+
+        if args.vacuum:
+            duration, _ = await timed(sora.db.execute, "VACUUM")
+            rows.append(await measure("vacuumed", {"seconds": round(duration, 1)}))
+    return rows
+
+
+# ===== СВОДКИ ОТЧЁТОВ =====
+# Начало периода так же, как в миграции 8
+PERIOD_START_SQL = {
+    "day": "report_date",
+    "week": "date(report_date, 'weekday 0', '-6 days')",
+    "month": "date(report_date, 'start of month')",
+}
+
+
+def report_rows(years, staff, rng):
+    """Отчёты по сменам за years лет до сегодняшнего дня; каждый сотрудник выходит примерно в 4 смены из 5."""
+    today = datetime.now().date()
+    rows = []
+    for day in range(years * 365, -1, -1):
+        report_date = (today - timedelta(days=day)).isoformat()
+        for user_id in range(1, staff + 1):
+            if rng.random() < 0.8:
+                total = rng.randint(5000, 80000)
+                cash = rng.randint(0, total)
+                rows.append((user_id, report_date, total, cash, total - cash, rng.randint(0, total // 3),
+                             rng.randint(0, 40), rng.randint(0, 5000), 0))
+    return rows
+
+
+async def scan_period_summary(sora, period, start):
+    # Та же сводка, что fetch_period_summary, пересчётом shift_reports
+    return await sora.db.fetchall(
+        f"""
+        SELECT sr.user_id, u.first_name, COUNT(*), SUM(sr.total), SUM(sr.cash), SUM(sr.card), SUM(sr.bar),
+               SUM(sr.hookah_count), SUM(sr.expenses), SUM(sr.total - sr.expenses)
+        FROM shift_reports sr
+                 LEFT JOIN users u ON sr.user_id = u.user_id
+        WHERE {PERIOD_START_SQL[period]} = ?
+        GROUP BY sr.user_id
+        ORDER BY SUM(sr.total) DESC
+        """,
+        (start.isoformat(),)
+    )
+
+
+async def scan_trend(sora, period, count):
+    # Тот же ряд, что fetch_trend, пересчётом shift_reports
+    start = sora.get_period_start(datetime.now().date(), period)
+    for _ in range(count - 1):
+        start = sora.get_period_start(start - timedelta(days=1), period)
+    return await sora.db.fetchall(
+        f"""
+        SELECT {PERIOD_START_SQL[period]} AS period_start, COUNT(*), SUM(total), SUM(expenses),
+               SUM(total - expenses)
+        FROM shift_reports
+        WHERE report_date >= ?
+        GROUP BY period_start
+        ORDER BY period_start
+        """,
+        (start.isoformat(),)
+    )
+
+
+def rounded(rows):
+    return sorted(tuple(round(value, 2) if isinstance(value, float) else value for value in row) for row in rows)
+
+
+async def bench_rollups(args, sora):
+    rng = random.Random(args.seed)
+    today = datetime.now().date()
+    rows = []
+    async with sora.clubs.use(sora.DEFAULT_CLUB):
+        reports = report_rows(args.years, args.staff, rng)
+        duration, _ = await timed(sora.db.executemany, REPORT_INSERT, reports)
+        print(f"Отчётов: {len(reports)}, запись с пересчётом сводок триггерами: {duration:.1f} с")
+
+        for period in ("day", "week", "month"):
+            start = sora.get_period_start(today, period)
+            queries = {
+                "summary": (lambda: sora.fetch_period_summary(period, start),
+                            lambda: scan_period_summary(sora, period, start)),
+                f"trend {sora.TREND_MAX_PERIODS}": (lambda: sora.fetch_trend(period, sora.TREND_MAX_PERIODS),
+                                                   lambda: scan_trend(sora, period, sora.TREND_MAX_PERIODS)),
+            }
+            for query, (rollup, scan) in queries.items():
+                row = {"query": query, "period": period}
+                results = {}
+                for name, func in (("rollup", rollup), ("scan", scan)):
+                    samples = []
+                    for _ in range(args.repeat):
+                        duration, results[name] = await timed(func)
+                        samples.append(duration)
+                    row[f"{name}_p50_ms"] = summarize(samples)["p50_ms"]
+                # Оба способа обязаны давать одни и те же итоги
+                assert results["rollup"] and rounded(results["rollup"]) == rounded(results["scan"]), (query, period)
+                row["rows"] = len(results["rollup"])
+                rows.append(row)
+    return rows
+
+
+# ===== АНАЛИТИКА: PANDAS ПРОТИВ SQLITE3 =====
+ANALYTICS_NAMED_STAFF = 0.5  # доля сотрудников с именем; остальные в книге - по user_id
+
+
+def rolling_mean(values, window):
+    # Как rolling(window, min_periods=1).mean(): среднее по доступным значениям окна
+    result, total = [], 0
+    for number, value in enumerate(values):
+        total += value
+        if number >= window:
+            total -= values[number - window]
+        result.append(round(total / min(number + 1, window), 2))
+    return result
+
+
+def share(numerator, denominator):
+    return round(numerator / denominator, 4) if denominator else None
+
+
+def python_analytics_export(sora, path, date_from, date_to):
+    """Та же книга, что build_analytics_export, без pandas: строки sqlite3, словари и openpyxl write-only."""
+    from openpyxl import Workbook
+
+    metrics = sora.REPORT_METRICS
+    conn = sora.connect_db(sora.get_current_club().path)
+    try:
+        cursor = conn.execute(
+            """
+            SELECT sr.report_date, COALESCE(u.first_name, CAST(sr.user_id AS TEXT)), sr.total, sr.cash, sr.card,
+                   sr.bar, sr.hookah_count, sr.expenses
+            FROM shift_reports sr
+                     LEFT JOIN users u ON sr.user_id = u.user_id
+            WHERE sr.report_date BETWEEN ? AND ?
+            """,
+            (date_from, date_to)
+        )
+        by_day, by_employee = {}, {}
+        count = 0
+        for report_date, employee, *values in cursor:
+            values.append(values[0] - values[5])  # net_profit
+            day = by_day.setdefault(report_date, [0] * len(metrics))
+            person = by_employee.setdefault(employee, [0] * (len(metrics) + 1))
+            for number, value in enumerate(values):
+                day[number] += value
+                person[number] += value
+            person[-1] += 1
+            count += 1
+    finally:
+        conn.close()
+
+    # По дням: календарные дни от первого до последнего отчёта, пропуски - нулями
+    reported = sorted(by_day)
+    first = datetime.strptime(reported[0], "%Y-%m-%d").date()
+    last = datetime.strptime(reported[-1], "%Y-%m-%d").date()
+    days = [first + timedelta(days=number) for number in range((last - first).days + 1)]
+    daily = [by_day.get(day.isoformat(), [0] * len(metrics)) for day in days]
+    column = {metric: [row[number] for row in daily] for number, metric in enumerate(metrics)}
+    total_ma7 = rolling_mean(column["total"], 7)
+    total_ma30 = rolling_mean(column["total"], 30)
+    net_profit_ma7 = rolling_mean(column["net_profit"], 7)
+
+    # Сезонность по дням недели среди дней, за которые есть отчёты
+    total_index, net_index, hookah_index = (metrics.index(name) for name in ("total", "net_profit", "hookah_count"))
+    weekdays = {}
+    for report_date in reported:
+        weekday = weekdays.setdefault(datetime.strptime(report_date, "%Y-%m-%d").weekday(), [0, 0, 0, 0])
+        values = by_day[report_date]
+        weekday[0] += 1
+        weekday[1] += values[total_index]
+        weekday[2] += values[net_index]
+        weekday[3] += values[hookah_index]
+    avg_daily_total = sum(by_day[day][total_index] for day in reported) / len(reported)
+    seasonality = [(sora.WEEKDAY_NAMES[weekday], days_count, round(total / days_count, 2),
+                    round(net / days_count, 2), round(hookah / days_count, 2),
+                    round(total / days_count / avg_daily_total, 3))
+                   for weekday, (days_count, total, net, hookah) in sorted(weekdays.items())]
+
+    employees = sorted(by_employee.items(), key=lambda item: (-item[1][total_index], item[0]))
+    totals = [sum(row[number] for row in by_day.values()) for number in range(len(metrics))]
+    cash, card = totals[metrics.index("cash")], totals[metrics.index("card")]
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Сводка")
+    sheet.append(["metric", "value"])
+    for row in (("period", f"{date_from} — {date_to}"), ("reports", count), ("days_with_reports", len(reported)),
+                *zip(metrics, totals), ("avg_daily_total", round(avg_daily_total, 2)),
+                ("cash_share", share(cash, cash + card)),
+                ("expense_ratio", share(totals[metrics.index("expenses")], totals[total_index])),
+                ("best_weekday", max(seasonality, key=lambda row: row[2])[0]),
+                ("top_employee", employees[0][0])):
+        sheet.append(row)
+
+    sheet = workbook.create_sheet("По дням")
+    sheet.append(["date", *metrics, "total_ma7", "total_ma30", "net_profit_ma7", "cash_share", "expense_ratio"])
+    for number, (day, values) in enumerate(zip(days, daily)):
+        sheet.append([day, *values, total_ma7[number], total_ma30[number], net_profit_ma7[number],
+                      share(values[1], values[1] + values[2]), share(values[5], values[0])])
+
+    sheet = workbook.create_sheet("Дни недели")
+    sheet.append(["weekday", "days", "avg_total", "avg_net_profit", "avg_hookah_count", "total_index"])
+    for row in seasonality:
+        sheet.append(row)
+
+    sheet = workbook.create_sheet("Сотрудники")
+    sheet.append(["employee", "reports", *metrics, "avg_total", "cash_share", "expense_ratio", "rank"])
+    rank = 0
+    for number, (employee, values) in enumerate(employees):
+        if not number or values[total_index] != employees[number - 1][1][total_index]:
+            rank = number + 1
+        sheet.append([employee, values[-1], *values[:-1], round(values[total_index] / values[-1], 2),
+                      share(values[1], values[1] + values[2]), share(values[5], values[0]), rank])
+
+    workbook.save(path)
+    return count
+
+
+def read_sheets(path):
+    """Листы книги: {название: строки} без пустых ячеек в конце строк."""
+    from openpyxl import load_workbook
+
+    def normalized(row):
+        values = list(row)
+        while values and values[-1] is None:
+            values.pop()
+        return tuple(values)
+
+    workbook = load_workbook(path, read_only=True)
+    try:
+        return {sheet.title: [normalized(row) for row in sheet.iter_rows(values_only=True)]
+                for sheet in workbook.worksheets}
+    finally:
+        workbook.close()
+
+
+def same_rows(left, right):
+    # pandas округляет через numpy (41258.475 -> 41258.48), round() - точно (41258.47): допускаем разницу в 0.01
+    def same(a, b):
+        if isinstance(a, float) or isinstance(b, float):
+            return isinstance(a, (int, float)) and isinstance(b, (int, float)) and abs(a - b) <= 0.0100001
+        return a == b
+
+    return len(left) == len(right) and all(
+        len(row) == len(other) and all(map(same, row, other)) for row, other in zip(left, right))
+
+
+def analytics_case(work_dir, mode, date_from, date_to):
+    """Два построения аналитической книги подряд (холодное - с импортом библиотек); запускается через run_case."""
+    sora = loadtest.import_bot(Path(work_dir))
+    rss_before = peak_rss_mb()
+
+    async def run():
+        async with sora.clubs.use(sora.DEFAULT_CLUB):
+            path = sora.get_current_club().export_dir / f"analytics_{mode}.xlsx"
+            durations = []
+            for _ in range(2):
+                started = time.perf_counter()
+                if mode == "pandas":
+                    await asyncio.to_thread(sora.build_analytics_export, path, date_from, date_to)
+                else:
+                    await asyncio.to_thread(python_analytics_export, sora, path, date_from, date_to)
+                durations.append(time.perf_counter() - started)
+        await sora.clubs.close()
+        return {"cold_s": round(durations[0], 2), "warm_s": round(durations[1], 2),
+                "file_kb": round(path.stat().st_size / 1024)}
+
+    result = asyncio.run(run())
+    result.update(rss_before_mb=rss_before, peak_rss_mb=peak_rss_mb())
+    print(json.dumps(result))
+
+
+async def bench_analytics(args, sora):
+    rng = random.Random(args.seed)
+    today = datetime.now().date()
+    rows = []
+    async with sora.clubs.use(sora.DEFAULT_CLUB):
+        reports = report_rows(args.years, args.staff, rng)
+        await sora.db.executemany(REPORT_INSERT, reports)
+        await sora.db.executemany("INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+                                  [(user_id, f"user{user_id}", f"Сотрудник {user_id}")
+                                   for user_id in range(1, int(args.staff * ANALYTICS_NAMED_STAFF) + 1)])
+        await sora.db.checkpoint()
+        export_dir = sora.get_current_club().export_dir
+
+        periods = {f"{args.days} days": today - timedelta(days=args.days),
+                   f"{args.years} years": today - timedelta(days=args.years * 365)}
+        date_to = today.isoformat()
+        for period, date_from in periods.items():
+            date_from = date_from.isoformat()
+            count = (await sora.db.fetchone("SELECT COUNT(*) FROM shift_reports WHERE report_date BETWEEN ? AND ?",
+                                            (date_from, date_to)))[0]
+            for mode in ("pandas", "sqlite3"):
+                rows.append({"period": period, "mode": mode, "reports": count,
+                             **run_case(f"analytics_case({os.getcwd()!r}, {mode!r}, {date_from!r}, {date_to!r})")})
+
+            # Обе книги обязаны совпадать лист в лист
+            pandas_sheets, python_sheets = (read_sheets(export_dir / f"analytics_{mode}.xlsx")
+                                            for mode in ("pandas", "sqlite3"))
+            assert list(pandas_sheets) == list(python_sheets), period
+            for title, sheet in pandas_sheets.items():
+                assert same_rows(sheet, python_sheets[title]), (period, title)
+    return rows
+
+
+# ===== ИМПОРТ ТОВАРОВ =====
+IMPORT_HEADER = ["id", "name", "quantity", "category", "reorder_threshold"]
+IMPORT_ERROR_SHARE = 0.01  # доля строк с ошибками: неизвестный id, пустое название, отрицательный остаток
+
+
+def import_rows(count, names, rng):
+    """Строки файла импорта: половина - товары склада по id, остальные - новые товары и немного ошибок."""
+    product_ids = sorted(names)
+    rows = []
+    for number in range(count):
+        if rng.random() < IMPORT_ERROR_SHARE:
+            rows.append(rng.choice([[product_ids[-1] + 10 ** 6, "Нет такого", 1, None, None],
+                                    [None, None, 5, None, None],
+                                    [None, f"Ошибка {number}", -1, None, None]]))
+        elif number % 2 and number // 2 < len(product_ids):
+            product_id = product_ids[number // 2]
+            rows.append([product_id, names[product_id], rng.randint(0, 200), rng.choice(CATEGORIES),
+                         rng.choice([None, rng.randint(1, 20)])])
+        else:
+            rows.append([None, f"Новый товар {number}", rng.randint(0, 200), rng.choice(CATEGORIES), None])
+    return rows
+
+
+def write_import_files(directory, rows):
+    """Один и тот же импорт в .xlsx и .csv; возвращает {формат: путь}."""
+    from openpyxl import Workbook
+
+    paths = {"xlsx": directory / "import_bench.xlsx", "csv": directory / "import_bench.csv"}
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Склад")
+    sheet.append(IMPORT_HEADER)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(paths["xlsx"])
+
+    with open(paths["csv"], "w", newline="", encoding="utf-8-sig") as file:
+        writer = csv.writer(file, delimiter=";")
+        writer.writerow(IMPORT_HEADER)
+        writer.writerows(["" if value is None else value for value in row] for row in rows)
+    return paths
+
+
+def import_case(work_dir, path):
+    """Проверка и применение одного файла импорта; запускается через run_case на копии базы."""
+    sora = loadtest.import_bot(Path(work_dir))
+    rss_before = peak_rss_mb()
+
+    async def run():
+        async with sora.clubs.use(sora.DEFAULT_CLUB):
+            parse_s, result = await timed(asyncio.to_thread, sora.parse_product_import, Path(path))
+            parse_peak = peak_rss_mb()
+            apply_s, (created, updated) = await timed(sora.db.transaction, sora._apply_product_import,
+                                                     result.rows, sora.MAIN_ADMIN_ID)
+            assert (created, updated) == (result.created, result.updated)
+        await sora.clubs.close()
+        return {"created": created, "updated": updated, "unchanged": result.unchanged,
+                "errors": len(result.errors), "parse_s": round(parse_s, 2), "apply_s": round(apply_s, 2),
+                "rss_before_mb": rss_before, "parse_peak_mb": parse_peak}
+
+    result = asyncio.run(run())
+    result["peak_rss_mb"] = peak_rss_mb()
+    print(json.dumps(result))
+
+
+async def bench_import(args, sora):
+    rng = random.Random(args.seed)
+    work_dir = Path(os.getcwd())
+    async with sora.clubs.use(sora.DEFAULT_CLUB):
+        await sora.db.executemany("INSERT INTO products (name, quantity, category) VALUES (?, ?, ?)",
+                                  product_rows(args.products, rng))
+        names = dict(await sora.db.fetchall("SELECT id, name FROM products"))
+        await sora.db.checkpoint("TRUNCATE")
+    paths = write_import_files(work_dir, import_rows(args.rows, names, rng))
+
+    rows = []
+    for file_format, path in paths.items():
+        # Каждый формат применяется к своей копии исходной базы
+        case_dir = work_dir / f"case_{file_format}"
+        shutil.copytree(work_dir / "database", case_dir / "database")
+        rows.append({"format": file_format, "rows": args.rows,
+                     "file_mb": round(path.stat().st_size / 2 ** 20, 2),
+                     **run_case(f"import_case({str(case_dir)!r}, {str(path)!r})")})
+    return rows
+
+
+def print_rows(rows):
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    widths = [max(len(column), *(len(str(row.get(column, ""))) for row in rows)) for column in columns]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row.get(column, "")).rjust(width) for column, width in zip(columns, widths)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарки подсистем бота на синтетических данных")
+    parser.add_argument("--seed", type=int, default=1, help="seed генератора случайных данных")
+    parser.add_argument("--output", help="куда сохранить результат в JSON")
+    scenarios = parser.add_subparsers(dest="scenario", required=True)
+
+    search = scenarios.add_parser("search", help="поиск по FTS5 против просмотра всей таблицы")
+    search.add_argument("--products", type=int, default=100000, help="товаров на складе")
+    search.add_argument("--repeat", type=int, default=3, help="сколько раз повторить набор запросов")
+    search.set_defaults(func=bench_search)
+
+    profiles = scenarios.add_parser("profiles", help="скорость записи при разных профилях подключения SQLite")
+    profiles.add_argument("--reports", type=int, default=1000, help="сколько отчётов по смене записать")
+    profiles.add_argument("--logs", type=int, default=3000, help="сколько записей журнала действий записать")
+    profiles.set_defaults(func=bench_profiles)
+
+    export = scenarios.add_parser("export", help="время и пик памяти экспорта склада в Excel")
+    export.add_argument("--rows", type=int, nargs="+", default=[10000, 100000], help="размеры склада")
+    export.add_argument("--old-limit", type=int, default=0,
+                        help="не запускать прежний экспорт на складе больше этого размера (0 - без ограничения)")
+    export.set_defaults(func=bench_export)
+
+    pages = scenarios.add_parser("pages", help="объём ответов и запросы при просмотре склада")
+    pages.add_argument("--products", type=int, default=10000, help="товаров на складе")
+    pages.set_defaults(func=bench_pages)
+
+    logs = scenarios.add_parser("logs", help="размер базы и скорость журнала действий до и после архивации")
+    logs.add_argument("--rows", type=int, default=1000000, help="записей в журнале")
+    logs.add_argument("--days", type=int, default=365, help="за сколько дней распределены записи")
+    logs.add_argument("--repeat", type=int, default=20, help="повторов каждого запроса страницы")
+    logs.add_argument("--vacuum", action="store_true", help="после архивации выполнить VACUUM")
+    logs.set_defaults(func=bench_logs)
+
+    rollups = scenarios.add_parser("rollups", help="сводки и динамика: report_rollups против пересчёта отчётов")
+    rollups.add_argument("--years", type=int, default=5, help="за сколько лет создать отчёты")
+    rollups.add_argument("--staff", type=int, default=20, help="сотрудников, сдающих отчёты")
+    rollups.add_argument("--repeat", type=int, default=20, help="повторов каждого запроса")
+    rollups.set_defaults(func=bench_rollups)
+
+    analytics = scenarios.add_parser("analytics", help="аналитическая книга: pandas против sqlite3 и openpyxl")
+    analytics.add_argument("--years", type=int, default=5, help="за сколько лет создать отчёты")
+    analytics.add_argument("--staff", type=int, default=20, help="сотрудников, сдающих отчёты")
+    analytics.add_argument("--days", type=int, default=90, help="короткий период выгрузки, дней")
+    analytics.set_defaults(func=bench_analytics)
+
+    imports = scenarios.add_parser("import", help="время и пик памяти проверки и применения импорта товаров")
+    imports.add_argument("--rows", type=int, default=50000, help="строк в файле импорта")
+    imports.add_argument("--products", type=int, default=25000, help="товаров на складе до импорта")
+    imports.set_defaults(func=bench_import)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output = Path(args.output).resolve() if args.output else None
+
+    cwd = os.getcwd()
+    work_dir = Path(tempfile.mkdtemp(prefix="sora_bench_"))
+    try:
+        sora = loadtest.import_bot(work_dir)
+
+        async def run():
+            try:
+                return await args.func(args, sora)
+            finally:
+                await sora.clubs.close()
+
+        rows = asyncio.run(run())
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_rows(rows)
+    if output:
+        output.write_text(json.dumps(rows, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"Результат сохранён в {output}")
+
+
+if __name__ == "__main__":
+    main()
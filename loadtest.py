@@ -0,0 +1,452 @@
+"""
+Нагрузочный тест SoraEcoSystemBot без сети.
+
+Поднимает диспетчер бота на временной базе, подменяет сессию Bot API
+заглушкой и прогоняет через dp.feed_update синтетические обновления от
+множества пользователей одновременно: регистрация и одобрение, добавление
+товаров, поиск, отчёты по смене, статистика и экспорт в Excel.
+
+Результат - пропускная способность (обновлений в секунду) и перцентили
+задержки по каждому обработчику - печатается и сохраняется в JSON, чтобы
+сравнивать прогоны между версиями:
+
+    python loadtest.py --users 200 --rounds 3 --output loadtest.json
+    python loadtest.py --compare loadtest.json
+
+С --clubs N сотрудники распределяются по N клубам (каждый со своей базой и
+администратором) и подключаются по коду клуба; в результат добавляются
+пиковая память процесса и число открытий и вытеснений баз клубов:
+
+    python loadtest.py --clubs 200 --users 400 --rounds 1
+
+С --blocking-db запросы выполняются прямо в цикле событий, как до переноса
+базы в отдельный поток; сравнение двух прогонов показывает, сколько
+обработчики ждут чужих дисковых операций:
+
+    python loadtest.py --blocking-db --output blocking.json
+    python loadtest.py --compare blocking.json
+
+С --routing вместо сценария измеряется только выбор обработчика для
+текстового сообщения: таблицы меню против прежней проверки фильтров
+F.text == ... и StateFilter по порядку, на настоящих кнопках и состояниях
+бота и на меню, расширенном синтетическими кнопками:
+
+    python loadtest.py --routing
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from pathlib import Path
+
+# Ответ на первый /start до одобрения администратором - ожидаемый, не ошибка
+PENDING_APPROVAL_REPLY = "❌ Ваш доступ к боту еще не подтвержден"
+LOOP_PROBE_INTERVAL = 0.01  # секунды между замерами задержки цикла событий
+SEARCH_WORDS = ["кола", "чипсы", "табак", "уголь", "сок", "вода", "мята", "лёд", "чай", "орехи"]
+
+
+def percentile(values, share):
+    """Перцентиль по ближайшему рангу; values должен быть отсортирован."""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(share * len(values)) - 1))
+    return values[index]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3) if samples else 0.0,
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 3),
+        "p90_ms": round(percentile(samples, 0.90) * 1000, 3),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3) if samples else 0.0,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на синтетических обновлениях")
+    parser.add_argument("--users", type=int, default=100, help="число имитируемых сотрудников")
+    parser.add_argument("--rounds", type=int, default=2, help="сколько раз каждый проходит сценарий")
+    parser.add_argument("--concurrency", type=int, default=50, help="сколько пользователей активны одновременно")
+    parser.add_argument("--products", type=int, default=1000, help="товаров на складе перед стартом")
+    parser.add_argument("--exports", type=int, default=5, help="сколько раз администратор выгружает склад")
+    parser.add_argument("--clubs", type=int, default=1, help="сколько клубов обслуживает бот")
+    parser.add_argument("--blocking-db", action="store_true",
+                        help="выполнять запросы в цикле событий, как до фонового потока базы")
+    parser.add_argument("--routing", action="store_true", help="только микробенчмарк выбора обработчика")
+    parser.add_argument("--seed", type=int, default=1, help="seed генератора случайных данных")
+    parser.add_argument("--output", default="loadtest.json", help="куда сохранить результат")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную папку с базой")
+    return parser.parse_args()
+
+
+def import_bot(work_dir):
+    """Импортирует бота так, что база, выгрузки и bot.log оказываются в work_dir."""
+    # Бот импортируется только после того, как окружение указывает на временную папку
+    os.environ["DATA_DIR"] = str(work_dir)
+    os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+    os.chdir(work_dir)  # bot.log пишется в текущую папку
+    sys.path.insert(0, str(Path(__file__).parent))
+
+    import SoraEcoSystems as sora
+
+    for handler in list(logging.getLogger().handlers):
+        if type(handler) is logging.StreamHandler:
+            logging.getLogger().removeHandler(handler)
+    return sora
+
+
+def request_size(method):
+    """Размер вызова Bot API в байтах JSON - примерно столько уходит в Telegram."""
+    return len(json.dumps(method.dict(exclude_none=True), default=str, ensure_ascii=False).encode())
+
+
+def install_fake_session(sora, record=False):
+    """Подменяет сессию Bot API заглушкой без сети; с record=True сохраняет все вызовы."""
+    from aiogram import methods, types
+    from aiogram.client.session.base import BaseSession
+
+    class FakeSession(BaseSession):
+        """Отвечает на вызовы Bot API без сети и считает их по методам."""
+
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+            self.requests = []
+            self.bytes_sent = 0
+            self.error_replies = 0
+            self.message_id = 0
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+        async def make_request(self, bot, method, timeout=None):
+            self.calls[type(method).__name__] += 1
+            self.bytes_sent += request_size(method)
+            if record:
+                self.requests.append(method)
+            self.message_id += 1
+            chat_id = getattr(method, "chat_id", 0)
+            chat = types.Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private")
+            if isinstance(method, (methods.SendMessage, methods.EditMessageText)):
+                if method.text.startswith("❌") and not method.text.startswith(PENDING_APPROVAL_REPLY):
+                    self.error_replies += 1
+                return types.Message(message_id=self.message_id, date=datetime.now(), chat=chat, text=method.text)
+            if isinstance(method, methods.SendDocument):
+                return types.Message(message_id=self.message_id, date=datetime.now(), chat=chat,
+                                     document=types.Document(file_id=f"file{self.message_id}",
+                                                             file_unique_id=f"unique{self.message_id}"))
+            return True
+
+    session = FakeSession()
+    session.middleware = sora.bot.session.middleware  # счётчик вызовов API для метрик бота
+    sora.bot.session = session
+    return session
+
+
+def run_queries_inline(sora):
+    """Выполняет запросы прямо в цикле событий, как до выноса базы в отдельный поток."""
+
+    async def run(self, func, *args):
+        trace = sora.handler_trace.get()
+        if trace is None:
+            return func(*args)
+        return self._traced(trace, func, args)
+
+    sora.Database._run = run
+
+
+async def run(args, work_dir):
+    sora = import_bot(work_dir)
+    from aiogram import types
+
+    if args.blocking_db:
+        run_queries_inline(sora)
+    session = install_fake_session(sora)
+
+    latencies = defaultdict(list)
+    handler_errors = Counter()
+
+    async def measure_handler(handler, event, data):
+        name = data.get("menu_handler", data["handler"]).callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors[name] += 1
+            raise
+        finally:
+            latencies[name].append(time.perf_counter() - started)
+
+    sora.dp.message.middleware(measure_handler)
+    sora.dp.callback_query.middleware(measure_handler)
+
+    update_ids = iter(range(1, 10 ** 9))
+    update_latencies = []
+    update_errors = 0
+
+    def make_user(user_id):
+        return types.User(id=user_id, is_bot=False, first_name=f"Сотрудник {user_id}", username=f"user{user_id}")
+
+    async def feed(update):
+        nonlocal update_errors
+        started = time.perf_counter()
+        try:
+            await sora.dp.feed_update(sora.bot, update)
+        except Exception as e:
+            update_errors += 1
+            logging.getLogger(__name__).error(f"Ошибка обработки обновления: {e}")
+        update_latencies.append(time.perf_counter() - started)
+
+    async def send_text(user_id, text):
+        update_id = next(update_ids)
+        await feed(types.Update(update_id=update_id, message=types.Message(
+            message_id=update_id, date=datetime.now(),
+            chat=types.Chat(id=user_id, type="private"),
+            from_user=make_user(user_id), text=text)))
+
+    async def press_button(user_id, data):
+        update_id = next(update_ids)
+        await feed(types.Update(update_id=update_id, callback_query=types.CallbackQuery(
+            id=str(update_id), chat_instance="loadtest", from_user=make_user(user_id), data=data,
+            message=types.Message(message_id=update_id, date=datetime.now(),
+                                  chat=types.Chat(id=user_id, type="private"), text="loadtest"))))
+
+    rng = random.Random(args.seed)
+    admin_id = sora.MAIN_ADMIN_ID
+    async with sora.clubs.use(sora.DEFAULT_CLUB):  # база основного клуба создаётся вместе с администратором
+        await sora.db.executemany(
+            "INSERT INTO products (name, quantity, category) VALUES (?, ?, ?)",
+            [(f"{rng.choice(SEARCH_WORDS)} {number}", rng.randint(0, 200), rng.choice(["Бар", "Кальян", None]))
+             for number in range(args.products)]
+        )
+
+    # Клуб с номером n > 0 - код club{n}, администратор first_admin + n
+    first_admin = 2 * 10 ** 6
+    for number in range(1, args.clubs):
+        await sora.clubs.add(f"club{number}", f"Клуб {number}", first_admin + number)
+
+    async def employee(user_id, limit):
+        club = user_id % args.clubs
+        async with limit:
+            await send_text(user_id, f"/start club{club}" if club else f"/start {sora.DEFAULT_CLUB}")
+            await press_button(first_admin + club if club else admin_id, f"approve_{user_id}")
+            for round_number in range(args.rounds):
+                await send_text(user_id, "📊 Склад")
+                await send_text(user_id, "📦 Добавить товар")
+                await send_text(user_id, f"{rng.choice(SEARCH_WORDS)} {user_id}-{round_number}")
+                await send_text(user_id, str(rng.randint(1, 100)))
+                await send_text(user_id, "Пропустить")
+                await send_text(user_id, "🔍 Поиск товара")
+                await send_text(user_id, rng.choice(SEARCH_WORDS)[:3])
+                await send_text(user_id, "📝 Отчёт по смене")
+                if round_number == 0:
+                    await send_text(user_id, "📋 Создать отчёт")
+                    values = [rng.randint(1000, 50000) for _ in range(4)] + [rng.randint(0, 30), rng.randint(0, 5000)]
+                    for value in values:
+                        await send_text(user_id, str(value))
+                else:
+                    await send_text(user_id, "🔄 Обновить отчёт")
+                    await send_text(user_id, str(rng.randint(1000, 50000)))
+                    for _ in range(5):
+                        await send_text(user_id, "⏭ Пропустить")
+
+    async def admin():
+        for number in range(max(args.exports, 1)):
+            await asyncio.sleep(0.2)
+            await send_text(admin_id, "📊 Статистика")
+            if number < args.exports:
+                await send_text(admin_id, "📥 Экспорт в Excel")
+
+    loop_lags = []
+
+    async def probe_loop():
+        # Насколько позже срока просыпается цикл событий - столько он был занят, не принимая обновлений
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LOOP_PROBE_INTERVAL)
+            loop_lags.append(time.perf_counter() - started - LOOP_PROBE_INTERVAL)
+
+    sora.action_log.start()
+    sora.notifier.start()
+    sora.stock_alerts.start()
+
+    limit = asyncio.Semaphore(args.concurrency)
+    first_user = 10 ** 6
+    probe = asyncio.create_task(probe_loop())
+    started = time.perf_counter()
+    await asyncio.gather(admin(), *(employee(first_user + number, limit) for number in range(args.users)))
+    wall_time = time.perf_counter() - started
+    probe.cancel()
+
+    await sora.stock_alerts.stop()
+    await sora.action_log.stop()
+    pending_notifications = sora.notifier._pending
+    await sora.notifier.stop(timeout=0)
+    async with sora.clubs.use(sora.DEFAULT_CLUB):
+        stats = await sora.get_stats()
+    club_counts = {"clubs": len(sora.clubs.clubs), "opened": sora.clubs.opened_count,
+                   "evicted": sora.clubs.evicted_count, "open_at_end": len(sora.clubs.open),
+                   "max_open": sora.clubs.max_open}
+    await sora.fsm_storage.close()
+    await sora.clubs.close()
+
+    return {
+        "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "keep")},
+        "updates": len(update_latencies),
+        "update_errors": update_errors,
+        "error_replies": session.error_replies,
+        "wall_time_s": round(wall_time, 3),
+        "updates_per_sec": round(len(update_latencies) / wall_time, 1),
+        "update_latency": summarize(update_latencies),
+        "loop_lag": summarize(loop_lags),
+        "handlers": {name: dict(summarize(samples), errors=handler_errors[name],
+                                sql_per_call=round(sora.handler_metrics.handlers[name].sql_count / len(samples), 2))
+                     for name, samples in sorted(latencies.items())},
+        "api_calls": dict(session.calls.most_common()),
+        "notifications_pending": pending_notifications,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),  # ru_maxrss в КиБ
+        "clubs": club_counts,
+        "db": {name: stats[name] for name in (
+            "users_total", "products_total", "shift_reports_total", "action_logs_total")},
+    }
+
+
+async def routing_benchmark(args, work_dir):
+    """Время выбора обработчика: таблицы меню против перебора фильтров по порядку."""
+    sora = import_bot(work_dir)
+    from aiogram import F, types
+    from aiogram.dispatcher.event.handler import FilterObject, HandlerObject
+    from aiogram.filters import StateFilter
+
+    rng = random.Random(args.seed)
+    index = sora.menu_index
+    real_buttons, real_states = list(index.buttons), list(index.states)
+
+    def linear_handlers():
+        """Обработчики меню в порядке объявления с прежними фильтрами."""
+        entries = [(entry, [FilterObject(F.text == text)]) for text, entry in index.buttons.items()]
+        entries += [(entry, [FilterObject(F.text), FilterObject(StateFilter(state))])
+                    for state, entry in index.states.items()]
+        entries.sort(key=lambda item: item[0].order)
+        return [HandlerObject(callback=entry.handler.callback, filters=filters) for entry, filters in entries]
+
+    def messages(texts):
+        return [types.Message(message_id=i, date=datetime.now(), chat=types.Chat(id=1, type="private"), text=text)
+                for i, text in enumerate(texts)]
+
+    async def timed(route, cases, repeat):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for message, raw_state in cases:
+                await route(message, raw_state)
+        return round((time.perf_counter() - started) / (repeat * len(cases)) * 10 ** 6, 2)
+
+    async def measure(extra):
+        # Синтетические кнопки добавляются в конец, как новые пункты меню
+        synthetic = {f"Кнопка {i}": sora.MenuEntry(10 ** 6 + i, index.buttons[real_buttons[0]].handler)
+                     for i in range(extra)}
+        index.buttons.update(synthetic)
+        linear = linear_handlers()
+
+        async def route_linear(message, raw_state):
+            for handler in linear:
+                result, _ = await handler.check(message, raw_state=raw_state)
+                if result:
+                    return handler
+
+        async def route_table(message, raw_state):
+            return await index.match(message, raw_state=raw_state)
+
+        cases = [(message, None) for message in messages(real_buttons)]
+        cases += [(message, rng.choice(real_states)) for message in messages(["Кола 0.5"] * len(real_states))]
+        cases += [(message, None) for message in messages(["привет"] * 10)]  # неизвестный текст
+        for message, raw_state in cases:
+            found = await route_table(message, raw_state)
+            expected = await route_linear(message, raw_state)
+            found = found["menu_handler"].callback if found else None
+            assert found == (expected.callback if expected else None), message.text
+        row = {
+            "buttons": len(index.buttons),
+            "states": len(index.states),
+            "linear_us": await timed(route_linear, cases, args.rounds * 20),
+            "table_us": await timed(route_table, cases, args.rounds * 20),
+        }
+        for text in synthetic:
+            del index.buttons[text]
+        return row
+
+    return {"routing": [await measure(extra) for extra in (0, 500)]}
+
+
+def print_routing(result):
+    print(f"{'кнопок':>8} {'состояний':>10} {'фильтры, мкс':>13} {'таблица, мкс':>13}")
+    for row in result["routing"]:
+        print(f"{row['buttons']:>8} {row['states']:>10} {row['linear_us']:>13.2f} {row['table_us']:>13.2f}")
+
+
+def print_result(result, baseline=None):
+    def change(current, previous):
+        if not previous:
+            return ""
+        return f" ({(current - previous) / previous * 100:+.1f}%)"
+
+    base_handlers = baseline["handlers"] if baseline else {}
+    print(f"Обновлений: {result['updates']} за {result['wall_time_s']} с, "
+          f"{result['updates_per_sec']}/с{change(result['updates_per_sec'], baseline and baseline['updates_per_sec'])}")
+    print(f"Ошибок: {result['update_errors']}, ответов с ❌: {result['error_replies']}")
+    lag = result["loop_lag"]
+    print(f"Задержка цикла событий: p50 {lag['p50_ms']:.2f} мс, p99 {lag['p99_ms']:.2f} мс, max {lag['max_ms']:.2f} мс")
+    print(f"Память: {result['max_rss_mb']} МБ, клубов: {result['clubs']['clubs']}, открытий баз: "
+          f"{result['clubs']['opened']}, вытеснений: {result['clubs']['evicted']}")
+    print(f"{'обработчик':32} {'вызовов':>8} {'p50, мс':>9} {'p90, мс':>9} {'p99, мс':>9} {'max, мс':>9}")
+    for name, row in sorted(result["handlers"].items(), key=lambda item: -item[1]["p90_ms"]):
+        previous = base_handlers.get(name, {}).get("p90_ms")
+        print(f"{name:32} {row['count']:>8} {row['p50_ms']:>9.2f} {row['p90_ms']:>9.2f} "
+              f"{row['p99_ms']:>9.2f} {row['max_ms']:>9.2f}{change(row['p90_ms'], previous)}")
+
+
+def main():
+    args = parse_args()
+    output = Path(args.output).resolve()
+    baseline = None
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+
+    cwd = os.getcwd()
+    work_dir = Path(tempfile.mkdtemp(prefix="sora_loadtest_"))
+    try:
+        result = asyncio.run((routing_benchmark if args.routing else run)(args, work_dir))
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Временная папка сохранена: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.routing:
+        print_routing(result)
+    else:
+        print_result(result, baseline)
+    output.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"Результат сохранён в {output}")
+
+
+if __name__ == "__main__":
+    main()
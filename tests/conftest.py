@@ -0,0 +1,101 @@
+"""Общие фикстуры тестов.
+
+Бот импортируется так же, как в loadtest.py: база, выгрузки и bot.log - во
+временной папке, сессия Bot API заменена заглушкой без сети. Все тесты
+выполняются в одном цикле событий, потому что реестр клубов и фоновые
+задачи бота создаются один раз на процесс.
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import loadtest
+
+
+@pytest.fixture(scope="session")
+def sora(tmp_path_factory):
+    cwd = os.getcwd()
+    try:
+        return loadtest.import_bot(tmp_path_factory.mktemp("data"))
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope="session")
+def run(sora):
+    """Выполняет корутину в общем цикле событий тестов."""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+
+    async def shutdown():
+        await sora.fsm_storage.close()
+        await sora.clubs.close()
+
+    loop.run_until_complete(shutdown())
+    loop.close()
+
+
+class BotClient:
+    """Отправляет боту обновления от имени пользователей и возвращает тексты ответов."""
+
+    def __init__(self, sora, session):
+        self.sora = sora
+        self.session = session
+        self.update_id = 0
+
+    def _user(self, user_id):
+        from aiogram import types
+        return types.User(id=user_id, is_bot=False, first_name=f"Сотрудник {user_id}", username=f"user{user_id}")
+
+    async def _feed(self, update):
+        sent = len(self.session.requests)
+        await self.sora.dp.feed_update(self.sora.bot, update)
+        return [method.text for method in self.session.requests[sent:] if hasattr(method, "text")]
+
+    async def send(self, user_id, text):
+        from aiogram import types
+        self.update_id += 1
+        return await self._feed(types.Update(update_id=self.update_id, message=types.Message(
+            message_id=self.update_id, date=datetime.now(), chat=types.Chat(id=user_id, type="private"),
+            from_user=self._user(user_id), text=text)))
+
+    async def press(self, user_id, data):
+        from aiogram import types
+        self.update_id += 1
+        return await self._feed(types.Update(update_id=self.update_id, callback_query=types.CallbackQuery(
+            id=str(self.update_id), chat_instance="tests", from_user=self._user(user_id), data=data,
+            message=types.Message(message_id=self.update_id, date=datetime.now(),
+                                  chat=types.Chat(id=user_id, type="private"), text="tests"))))
+
+
+@pytest.fixture(scope="session")
+def client(sora, run):
+    session = loadtest.install_fake_session(sora, record=True)
+
+    async def start():
+        sora.action_log.start()
+        sora.notifier.start()
+
+    async def stop():
+        await sora.action_log.stop()
+        await sora.notifier.stop(timeout=0)
+
+    run(start())
+    yield BotClient(sora, session)
+    run(stop())
+
+
+@pytest.fixture
+def club(sora, run):
+    """Контекст основного клуба для прямых обращений к db."""
+    club = run(sora.clubs.acquire(sora.DEFAULT_CLUB))
+    token = sora.current_club.set(club)
+    yield club
+    sora.current_club.reset(token)
+    sora.clubs.release(club)
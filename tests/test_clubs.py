@@ -0,0 +1,53 @@
+"""Ссылка другого клуба не переводит сотрудника без одобрения администратора этого клуба."""
+import pytest
+
+TARGET_ADMIN_ID = 3
+
+
+@pytest.fixture(scope="module")
+def target_club(sora, run, client):
+    run(sora.clubs.add("transfer_target", "Transfer", TARGET_ADMIN_ID))
+    run(client.send(TARGET_ADMIN_ID, "/start"))  # администратор регистрируется в базе своего клуба
+    return "transfer_target"
+
+
+@pytest.fixture
+def member(sora, run, client):
+    """Сотрудник основного клуба."""
+    user_id = 800000 + client.update_id
+    run(client.send(user_id, f"/start {sora.DEFAULT_CLUB}"))
+    assert run(sora.clubs.get_member_club(user_id)) == sora.DEFAULT_CLUB
+    return user_id
+
+
+def test_new_user_joins_by_link(sora, run, client, target_club):
+    user_id = 810000 + client.update_id
+    run(client.send(user_id, f"/start {target_club}"))
+
+    assert run(sora.clubs.get_member_club(user_id)) == target_club
+
+
+def test_member_of_other_club_needs_approval(sora, run, client, target_club, member):
+    replies = run(client.send(member, f"/start {target_club}"))
+
+    assert replies[0].startswith("📨 Запрос на переход")
+    assert run(sora.clubs.get_member_club(member)) == sora.DEFAULT_CLUB
+
+    replies = run(client.send(TARGET_ADMIN_ID, f"/club_transfer {member}"))
+
+    assert replies[0].startswith("✅")
+    assert run(sora.clubs.get_member_club(member)) == target_club
+
+
+def test_transfer_without_request_is_refused(sora, run, client, target_club, member):
+    replies = run(client.send(TARGET_ADMIN_ID, f"/club_transfer {member}"))
+
+    assert replies == ["❌ Этот пользователь не просил о переходе в ваш клуб."]
+    assert run(sora.clubs.get_member_club(member)) == sora.DEFAULT_CLUB
+
+
+def test_request_only_approved_by_requested_club(sora, run, client, target_club, member):
+    run(client.send(member, f"/start {target_club}"))
+    run(client.send(sora.MAIN_ADMIN_ID, f"/club_transfer {member}"))
+
+    assert run(sora.clubs.get_member_club(member)) == sora.DEFAULT_CLUB
@@ -0,0 +1,60 @@
+"""Кэш SQLiteStorage: память ограничена FSM_CACHE_SIZE, вытесненные состояния читаются из fsm_states."""
+import pytest
+
+USERS = 100000
+CHECK_EVERY = 1000
+
+
+@pytest.fixture(scope="module")
+def fsm_club(sora, run):
+    """Отдельный клуб, чтобы сто тысяч состояний не попали в базу основного."""
+    # Свой администратор: add() переводит его в новый клуб, а MAIN_ADMIN_ID нужен другим тестам в основном
+    run(sora.clubs.add("fsm_bulk", "FSM", 1))
+    club = run(sora.clubs.acquire("fsm_bulk"))
+    token = sora.current_club.set(club)
+    yield club
+    sora.current_club.reset(token)
+    sora.clubs.release(club)
+
+
+def storage_key(sora, user_id):
+    return sora.StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def test_cache_stays_bounded_with_many_users(sora, run, fsm_club):
+    storage = sora.fsm_storage
+
+    async def fill():
+        largest = 0
+        for user_id in range(1, USERS + 1):
+            await storage.set_state(sora.bot, storage_key(sora, user_id), f"Step:{user_id % 7}")
+            if user_id % CHECK_EVERY == 0:
+                largest = max(largest, len(fsm_club.fsm_cache))
+        return largest
+
+    assert run(fill()) == storage.cache_size
+    assert len(fsm_club.fsm_cache) == storage.cache_size
+    assert run(fsm_club.db.fetchone("SELECT COUNT(*) FROM fsm_states"))[0] == USERS
+
+    # Кэш хранит последних пользователей, первые вытеснены, но не потеряны
+    assert storage._key(storage_key(sora, USERS)) in fsm_club.fsm_cache
+    for user_id in (1, 2, USERS // 2):
+        key = storage_key(sora, user_id)
+        assert storage._key(key) not in fsm_club.fsm_cache
+        assert run(storage.get_state(sora.bot, key)) == f"Step:{user_id % 7}"
+        assert storage._key(key) in fsm_club.fsm_cache
+    assert len(fsm_club.fsm_cache) == storage.cache_size
+
+
+def test_evicted_data_reloads_from_database(sora, run, fsm_club):
+    storage = sora.fsm_storage
+    first = storage_key(sora, USERS + 1)
+    run(storage.set_data(sora.bot, first, {"report": {"total": 1500}}))
+
+    async def touch_others():
+        for user_id in range(USERS + 2, USERS + 2 + storage.cache_size):
+            await storage.get_state(sora.bot, storage_key(sora, user_id))
+
+    run(touch_others())
+    assert storage._key(first) not in fsm_club.fsm_cache
+    assert run(storage.get_data(sora.bot, first)) == {"report": {"total": 1500}}
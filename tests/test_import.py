@@ -0,0 +1,35 @@
+"""Неподтверждённые импорты товаров не копятся в памяти и на диске."""
+import os
+import time
+
+
+def test_stale_imports_and_files_are_purged(sora, club):
+    stale_time = time.time() - sora.IMPORT_PENDING_TTL - 1
+    result = sora.ProductImport([], 0, 0, 0, [], [])
+    sora.pending_imports[club.slug, 1] = (stale_time, result)
+    sora.pending_imports[club.slug, 2] = (time.time(), result)
+
+    stale_file = club.export_dir / "import_1_0.xlsx"
+    fresh_file = club.export_dir / "import_2_0.csv"
+    for path in (stale_file, fresh_file):
+        path.write_text("name,quantity\n")
+    os.utime(stale_file, (stale_time, stale_time))
+
+    try:
+        sora.purge_stale_imports()
+
+        assert (club.slug, 1) not in sora.pending_imports
+        assert not stale_file.exists()
+        assert fresh_file.exists()
+        assert sora.take_pending_import(2) is result
+    finally:
+        sora.pending_imports.clear()
+        fresh_file.unlink(missing_ok=True)
+
+
+def test_expired_import_cannot_be_applied(sora, club):
+    sora.pending_imports[club.slug, 3] = (time.time() - sora.IMPORT_PENDING_TTL - 1,
+                                          sora.ProductImport([], 0, 0, 0, [], []))
+
+    assert sora.take_pending_import(3) is None
+    assert (club.slug, 3) not in sora.pending_imports
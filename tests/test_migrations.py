@@ -0,0 +1,112 @@
+"""Миграции схемы и планы частых запросов (EXPLAIN QUERY PLAN)."""
+import logging
+
+import pytest
+
+
+@pytest.fixture
+def migrated(sora, tmp_path):
+    conn = sora.connect_db(tmp_path / "SoraClub.db")
+    sora.apply_migrations(conn)
+    yield conn
+    conn.close()
+
+
+def query_plan(conn, sql, params=()):
+    return " | ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+
+
+def captured_queries(run, club, coroutine):
+    """Выполняет coroutine и возвращает SELECT-запросы, ушедшие в базу клуба, с подставленными параметрами."""
+    statements = []
+    run(club.db.call(lambda conn: conn.set_trace_callback(statements.append)))
+    try:
+        run(coroutine)
+    finally:
+        run(club.db.call(lambda conn: conn.set_trace_callback(None)))
+    return [sql for sql in statements if sql.lstrip().upper().startswith("SELECT")]
+
+
+def test_all_migrations_apply_to_empty_database(sora, migrated):
+    assert migrated.execute("PRAGMA user_version").fetchone()[0] == len(sora.MIGRATIONS)
+
+
+def test_duplicate_shift_reports_are_moved_not_deleted(sora, tmp_path, caplog):
+    conn = sora.connect_db(tmp_path / "old.db")
+    for script in sora.MIGRATIONS[:2]:
+        conn.executescript(script)
+    conn.execute("PRAGMA user_version = 2")
+    report = "INSERT INTO shift_reports (user_id, report_date, total, cash, card, bar, hookah_count, expenses, " \
+             "balance) VALUES (?, ?, ?, 0, 0, 0, 0, 0, 0)"
+    with conn:
+        conn.executemany(report, [(1, "2024-05-01", 100), (1, "2024-05-01", 200), (1, "2024-05-01", 300),
+                                  (2, "2024-05-01", 400), (1, "2024-05-02", 500)])
+
+    with caplog.at_level(logging.WARNING):
+        sora.apply_migrations(conn)
+
+    assert conn.execute("SELECT user_id, report_date, total FROM shift_reports ORDER BY id").fetchall() == [
+        (1, "2024-05-01", 300), (2, "2024-05-01", 400), (1, "2024-05-02", 500)]
+    assert conn.execute("SELECT user_id, report_date, total FROM shift_reports_duplicates ORDER BY id").fetchall() == [
+        (1, "2024-05-01", 100), (1, "2024-05-01", 200)]
+    assert "1 за 2024-05-01 (2 шт.)" in caplog.text
+    conn.close()
+
+
+def test_logs_pages_use_timestamp_indexes(sora, run, club):
+    cases = {
+        "idx_action_logs_timestamp": [{}, {"date_from": "2024-01-01", "date_to": "2024-01-31"}],
+        "idx_action_logs_user_time": [{"user_id": 1}],
+        "idx_action_logs_action_time": [{"action": "Поиск товара"}],
+    }
+    for index, filters_list in cases.items():
+        for filters in filters_list:
+            for key in (None, ("2024-01-15 10:00:00", 100)):
+                for direction in ("next", "prev"):
+                    [sql] = captured_queries(run, club, sora.fetch_logs_page(filters, direction, key))
+                    plan = query_plan(club.db.conn, sql)
+                    assert f"INDEX {index}" in plan, (filters, key, direction, plan)
+                    assert "TEMP B-TREE" not in plan, (filters, plan)
+
+
+def test_products_pages_use_indexes(sora, run, club):
+    for mode in ("list", "edit"):
+        for key in (None, (5, 10) if mode == "list" else (10,)):
+            for direction in ("next", "prev"):
+                [sql] = captured_queries(run, club, sora.fetch_products_page(mode, direction, key))
+                plan = query_plan(club.db.conn, sql)
+                if mode == "list":
+                    assert "INDEX idx_products_quantity" in plan, plan
+                else:
+                    assert "INTEGER PRIMARY KEY" in plan or plan.startswith("SCAN products"), plan
+                assert "TEMP B-TREE" not in plan, plan
+
+
+def test_low_stock_query_uses_partial_index(migrated):
+    # check_low_stock; условие совпадает с частичным индексом
+    plan = query_plan(migrated, "SELECT id, name, quantity, category, reorder_threshold FROM products "
+                                "WHERE quantity < reorder_threshold ORDER BY quantity, id")
+    assert "INDEX idx_products_low_stock" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_pending_users_query_uses_approval_index(migrated):
+    # show_unapproved_users
+    plan = query_plan(migrated, "SELECT user_id, username, first_name, added_date FROM users "
+                                "WHERE is_approved = 0 AND is_banned = 0 ORDER BY added_date DESC")
+    assert "INDEX idx_users_approval (is_approved=? AND is_banned=?)" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_shift_report_lookup_uses_unique_index(migrated):
+    # create_report_start и update_report_start
+    plan = query_plan(migrated, "SELECT id FROM shift_reports WHERE user_id = ? AND report_date = ?", (1, "2024-01-01"))
+    assert "INDEX idx_shift_reports_user_date (user_id=? AND report_date=?)" in plan
+
+
+def test_product_search_uses_fts_index(sora, run, club):
+    # Кроме самого поиска FTS5 читает свою служебную таблицу products_fts_config
+    [sql] = [sql for sql in captured_queries(run, club, sora.search_products("кола")) if "MATCH" in sql]
+    plan = query_plan(club.db.conn, sql)
+    assert "SCAN products_fts VIRTUAL TABLE INDEX 0:M" in plan  # M - ограничение MATCH
+    assert "SEARCH p USING INTEGER PRIMARY KEY" in plan
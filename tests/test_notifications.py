@@ -0,0 +1,129 @@
+"""Очередь уведомлений без сети: ответы 429, приоритеты, сводки и вёдра чатов."""
+import asyncio
+import time
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+RETRY_AFTER = 0.3  # секунды; Telegram присылает целые, но диспетчеру это неважно
+
+
+class FakeBot:
+    """Записывает отправленные сообщения; для чатов из flood отвечает 429 заданное число раз."""
+
+    def __init__(self, flood=None):
+        self.flood = dict(flood or {})
+        self.sent = []  # (время, chat_id, текст)
+
+    async def send_message(self, chat_id, text):
+        if self.flood.get(chat_id):
+            self.flood[chat_id] -= 1
+            raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=text), "Too Many Requests", RETRY_AFTER)
+        self.sent.append((time.monotonic(), chat_id, text))
+        return True
+
+
+@pytest.fixture
+def dispatch(sora, run):
+    """Создаёт диспетчер с fake_bot, выполняет scenario(dispatcher) и останавливает его."""
+
+    def dispatch(fake_bot, scenario, **options):
+        options.setdefault("global_rate", 1000.0)
+        options.setdefault("private_chat_rate", 1000.0)
+
+        async def main():
+            dispatcher = sora.NotificationDispatcher(fake_bot, **options)
+            try:
+                return dispatcher, await scenario(dispatcher)
+            finally:
+                await dispatcher.stop(timeout=5)
+
+        return run(main())
+
+    return dispatch
+
+
+def test_retry_after_holds_chat_and_retries(dispatch):
+    bot = FakeBot(flood={1: 1})
+
+    async def scenario(dispatcher):
+        dispatcher.start()
+        started = time.monotonic()
+        held = dispatcher.send(1, "в чат с ограничением")
+        other = dispatcher.send(2, "в другой чат")
+        return started, await asyncio.gather(held, other)
+
+    dispatcher, (started, delivered) = dispatch(bot, scenario)
+
+    assert delivered == [True, True]
+    assert [chat_id for _, chat_id, _ in bot.sent] == [2, 1]  # 429 в одном чате не задерживает другие
+    assert bot.sent[1][0] - started >= RETRY_AFTER
+    assert (dispatcher.sent_count, dispatcher.retry_count, dispatcher.failed_count) == (2, 1, 0)
+
+
+def test_high_priority_goes_first(sora, dispatch):
+    bot = FakeBot()
+
+    async def scenario(dispatcher):
+        futures = [dispatcher.send(chat_id, "действие", sora.PRIORITY_ACTION) for chat_id in range(10, 15)]
+        futures.append(dispatcher.send(20, "уведомление", sora.PRIORITY_NORMAL))
+        futures.append(dispatcher.send(-30, "отчёт", sora.PRIORITY_REPORT))
+        dispatcher.start()  # очередь уже заполнена - порядок задают только приоритеты
+        return await asyncio.gather(*futures)
+
+    _, delivered = dispatch(bot, scenario)
+
+    assert all(delivered)
+    assert [text for _, _, text in bot.sent] == ["отчёт", "уведомление"] + ["действие"] * 5
+
+
+def test_burst_collapses_into_digest(dispatch):
+    bot = FakeBot()
+
+    async def scenario(dispatcher):
+        dispatcher.start()
+        for number in range(50):
+            dispatcher.send_action(1, f"Действие {number}")
+        dispatcher.flush_digests()
+        await dispatcher._idle.wait()
+
+    dispatch(bot, scenario, digest_interval=60)
+
+    [(_, chat_id, text)] = bot.sent
+    assert chat_id == 1
+    assert text.startswith("🔔 Сводка действий (50)")
+    assert "Действие 0" in text and "Действие 49" in text
+
+
+def test_idle_chat_buckets_are_pruned(dispatch):
+    bot = FakeBot()
+
+    async def scenario(dispatcher):
+        dispatcher.start()
+        await asyncio.gather(*(dispatcher.send(chat_id, "привет") for chat_id in range(100)))
+        await asyncio.sleep(0.01)  # ведро с rate 1000 наполняется за миллисекунду
+        await dispatcher.send(1000, "новый чат")
+        return list(dispatcher.chat_buckets)
+
+    _, buckets = dispatch(bot, scenario, prune_interval=0)
+
+    assert len(bot.sent) == 101
+    assert buckets == ["1000"]
+
+
+def test_blocked_chat_bucket_is_kept(dispatch):
+    bot = FakeBot(flood={1: 1})
+
+    async def scenario(dispatcher):
+        dispatcher.start()
+        held = dispatcher.send(1, "в чат с ограничением")
+        await dispatcher.send(2, "в другой чат")
+        await dispatcher.send(3, "новый чат")  # очистка при создании ведра не трогает заблокированный чат
+        buckets = set(dispatcher.chat_buckets)
+        await held
+        return buckets
+
+    _, buckets = dispatch(bot, scenario, prune_interval=0)
+
+    assert "1" in buckets
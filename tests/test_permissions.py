@@ -0,0 +1,58 @@
+"""Кэш прав доступа: изменение флагов пользователя действует со следующего сообщения."""
+import pytest
+
+BANNED_REPLY = "❌ Ваш доступ к боту заблокирован."
+NOT_APPROVED_REPLY = "❌ Ваш доступ к боту еще не подтвержден"
+WAREHOUSE_REPLY = "📊 Управление складом"
+
+
+@pytest.fixture
+def approved_user(sora, run, client):
+    """Одобренный сотрудник, чьи права уже лежат в кэше клуба."""
+    user_id = 700000 + client.update_id
+    run(client.send(user_id, f"/start {sora.DEFAULT_CLUB}"))
+    run(client.press(sora.MAIN_ADMIN_ID, f"approve_{user_id}"))
+    assert run(client.send(user_id, "📊 Склад"))[0].startswith(WAREHOUSE_REPLY)
+    return user_id
+
+
+def cached_permissions(sora, user_id):
+    return sora.clubs.open[sora.DEFAULT_CLUB].permissions.get(user_id)
+
+
+def test_approved_user_is_served_from_cache(sora, run, client, approved_user):
+    assert cached_permissions(sora, approved_user) == sora.UserPermissions(False, False, True)
+
+    stats = sora.handler_metrics.handlers["warehouse_menu"]
+    queries_before = stats.sql_count
+    assert run(client.send(approved_user, "📊 Склад"))[0].startswith(WAREHOUSE_REPLY)
+    assert stats.sql_count == queries_before
+
+
+def test_ban_callback_applies_to_next_message(sora, run, client, approved_user):
+    run(client.press(sora.MAIN_ADMIN_ID, f"ban_{approved_user}"))
+    assert cached_permissions(sora, approved_user) is None
+
+    assert run(client.send(approved_user, "📊 Склад")) == [BANNED_REPLY]
+
+
+def test_ban_from_admin_panel_applies_to_next_message(sora, run, client, approved_user):
+    run(client.send(sora.MAIN_ADMIN_ID, "🚫 Заблокировать"))
+    run(client.send(sora.MAIN_ADMIN_ID, str(approved_user)))
+
+    assert run(client.send(approved_user, "📊 Склад")) == [BANNED_REPLY]
+
+
+def test_revoked_approval_applies_to_next_message(sora, run, client, approved_user):
+    run(client.press(sora.MAIN_ADMIN_ID, f"disapprove_{approved_user}"))
+
+    replies = run(client.send(approved_user, "📊 Склад"))
+    assert len(replies) == 1 and replies[0].startswith(NOT_APPROVED_REPLY)
+
+
+def test_unban_applies_to_next_message(sora, run, client, approved_user):
+    run(client.press(sora.MAIN_ADMIN_ID, f"ban_{approved_user}"))
+    assert run(client.send(approved_user, "📊 Склад")) == [BANNED_REPLY]
+
+    run(client.press(sora.MAIN_ADMIN_ID, f"unban_{approved_user}"))
+    assert run(client.send(approved_user, "📊 Склад"))[0].startswith(WAREHOUSE_REPLY)
@@ -0,0 +1,34 @@
+"""Запуск бота: тяжёлые библиотеки выгрузок не импортируются, пока их не попросят."""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+LAZY_PACKAGES = {"pandas", "openpyxl", "numpy"}
+IMPORT_BUDGET_S = 3.0  # с запасом: на одном CPU импорт занимает ~0.8 с, с pandas и openpyxl было ~1.4 с
+
+
+def import_times(tmp_path):
+    """Запускает `python -X importtime` на чистом процессе; возвращает {модуль: суммарное время в с}."""
+    env = dict(os.environ, DATA_DIR=str(tmp_path), BOT_TOKEN="123456:STARTUP", PYTHONPATH=str(ROOT))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import SoraEcoSystems"],
+                            cwd=tmp_path, env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr[-2000:]
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit():
+            times[module.strip()] = int(cumulative) / 10 ** 6
+    return times
+
+
+def test_export_libraries_are_not_imported_at_startup(tmp_path):
+    times = import_times(tmp_path)
+
+    assert "SoraEcoSystems" in times
+    assert sorted(module for module in times if module.split(".")[0] in LAZY_PACKAGES) == []
+    assert times["SoraEcoSystems"] < IMPORT_BUDGET_S
@@ -0,0 +1,138 @@
+"""Счётчики stats_counters совпадают с COUNT(*) после любой последовательности изменений."""
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+OPERATIONS = 600
+CHECK_EVERY = 50
+CATEGORIES = ["Бар", "Кальян", "Снэки", None]
+
+# Те же условия, что в миграциях 6 и 10
+EXPECTED_COUNTS = {
+    "users_total": "SELECT COUNT(*) FROM users",
+    "users_admin": "SELECT COUNT(*) FROM users WHERE is_admin = 1",
+    "users_banned": "SELECT COUNT(*) FROM users WHERE is_banned = 1",
+    "users_approved": "SELECT COUNT(*) FROM users WHERE is_approved = 1",
+    "users_pending": "SELECT COUNT(*) FROM users WHERE is_approved = 0 AND is_banned = 0",
+    "products_total": "SELECT COUNT(*) FROM products",
+    "products_low_stock": "SELECT COUNT(*) FROM products WHERE quantity < reorder_threshold",
+    "shift_reports_total": "SELECT COUNT(*) FROM shift_reports",
+    "action_logs_total": "SELECT COUNT(*) FROM action_logs",
+    "actions_24h": "SELECT COUNT(*) FROM action_logs WHERE timestamp > datetime('now', '-1 day')",
+}
+
+
+@pytest.fixture(scope="module")
+def stats_club(sora, run):
+    """Отдельный клуб: случайные удаления не должны задеть пользователей других тестов."""
+    run(sora.clubs.add("stats_random", "Stats", 2))
+    club = run(sora.clubs.acquire("stats_random"))
+    token = sora.current_club.set(club)
+    yield club
+    sora.current_club.reset(token)
+    sora.clubs.release(club)
+
+
+async def random_id(sora, table, column):
+    row = await sora.db.fetchone(f"SELECT {column} FROM {table} ORDER BY random() LIMIT 1")
+    return row[0] if row else None
+
+
+def random_operations(sora, rng):
+    """Набор случайных изменений; каждое - корутина без аргументов."""
+
+    async def add_user():
+        user_id = rng.randint(10, 10 ** 6)
+        await sora.db.execute(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, is_admin, is_banned, is_approved) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, f"user{user_id}", "Сотрудник", rng.random() < 0.1, rng.random() < 0.2, rng.random() < 0.5))
+
+    async def update_user():
+        user_id = await random_id(sora, "users", "user_id")
+        column = rng.choice(["is_admin", "is_banned", "is_approved"])
+        if user_id is not None:
+            await sora.db.execute(f"UPDATE users SET {column} = ? WHERE user_id = ?", (rng.randint(0, 1), user_id))
+
+    async def delete_user():
+        user_id = await random_id(sora, "users", "user_id")
+        await sora.db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+
+    async def add_product():
+        await sora.db.transaction(sora._add_product, f"Товар {rng.random()}", rng.randint(0, 30),
+                                  rng.choice(CATEGORIES), None)
+
+    async def move_stock():
+        product_id = await random_id(sora, "products", "id")
+        if product_id is not None:
+            await sora.apply_stock_movement(product_id, "correction", rng.randint(-15, 15))
+
+    async def set_product_threshold():
+        product_id = await random_id(sora, "products", "id")
+        await sora.db.execute("UPDATE products SET reorder_threshold = ?, threshold_custom = 1 WHERE id = ?",
+                              (rng.randint(0, 25), product_id))
+
+    async def change_category():
+        product_id = await random_id(sora, "products", "id")
+        await sora.db.execute("UPDATE products SET category = ? WHERE id = ?", (rng.choice(CATEGORIES), product_id))
+
+    async def set_category_threshold():
+        await sora.db.execute("INSERT OR REPLACE INTO category_thresholds (category, threshold) VALUES (?, ?)",
+                              (rng.choice(CATEGORIES[:-1]), rng.randint(0, 25)))
+
+    async def delete_category_threshold():
+        await sora.db.execute("DELETE FROM category_thresholds WHERE category = ?", (rng.choice(CATEGORIES[:-1]),))
+
+    async def delete_product():
+        product_id = await random_id(sora, "products", "id")
+        await sora.db.execute("DELETE FROM products WHERE id = ?", (product_id,))
+
+    async def add_report():
+        await sora.db.execute(
+            "INSERT OR IGNORE INTO shift_reports (user_id, report_date, total, cash, card, bar, hookah_count, "
+            "expenses, balance) VALUES (?, date('2024-01-01', ? || ' days'), 1000, 500, 500, 0, 0, 0, 1000)",
+            (rng.randint(1, 5), rng.randint(0, 60)))
+
+    async def delete_report():
+        report_id = await random_id(sora, "shift_reports", "id")
+        await sora.db.execute("DELETE FROM shift_reports WHERE id = ?", (report_id,))
+
+    async def add_logs():
+        # Часть записей старше срока хранения - их заберёт архивация
+        now = datetime.now(timezone.utc)
+        await sora.db.executemany(
+            "INSERT INTO action_logs (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
+            [(rng.randint(1, 5), "Поиск товара", "",
+              (now - timedelta(hours=rng.randint(0, 24 * 200))).strftime('%Y-%m-%d %H:%M:%S'))
+             for _ in range(rng.randint(1, 20))])
+
+    async def delete_log():
+        log_id = await random_id(sora, "action_logs", "id")
+        await sora.db.execute("DELETE FROM action_logs WHERE id = ?", (log_id,))
+
+    async def archive_logs():
+        await sora.log_archiver.archive()
+
+    return [add_user, add_user, update_user, update_user, delete_user, add_product, add_product, move_stock,
+            move_stock, set_product_threshold, change_category, set_category_threshold, delete_category_threshold,
+            delete_product, add_report, delete_report, add_logs, add_logs, delete_log, archive_logs]
+
+
+def assert_counters_match(sora, run, step):
+    stats = run(sora.get_stats())
+    for name, sql in EXPECTED_COUNTS.items():
+        assert stats[name] == run(sora.db.fetchone(sql))[0], (step, name)
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_counters_match_counts_after_random_changes(sora, run, stats_club, seed):
+    rng = random.Random(seed)
+    operations = random_operations(sora, rng)
+    for step in range(1, OPERATIONS + 1):
+        run(rng.choice(operations)())
+        if step % CHECK_EVERY == 0:
+            assert_counters_match(sora, run, step)
+
+    assert run(sora.db.fetchone("SELECT COUNT(*) FROM products"))[0] > 0
+    assert sora.log_archiver.archived_count > 0
@@ -0,0 +1,128 @@
+"""Параллельные движения остатка одного товара: без потерянных обновлений и ухода в минус."""
+import asyncio
+import random
+import threading
+import time
+
+import pytest
+
+WORKERS = 8
+MOVEMENTS_PER_WORKER = 200
+START_QUANTITY = 10
+
+
+@pytest.fixture
+def database_path(sora, tmp_path):
+    path = tmp_path / "SoraClub.db"
+    conn = sora.connect_db(path)
+    sora.apply_migrations(conn)
+    conn.close()
+    return path
+
+
+def add_product(conn, sora):
+    return sora._add_product(conn, "Кола", START_QUANTITY, "Бар", None)[0]
+
+
+def assert_consistent(conn, product_id, applied):
+    quantity = conn.execute("SELECT quantity FROM products WHERE id = ?", (product_id,)).fetchone()[0]
+    assert quantity == START_QUANTITY + sum(applied)
+
+    movements = conn.execute(
+        "SELECT delta, quantity_after FROM stock_movements WHERE product_id = ? ORDER BY id", (product_id,)
+    ).fetchall()
+    # Первое движение - сам приход товара
+    assert movements[0] == (START_QUANTITY, START_QUANTITY)
+    assert sorted(delta for delta, _ in movements[1:]) == sorted(applied)
+    for (_, previous), (delta, after) in zip(movements, movements[1:]):
+        assert after == previous + delta
+        assert after >= 0
+    assert movements[-1][1] == quantity
+
+
+def test_concurrent_connections_keep_chain_consistent(sora, database_path):
+    """Каждый поток - отдельное соединение, как у нескольких процессов бота на одной базе."""
+    conn = sora.connect_db(database_path)
+    with conn:
+        product_id = add_product(conn, sora)
+
+    applied, rejected, errors = [], [], []
+    start = threading.Barrier(WORKERS)
+
+    def adjuster(seed):
+        rng = random.Random(seed)
+        worker_conn = sora.connect_db(database_path)
+        try:
+            start.wait()
+            for _ in range(MOVEMENTS_PER_WORKER):
+                delta = rng.choice([-3, -2, -1, 1, 2, 3])
+                with worker_conn:
+                    row = sora._apply_stock_movement(worker_conn, product_id, "correction", delta, seed, None)
+                (applied if row else rejected).append(delta)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            worker_conn.close()
+
+    threads = [threading.Thread(target=adjuster, args=(seed,)) for seed in range(WORKERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(applied) + len(rejected) == WORKERS * MOVEMENTS_PER_WORKER
+    assert rejected and all(delta < 0 for delta in rejected)
+    assert_consistent(conn, product_id, applied)
+    conn.close()
+
+
+def test_concurrent_handlers_keep_chain_consistent(sora, run, club):
+    """Обработчики бота: apply_stock_movement из множества задач цикла событий."""
+    product_id = run(club.db.transaction(add_product, sora))
+    rng = random.Random(1)
+    deltas = [rng.choice([-3, -2, -1, 1, 2, 3]) for _ in range(WORKERS * MOVEMENTS_PER_WORKER)]
+
+    async def adjust_all():
+        return await asyncio.gather(*(sora.apply_stock_movement(product_id, "correction", delta)
+                                      for delta in deltas))
+
+    results = run(adjust_all())
+    applied = [delta for delta, result in zip(deltas, results) if result]
+    assert any(result is None for result in results)
+    run(club.db.call(assert_consistent, product_id, applied))
+
+
+@pytest.fixture
+def local_timezone(monkeypatch):
+    """Меняет местный часовой пояс процесса; SQLite 'localtime' и 'utc' берут его из libc."""
+
+    def set_timezone(name):
+        monkeypatch.setenv("TZ", name)
+        time.tzset()
+
+    yield set_timezone
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.mark.parametrize("timezone", ["America/New_York", "Europe/Moscow"])
+def test_stock_at_uses_local_day(sora, run, club, local_timezone, timezone):
+    """Движение за минуту до местной полуночи относится к этому дню, через минуту - к следующему."""
+    local_timezone(timezone)
+    product_id = run(club.db.transaction(add_product, sora))
+
+    async def move_at(delta, local_time):
+        await sora.apply_stock_movement(product_id, "correction", delta)
+        await club.db.execute(
+            "UPDATE stock_movements SET created_at = datetime(?, 'utc') "
+            "WHERE id = (SELECT MAX(id) FROM stock_movements WHERE product_id = ?)", (local_time, product_id))
+
+    run(club.db.execute("UPDATE stock_movements SET created_at = datetime('2024-06-01 12:00', 'utc') "
+                        "WHERE product_id = ?", (product_id,)))
+    run(move_at(5, "2024-06-01 23:59"))
+    run(move_at(-3, "2024-06-02 00:01"))
+
+    assert run(sora.get_stock_at(product_id, "2024-05-31")) is None
+    assert run(sora.get_stock_at(product_id, "2024-06-01")) == START_QUANTITY + 5
+    assert run(sora.get_stock_at(product_id, "2024-06-02")) == START_QUANTITY + 2
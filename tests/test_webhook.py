@@ -0,0 +1,118 @@
+"""Webhook-сервер: проверка секрета, передача обновления диспетчеру и мягкая остановка."""
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+SECRET = "webhook-secret"
+
+
+def recorded_update(sora, update_id, text):
+    """Обновление в том виде, в каком его присылает Telegram."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1717243200,
+            "chat": {"id": sora.MAIN_ADMIN_ID, "type": "private", "first_name": "Admin"},
+            "from": {"id": sora.MAIN_ADMIN_ID, "is_bot": False, "first_name": "Admin", "language_code": "ru"},
+            "text": text,
+        },
+    }
+
+
+class FakeDispatcher:
+    """Запоминает полученные обновления; обработка ждёт gate, если он задан."""
+
+    def __init__(self, gate=None):
+        self.gate = gate
+        self.received = []
+        self.finished = []
+
+    async def feed_raw_update(self, bot, update):
+        self.received.append(update["update_id"])
+        if self.gate is not None:
+            await self.gate.wait()
+        self.finished.append(update["update_id"])
+
+
+@pytest.fixture
+def serve(sora, run):
+    """Выполняет scenario(server, client) против WebhookServer, поднятого на TestClient."""
+
+    def serve(dispatcher, scenario):
+        async def main():
+            server = sora.WebhookServer(dispatcher, sora.bot, secret=SECRET)
+            server.accepting = True  # start() ещё и регистрирует webhook; здесь сервер поднимает TestServer
+            client = TestClient(TestServer(server.app))
+            await client.start_server()
+            try:
+                return server, await scenario(server, client)
+            finally:
+                await client.close()
+
+        return run(main())
+
+    return serve
+
+
+def test_wrong_or_missing_secret_is_rejected(sora, serve):
+    dispatcher = FakeDispatcher()
+
+    async def scenario(server, client):
+        update = recorded_update(sora, 1, "📊 Склад")
+        missing = await client.post(server.path, json=update)
+        wrong = await client.post(server.path, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "guess"})
+        await asyncio.sleep(0)
+        return missing.status, wrong.status
+
+    server, statuses = serve(dispatcher, scenario)
+
+    assert statuses == (401, 401)
+    assert dispatcher.received == []
+    assert not server.tasks
+
+
+def test_recorded_update_reaches_handler(sora, run, client, serve):
+    sent = len(client.session.requests)
+
+    async def scenario(server, http):
+        response = await http.post(server.path, json=recorded_update(sora, 900001, "📊 Склад"),
+                                   headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+        await asyncio.gather(*server.tasks)
+        return response.status
+
+    server, status = serve(sora.dp, scenario)
+
+    assert status == 200
+    assert server.handled_count == 1 and server.failed_count == 0
+    replies = [method.text for method in client.session.requests[sent:] if hasattr(method, "text")]
+    assert replies[0].startswith("📊 Управление складом")
+
+
+def test_stop_waits_for_in_flight_updates(sora, serve):
+    gate = asyncio.Event()
+    dispatcher = FakeDispatcher(gate)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+
+    async def scenario(server, client):
+        response = await client.post(server.path, json=recorded_update(sora, 1, "📊 Склад"), headers=headers)
+        assert response.status == 200
+        await asyncio.sleep(0)
+        assert dispatcher.received == [1] and dispatcher.finished == []
+
+        stopping = asyncio.create_task(server.stop(timeout=5))
+        await asyncio.sleep(0.05)
+        late = await client.post(server.path, json=recorded_update(sora, 2, "📊 Склад"), headers=headers)
+        stopped_early = stopping.done()
+
+        gate.set()
+        await stopping
+        return late.status, stopped_early
+
+    server, (late_status, stopped_early) = serve(dispatcher, scenario)
+
+    assert late_status == 503  # после начала остановки новые обновления не принимаются
+    assert not stopped_early
+    assert dispatcher.finished == [1]
+    assert server.handled_count == 1